@@ -21,12 +21,21 @@ functions:
    listAtlases
    hasAtlas
    getAtlasDescription
+   searchAtlases
    loadAtlas
+   releaseAtlas
+   setAtlasCacheSize
+   atlasCacheStats
    addAtlas
    removeAtlas
    rescanAtlases
 
 
+The :class:`AtlasRegistry` and :class:`AtlasDescription` classes are defined
+in the :mod:`.atlasregistry` module, which can be used without importing
+``nibabel`` or ``scipy``. They are also available via this module.
+
+
 You must call the :meth:`.AtlasRegistry.rescanAtlases` function before any of
 the other functions will work.  The :func:`loadAtlas` function allows you to
 load an atlas image, which will be one of the following atlas-specific
@@ -42,673 +51,526 @@ load an atlas image, which will be one of the following atlas-specific
 
 from __future__ import division
 
-import xml.etree.ElementTree              as et
 import os.path                            as op
-import                                       glob
-import                                       bisect
+import                                       os
 import                                       logging
+import                                       tempfile
+import                                       collections
 
 import numpy                              as np
+import scipy.ndimage                      as ndimage
+import scipy.sparse                       as sparse
 
 import fsl.data.image                     as fslimage
+import fsl.data.imagewrapper              as imagewrapper
 import fsl.data.constants                 as constants
-from   fsl.utils.platform import platform as platform
+import fsl.data.atlasregistry             as atlasregistry
 import fsl.utils.transform                as transform
-import fsl.utils.notifier                 as notifier
-import fsl.utils.settings                 as fslsettings
+import fsl.utils.settings                 as fslsettings  # noqa
 
 
 log = logging.getLogger(__name__)
 
 
-class AtlasRegistry(notifier.Notifier):
-    """The ``AtlasRegistry`` maintains a list of all known atlases.
-
-
-    When the :meth:`rescanAtlases` method is called, the ``AtlasRegistry``
-    loads all of the FSL XML atlas specification files in
-    ``$FSLDIR/data/atlases``, and builds a list of :class:`AtlasDescription`
-    instances, each of which contains information about one atlas.
-
-
-    The :meth:`addAtlas` method allows other atlases to be added to the
-    registry. Whenever a new atlas is added, the ``AtlasRegistry`` notifies
-    any registered listeners via the :class:`.Notifier` interface with the
-    topic ``'add'``, passing it the newly loaded class:`AtlasDecsription`.
-    Similarly, the :meth:`removeAtlas` method allows individual atlases to be
-    removed. When this occurs, registered listeners on the ``'remove'`` topic
-    are notified, and passed the ``AtlasDescription`` instance of the removed
-    atlas.
+# The registry and description classes are
+# defined in the atlasregistry module, so
+# that they can be used without importing
+# nibabel - they are made available here
+# for convenience and backwards
+# compatibility.
+AtlasRegistry       = atlasregistry.AtlasRegistry
+AtlasDescription    = atlasregistry.AtlasDescription
+AtlasLabel          = atlasregistry.AtlasLabel
+atlasSize           = atlasregistry.atlasSize
+descStamp           = atlasregistry.descStamp
+registry            = atlasregistry.registry
+rescanAtlases       = atlasregistry.rescanAtlases
+listAtlases         = atlasregistry.listAtlases
+hasAtlas            = atlasregistry.hasAtlas
+getAtlasDescription = atlasregistry.getAtlasDescription
+searchAtlases       = atlasregistry.searchAtlases
+loadAtlas           = atlasregistry.loadAtlas
+releaseAtlas        = atlasregistry.releaseAtlas
+setAtlasCacheSize   = atlasregistry.setAtlasCacheSize
+atlasCacheStats     = atlasregistry.atlasCacheStats
+addAtlas            = atlasregistry.addAtlas
+removeAtlas         = atlasregistry.removeAtlas
 
 
-    The ``AtlasRegistry`` stores a list of all known atlases via the
-    :mod:`.settings` module. When an ``AtlasRegistry`` is created, it loads
-    in any previously known atlases. Whenever a new atlas is added, this
-    list is updated. See the :meth:`__getKnownAtlases` and
-    :meth:`_saveKnownAtlases` methods.
+class Atlas(fslimage.Image):
+    """This is the base class for the :class:`LabelAtlas` and
+    :class:`ProbabilisticAtlas` classes. It contains some initialisation
+    logic common to both.
     """
 
 
-    def __init__(self):
-        """Create an ``AtlasRegistry``. """
-
-        # A list of all AtlasDescription
-        # instances in existence, sorted
-        # by AtlasDescription.name.
-        self.__atlasDescs = []
-
-
-    def rescanAtlases(self):
-        """Causes the ``AtlasRegistry`` to rescan available atlases from
-        ``$FSLDIR``. Atlases are loaded from the ``fsl.data.atlases`` setting
-        (via the :mod:`.settings` module), and from ``$FSLDIR/data/atlases/``.
-        """
-
-        log.debug('Initialising atlas registry')
-        self.__atlasDescs = []
-
-        # Get $FSLDIR atlases
-        fslPaths = []
-        if platform.fsldir is not None:
-            fsldir   = op.join(platform.fsldir, 'data', 'atlases')
-            fslPaths = sorted(glob.glob(op.join(fsldir, '*.xml')))
-
-        # Any extra atlases that have
-        # been loaded in the past
-        extraIDs, extraPaths = self.__getKnownAtlases()
-
-        # FSLDIR atlases first, any
-        # other atlases second.
-        atlasPaths = list(fslPaths)         + extraPaths
-        atlasIDs   = [None] * len(fslPaths) + extraIDs
-
-        with self.skipAll():
-            for atlasID, atlasPath in zip(atlasIDs, atlasPaths):
-
-                # The FSLDIR atlases are probably
-                # listed twice - from the above glob,
-                # and from the saved extraPaths. So
-                # we remove any duplicates.
-                if atlasID is not None and self.hasAtlas(atlasID):
-                    continue
-
-                try:
-                    self.addAtlas(atlasPath, atlasID, save=False)
-                except Exception:
-                    log.warning('Failed to load atlas '
-                                'specification {}'.format(atlasPath),
-                                exc_info=True)
-
+    def __init__(self,
+                 atlasDesc,
+                 resolution=None,
+                 isLabel=False,
+                 **kwargs):
+        """Initialise an ``Atlas``.
 
-    def listAtlases(self):
-        """Returns a list containing :class:`AtlasDescription` objects for
-        all available atlases. The atlases are ordered in terms of the
-        ``AtlasDescription.name`` attribute (converted to lower case).
-        """
-        return list(self.__atlasDescs)
+        :arg atlasDesc:  The :class:`AtlasDescription` instance which
+                         describes the atlas.
 
+        :arg resolution: Desired isotropic resolution in millimetres.
 
-    def hasAtlas(self, atlasID):
-        """Returns ``True`` if this ``AtlasRegistry`` has an atlas with the
-        specified ``atlasID``.
-        """
-        return atlasID in [d.atlasID for d in self.__atlasDescs]
+        :arg isLabel:    Pass in ``True`` for label atlases, ``False`` for
+                         probabilistic atlases.
 
+        All other arguments are passed to :meth:`.Image.__init__`.
 
-    def getAtlasDescription(self, atlasID):
-        """Returns an :class:`AtlasDescription` instance describing the
-        atlas with the given ``atlasID``.
+        :raises: A ``ValueError`` if the atlas description does not contain
+                 any images, or if the headers of its images could not be
+                 read.
         """
 
-        for desc in self.__atlasDescs:
-            if desc.atlasID == atlasID:
-                return desc
+        if len(atlasDesc.images) == 0 or len(atlasDesc.pixdims) == 0:
+            raise ValueError('Atlas {} ({}) does not have any readable '
+                             'images'.format(atlasDesc.atlasID,
+                                             atlasDesc.specPath))
 
-        raise KeyError('Unknown atlas ID: {}'.format(atlasID))
-
-
-    def loadAtlas(self, atlasID, loadSummary=False, resolution=None, **kwargs):
-        """Loads and returns an :class:`Atlas` instance for the atlas
-        with the given  ``atlasID``.
-
-        :arg loadSummary: If ``True``, a 3D :class:`LabelAtlas` image is
-                          loaded. Otherwise, if the atlas is probabilistic,
-                          a 4D :class:`ProbabilisticAtlas` image is loaded.
-
-        :arg resolution: Optional. Desired isotropic atlas resolution in
-                         millimetres, e.g. ``1.0`` or ``2.0``. The available
-                         atlas with the nearest resolution to this value
-                         will be returned. If not provided, the highest
-                         resolution atlas will be loaded.
-        """
-
-        atlasDesc = self.getAtlasDescription(atlasID)
+        # Get the index of the atlas with the
+        # nearest resolution to that provided.
+        # If a reslution has not been provided,
+        # choose the atlas image with the
+        # highest resolution.
+        #
+        # We divide by three to get the atlas
+        # image index because there are three
+        # pixdim values for each atlas.
+        res   = resolution
+        reses = np.concatenate(atlasDesc.pixdims)
 
-        # label atlases are only
-        # available in 'summary' form
-        if atlasDesc.atlasType == 'label':
-            loadSummary = True
+        if resolution is None: imageIdx = np.argmin(reses)
+        else:                  imageIdx = np.argmin(np.abs(reses - res))
 
-        if loadSummary: atype = LabelAtlas
-        else:           atype = ProbabilisticAtlas
+        imageIdx = imageIdx // 3
 
-        return atype(atlasDesc, resolution, **kwargs)
+        if isLabel: imageFile = atlasDesc.summaryImages[imageIdx]
+        else:       imageFile = atlasDesc.images[       imageIdx]
 
+        fslimage.Image.__init__(self, imageFile, **kwargs)
 
-    def addAtlas(self, filename, atlasID=None, save=True):
-        """Add an atlas from the given XML specification file to the registry.
+        # Even though all the FSL atlases
+        # are in MNI152 space, not all of
+        # their sform_codes are correctly set
+        self.nibImage.header.set_sform(
+            None, code=constants.NIFTI_XFORM_MNI_152)
 
-        :arg filename: Path to a FSL XML atlas specification file.
+        self.desc = atlasDesc
 
-        :arg atlasID:  ID to give this atlas. If not provided, the file
-                       base name (converted to lower-case) is used. If an
-                       atlas with the given ID already exists, this new atlas
-                       is given a unique id.
 
-        :arg save:     If ``True`` (the default), this atlas will be saved
-                       so that it will be available in future instantiations.
+    def find(self, *args, **kwargs):
+        """Find an ``AtlasLabel`` - see the :meth:`AtlasDescription.find`
+        method.
         """
+        return self.desc.find(*args, **kwargs)
 
-        filename = op.abspath(filename)
-
-        if atlasID is None:
-            atlasIDBase = op.splitext(op.basename(filename))[0].lower()
-            atlasID     = atlasIDBase
-        else:
-            atlasIDBase = atlasID
-
-        # If an atlas with the same ID/path
-        # already exists, raise an error
-        if self.hasAtlas(atlasID):
-            raise KeyError('An atlas with ID "{}" already '
-                           'exists'.format(atlasID))
-
-        desc = AtlasDescription(filename, atlasID)
-
-        log.debug('Adding atlas to registry: {} / {}'.format(
-            desc.atlasID,
-            desc.specPath))
-
-        bisect.insort_left(self.__atlasDescs, desc)
-
-        if save:
-            self.__saveKnownAtlases()
 
-        self.notify(topic='add', value=desc)
+    def prepareMask(self, mask):
+        """Makes sure that the given mask has the same resolution as this
+        atlas, so it can be used for querying. Used by the
+        :meth:`.LabelAtlas.maskLabels` and
+        :meth:`.ProbabilisticAtlas.maskProportions` methods.
 
-        return desc
+        :arg mask: A :class:`.Image`
 
+        :returns:  A ``numpy`` array containing the resampled mask data.
 
-    def removeAtlas(self, atlasID):
-        """Removes the atlas with the specified ``atlasID`` from this
-        ``AtlasRegistry``.
+        :raises:   A :exc:`MaskError` if the mask is not in the same space as
+                   this atlas, or does not have three dimensions.
         """
 
-        remove = None
-
-        for i, desc in enumerate(self.__atlasDescs):
-            if desc.atlasID == atlasID:
-
-                log.debug('Removing atlas from registry: {} / {}'.format(
-                    desc.atlasID,
-                    desc.specPath))
-
-                self.__atlasDescs.pop(i)
-                remove = desc
-                break
-
-        self.__saveKnownAtlases()
-
-        if remove is not None:
-            self.notify(topic='remove', value=remove)
-
-
-    def __getKnownAtlases(self):
-        """Returns a list of tuples containing the IDs and paths of all known
-        atlases .
-
-        The atlases are retrieved via the :mod:`.settings` module - a setting
-        with the name ``fsl.data.atlases`` is assumed to contain a string of
-        ``atlasID=specPath`` pairs, separated with the operating system file
-        path separator (``:`` on Unix/Linux).
-        See also :meth:`__saveKnownAtlases`.
-        """
+        # Make sure that the mask has the same
+        # number of voxels as the atlas image.
+        # Use nearest neighbour interpolation
+        # for resampling, as it is most likely
+        # that the mask is binary.
         try:
-            atlases = fslsettings.read('fsl.data.atlases')
-
-            if atlases is None: atlases = []
-            else:               atlases = atlases.split(op.pathsep)
-
-            atlases = [e.split('=') for e in atlases]
-            atlases = [(name.strip(), path.strip())
-                       for name, path in atlases
-                       if op.exists(path)]
-
-            names = [e[0] for e in atlases]
-            paths = [e[1] for e in atlases]
-
-            return names, paths
-
-        except Exception:
-            return [], []
-
-
-    def __saveKnownAtlases(self):
-        """Saves the IDs and paths of all atlases which are currently in
-        the registry. The atlases are saved via the :mod:`.settings` module.
-        """
-
-        if self.__atlasDescs is None:
-            return
-
-        atlases = []
-
-        for desc in self.__atlasDescs:
-            atlases.append((desc.atlasID, desc.specPath))
-
-        atlases = ['{}={}'.format(name, path) for name, path in atlases]
-        atlases = op.pathsep.join(atlases)
-
-        fslsettings.write('fsl.data.atlases', atlases)
-
+            mask, xform = mask.resample(self.shape[:3],
+                                        dtype=np.float32,
+                                        order=0)
 
-class AtlasLabel(object):
-    """The ``AtlasLabel`` class is used by the :class:`AtlasDescription` class
-    as a container object used for storing atlas label information.
+        except ValueError:
+            raise MaskError('Mask has wrong number of dimensions')
 
-    An ``AtlasLabel`` instance contains the following attributes:
+        # TODO allow non-aligned mask - as long as it overlaps
+        #      in world coordinates, it should be allowed
+        if not fslimage.Image(mask, xform=xform).sameSpace(self):
+            raise MaskError('Mask is not in the same space as atlas')
 
-    ========= ================================================================
-    ``name``  Region name
-    ``index`` The index of this label into the list of all labels in the
-              ``AtlasDescription`` that owns it. For probabilistic atlases,
-              this is also the index into the 4D atlas image of the volume
-              that corresponds to this region.
-    ``value`` For label atlases and summary images, the value of voxels that
-              are in this region.
-    ``x``     X coordinate of the region in world space
-    ``y``     Y coordinate of the region in world space
-    ``z``     Z coordinate of the region in world space
-    ========= ================================================================
+        return mask
 
-    .. note:: The ``x``, ``y`` and ``z`` label coordinates are pre-calculated
-              centre-of-gravity coordinates, as listed in the atlas xml file.
-              They are in the coordinate system defined by the transformation
-              matrix for the first image in the ``images`` list of the atlas
-              XML file (typically MNI152 space).
-    """
 
-    def __init__(self, name, index, value, x, y, z):
-        self.name  = name
-        self.index = index
-        self.value = value
-        self.x     = x
-        self.y     = y
-        self.z     = z
+    def prepareMasks(self, masks, chunkSize=None):
+        """Resamples a collection of masks so that they have the same
+        resolution as this atlas. Used by the
+        :meth:`.LabelAtlas.maskProportionMatrix` and
+        :meth:`.ProbabilisticAtlas.maskProportionMatrix` methods.
 
+        Masks which have the same shape and voxel-to-world affine are
+        grouped, and each group is resampled, and checked against the atlas
+        space, in one go.
 
-    def __eq__(self, other):
-        """Compares the ``index`` of this ``AtlasLabel`` with another.
-        """
-        return self.index == other.index
+        :arg masks:     A sequence of 3D :class:`.Image` objects, or a single
+                        4D :class:`.Image`, where each volume is interpreted
+                        as a mask.
 
+        :arg chunkSize: Maximum number of bytes of resampled mask data to
+                        yield at a time. Defaults to
+                        :attr:`.ImageWrapper.DEFAULT_CHUNK_SIZE`. A chunk
+                        always contains at least one mask.
 
-    def __neq__(self, other):
-        """Compares the ``index`` of this ``AtlasLabel`` with another.
-        """
-        return self.index != other.index
+        :returns:       A generator which yields tuples containing:
 
+                          - A list of indices into ``masks``
+                          - A ``numpy`` array of shape ``(X, Y, Z, N)``,
+                            containing the resampled data for the ``N``
+                            masks.
 
-    def __lt__(self, other):
-        """Compares this ``AtlasLabel`` with another by their ``index``
-        attribute.
+        :raises:        A :exc:`MaskError` if any mask is not in the same
+                        space as this atlas, or does not have three
+                        dimensions.
         """
-        return self.index < other.index
-
-
-class AtlasDescription(object):
-    """An ``AtlasDescription`` instance parses and stores the information
-    stored in the FSL XML file that describes a single FSL atlas.  An XML
-    atlas specification file is assumed to have a structure that looks like
-    the following:
-
-    .. code-block:: xml
 
-       <atlas>
-         <header>
-           <name></name>        # Atlas name
-           <type></type>        # 'Probabilistic' or 'Label'
-           <images>
-            <imagefile>
-            </imagefile>        # If type is Probabilistic, path
-                                # to 4D image file, one volume per
-                                # label, Otherwise, if type is
-                                # Label, path to 3D label file
-                                # (identical to the summaryimagefile
-                                # below). The path must be specified
-                                # as relative to the location of this
-                                # XML file.
+        if chunkSize is None:
+            chunkSize = imagewrapper.ImageWrapper.DEFAULT_CHUNK_SIZE
 
-            <summaryimagefile>  # Path to 3D label summary file,
-            </summaryimagefile> # Every <image> must be accompanied
-                                # by a <summaryimage> - for label
-                                # atlases, they will typically refer
-                                # to the same image file.
+        # A 4D image is treated as a
+        # single group of masks
+        if isinstance(masks, fslimage.Image):
+            if len(masks.shape) != 4:
+                raise MaskError('Mask has wrong number of dimensions')
+            groups = [(masks, list(range(masks.shape[3])))]
 
-           </images>
-           ...                  # More images - generally both
-                                # 1mm and 2mm  versions (in
-                                # MNI152 space) are available
-         </header>
-        <data>
+        else:
+            masks  = list(masks)
+            groups = collections.OrderedDict()
+            for i, mask in enumerate(masks):
+                if len(mask.shape) != 3:
+                    raise MaskError('Mask has wrong number of dimensions')
+                key = (tuple(mask.shape), mask.voxToWorldMat.tobytes())
+                groups.setdefault(key, []).append(i)
+            groups = [(masks[idxs[0]], idxs) for idxs in groups.values()]
+
+        shape    = self.shape[:3]
+        perMask  = 4 * np.prod(shape)
+        maxMasks = max(1, int(chunkSize // perMask))
+
+        for template, idxs in groups:
+
+            # The resampling geometry, and the
+            # check against the atlas space, are
+            # the same as in Image.resample and
+            # prepareMask, but only need to be
+            # done once for the whole group.
+            oldShape = np.array(template.shape[:3], dtype=np.float64)
+            ratio    = oldShape / np.array(shape, dtype=np.float64)
+            resample = not np.all(np.isclose(ratio, 1))
+
+            if resample:
+                scale = transform.scaleOffsetXform(ratio, 0)
+                xform = transform.concat(template.voxToWorldMat, scale)
+            else:
+                xform = template.voxToWorldMat
 
-         # index - For probabilistic atlases, index of corresponding volume in
-         #         4D image file. For label images, the value of voxels which
-         #         are in the corresponding region. For probabilistic atlases,
-         #         it is assumed that the value for each region in the  summary
-         #         image(s) are equal to ``index + 1``.
-         #
-         #
-         # x    |
-         # y    |- XYZ *voxel* coordinates into the first image of the <images>
-         #      |  list
-         # z    |
-         <label index="0" x="0" y="0" z="0">Name</label>
-         ...
-        </data>
-       </atlas>
+            check = fslimage.Image(np.zeros(shape, dtype=np.float32),
+                                   xform=xform)
+            if not check.sameSpace(self):
+                raise MaskError('Mask is not in the same space as atlas')
 
+            for start in range(0, len(idxs), maxMasks):
 
-    Each ``AtlasDescription`` is assigned an identifier, which is simply the
-    XML file name describing the atlas, sans-suffix, and converted to lower
-    case.  For exmaple, the atlas described by:
+                chunk = idxs[start:start + maxMasks]
 
-        ``$FSLDIR/data/atlases/HarvardOxford-Cortical.xml``
+                if isinstance(masks, fslimage.Image):
+                    data = masks[:, :, :, chunk[0]:chunk[-1] + 1]
+                else:
+                    data = np.stack([masks[i][:] for i in chunk], axis=-1)
 
-    is given the identifier
+                data = np.array(data, dtype=np.float32, copy=False)
 
-        ``harvardoxford-cortical``
+                # Nearest neighbour resampling
+                # of all masks in the chunk - the
+                # last axis is left untouched.
+                if resample:
+                    data = ndimage.affine_transform(
+                        data,
+                        np.concatenate((ratio, [1])),
+                        output_shape=tuple(shape) + (len(chunk), ),
+                        order=0)
 
+                yield chunk, data
 
-    This identifier is intended to be unique.
 
+    def prepareCoords(self, coords, voxel=False):
+        """Transforms the given coordinates into voxel coordinates, and
+        checks that they are within the bounds of this atlas. Used by the
+        :meth:`.LabelAtlas.coordLabels` and
+        :meth:`.ProbabilisticAtlas.coordProportions` methods.
 
-    The following attributes are available on an ``AtlasDescription`` instance:
+        :arg coords: A ``(N, 3)`` array of world or voxel coordinates.
 
-    ================= ======================================================
-    ``atlasID``       The atlas ID, as described above.
+        :arg voxel:  If ``True``, the ``coords`` are interpreted as voxel
+                     coordinates. Otherwise they are interpreted as world
+                     coordinates.
 
-    ``name``          Name of the atlas.
+        :returns:    A tuple containing:
 
-    ``specPath``      Path to the atlas XML specification file.
+                       - A ``(N, 3)`` integer array of voxel coordinates
+                       - A ``(N, )`` boolean array which is ``True`` for
+                         voxel coordinates that are within the atlas bounds.
+        """
 
-    ``atlasType``     Atlas type - either *probabilistic* or *label*.
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
 
-    ``images``        A list of images available for this atlas - usually
-                      :math:`1mm^3` and :math:`2mm^3` images are present.
+        if not voxel:
+            coords = transform.transform(coords, self.worldToVoxMat)
 
-    ``summaryImages`` For probabilistic atlases, a list of *summary* images,
-                      which are just 3D labelled variants of the atlas.
+        voxels   = np.round(coords).astype(np.int64)
+        inBounds = np.all((voxels >= 0) &
+                          (voxels <  np.array(self.shape[:3])), axis=1)
 
-    ``pixdims``       A list of ``(x, y, z)`` pixdim tuples in mm, one for
-                      each image in ``images``.
+        return voxels, inBounds
 
-    ``xforms``        A list of affine transformation matrices (as ``4*4``
-                      ``numpy`` arrays), one for each image in ``images``,
-                      defining the voxel to world coordinate transformations.
 
-    ``labels``        A list of :class`AtlasLabel` objects, describing each
-                      region / label in the atlas.
-    ================= ======================================================
-    """
+    def sampleVoxels(self, voxels):
+        """Returns the atlas values at the given voxels. Used by the
+        :meth:`.LabelAtlas.coordLabels` and
+        :meth:`.ProbabilisticAtlas.coordProportions` methods.
 
+        If the atlas data is not loaded into memory, only the bounding box
+        which contains all of the voxels is read.
 
-    def __init__(self, filename, atlasID=None):
-        """Create an ``AtlasDescription`` instance.
+        :arg voxels: A ``(N, 3)`` array of in-bounds voxel coordinates.
 
-        :arg filename: Name of the XML file describing the atlas.
-
-        :arg atlasID:  ID to use for this atlas. If not provided, the file
-                       base name is used.
+        :returns:    A ``(N, )`` array (for a 3D atlas), or a ``(N, V)`` array
+                     (for a 4D atlas with ``V`` volumes), containing the
+                     values at each voxel.
         """
 
-        log.debug('Loading atlas description from {}'.format(filename))
-
-        root   = et.parse(filename)
-        header = root.find('header')
-        data   = root.find('data')
+        if len(voxels) == 0:
+            return np.zeros([0] + list(self.shape[3:]), dtype=self.dtype)
 
-        if atlasID is None:
-            atlasID = op.splitext(op.basename(filename))[0].lower()
+        if self.nibImage.in_memory:
+            data   = self.nibImage.get_data()
+            offset = np.zeros(3, dtype=np.int64)
 
-        self.atlasID   = atlasID
-        self.specPath  = op.abspath(filename)
-        self.name      = header.find('name').text.strip()
-        self.atlasType = header.find('type').text.strip().lower()
+        else:
+            lo     = voxels.min(axis=0)
+            hi     = voxels.max(axis=0) + 1
+            data   = self[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+            offset = lo
 
-        # Spelling error in some of the atlas.xml files.
-        if self.atlasType == 'probabalistic':
-            self.atlasType = 'probabilistic'
+        voxels = voxels - offset
+        data   = data.reshape(data.shape[:3] + (-1, ))
+        data   = data[voxels[:, 0], voxels[:, 1], voxels[:, 2], :]
 
-        images             = header.findall('images')
-        self.images        = []
-        self.summaryImages = []
-        self.pixdims       = []
-        self.xforms        = []
+        if len(self.shape) == 3: return data[:, 0]
+        else:                    return data
 
-        atlasDir = op.dirname(self.specPath)
 
-        for image in images:
+    def sampleMask(self, boolmask, volumes=None, chunkSize=None):
+        """Returns the atlas values at all voxels within the given mask.
+        Used by the :meth:`.ProbabilisticAtlas.maskProportions` method.
 
-            # Every image must also have a summary image
-            imagefile        = image.find('imagefile')       .text.strip()
-            summaryimagefile = image.find('summaryimagefile').text.strip()
+        If the atlas data is not loaded into memory, only the bounding box
+        which contains the mask is read, in chunks of volumes.
 
-            # Assuming that the path
-            # names begin with a slash
-            imagefile        = op.normpath(atlasDir + imagefile)
-            summaryimagefile = op.normpath(atlasDir + summaryimagefile)
+        :arg boolmask:  A 3D boolean ``numpy`` array with the same shape as
+                        this atlas.
 
-            i = fslimage.Image(imagefile, loadData=False, calcRange=False)
+        :arg volumes:   Sequence of volume indices to sample, for a 4D atlas.
+                        Defaults to all volumes.
 
-            self.images       .append(imagefile)
-            self.summaryImages.append(summaryimagefile)
-            self.pixdims      .append(i.pixdim[:3])
-            self.xforms       .append(i.voxToWorldMat)
+        :arg chunkSize: Maximum number of bytes to read at a time. Defaults
+                        to :attr:`.ImageWrapper.DEFAULT_CHUNK_SIZE`.
 
-        labels      = data.findall('label')
-        self.labels = []
+        :returns:       A ``(N, )`` array (for a 3D atlas), or a ``(N, V)``
+                        array (for a 4D atlas), containing the values at the
+                        ``N`` voxels in the mask, in the order returned by
+                        ``numpy.where``.
+        """
 
-        # Refs to AtlasLabel objects
-        # indexed by their value.
-        # Used by the find method.
-        self.__labelsByValue = {}
+        if chunkSize is None:
+            chunkSize = imagewrapper.ImageWrapper.DEFAULT_CHUNK_SIZE
 
-        # The xyz coordinates for each label are in terms
-        # of the voxel space of the first images element
-        # in the header. For convenience, we're going to
-        # transform all of these voxel coordinates into
-        # MNI152 space coordinates.
-        coords = np.zeros((len(labels), 3), dtype=np.float32)
+        is3D = len(self.shape) == 3
 
-        for i, label in enumerate(labels):
+        if volumes is None and not is3D: volumes = range(self.shape[3])
+        elif is3D:                       volumes = [0]
 
-            name  = label.text.strip()
-            index = int(  label.attrib['index'])
-            x     = float(label.attrib['x'])
-            y     = float(label.attrib['y'])
-            z     = float(label.attrib['z'])
+        volumes = np.asarray(volumes, dtype=np.int64)
+        nvox    = int(np.count_nonzero(boolmask))
+        block   = np.zeros((nvox, len(volumes)), dtype=self.dtype)
 
-            # For label images, the index field
-            # contains the region value
-            if self.atlasType == 'label':
-                value = index
-                index = i
+        if nvox == 0 or len(volumes) == 0:
+            pass
 
-            # For probablistic images, the index
-            # field specifies the volume in the
-            # 4D atlas corresponding to the region.
-            # It is assumed that the summary value
-            # for each region is index + 1
-            else:
-                value = index + 1
+        elif self.nibImage.in_memory:
+            data  = self.nibImage.get_data()
+            data  = data.reshape(data.shape[:3] + (-1, ))
+            block = data[boolmask][:, volumes]
 
-            al        = AtlasLabel(name, index, value, x, y, z)
-            coords[i] = (x, y, z)
+        else:
 
-            self.labels.append(al)
-            self.__labelsByValue[value] = al
+            # Restrict reads to the bounding
+            # box of the mask, and to the range
+            # of volumes that we need.
+            voxels   = np.array(np.where(boolmask)).T
+            lo       = voxels.min(axis=0)
+            hi       = voxels.max(axis=0) + 1
+            boxmask  = boolmask[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+            boxslc   = (slice(lo[0], hi[0]),
+                        slice(lo[1], hi[1]),
+                        slice(lo[2], hi[2]))
+            vlo      = volumes.min()
+            vhi      = volumes.max() + 1
+            chunks   = imagewrapper.calcVolumeChunks(
+                tuple(hi - lo) + (vhi - vlo, ),
+                3,
+                self.dtype.itemsize,
+                chunkSize)
+
+            for clo, chi in chunks:
+
+                clo  += vlo
+                chi  += vlo
+                which = np.where((volumes >= clo) & (volumes < chi))[0]
+
+                if len(which) == 0:
+                    continue
 
-        # Load the appropriate transformation matrix
-        # and transform all those voxel coordinates
-        # into world coordinates
-        coords = transform.transform(coords, self.xforms[0])
+                if is3D: data = self[boxslc][..., np.newaxis]
+                else:    data = self[boxslc + (slice(clo, chi), )]
 
-        # Update the coordinates
-        # in our label objects
-        for i, label in enumerate(self.labels):
-            label.x, label.y, label.z = coords[i]
+                block[:, which] = data[boxmask][:, volumes[which] - clo]
 
-        # Make sure the labels are sorted by index
-        self.labels = list(sorted(self.labels))
+        if is3D: return block[:, 0]
+        else:    return block
 
 
-    def find(self, index=None, value=None):
-        """Find an :class:`.AtlasLabel` either by ``index``, or by ``value``.
+    def sampleLabels(self, voxels):
+        """Returns the label value at each of the given voxels. Used by
+        :meth:`labelImage`. Must be implemented by sub-classes.
 
-        Exactly one of ``index`` or ``value`` may be specified - a
-        ``ValueError`` is raised otherwise. If an invalid ``index`` or
-        ``value`` is specified, an ``IndexError`` or ``KeyError`` will be
-        raised.
+        :arg voxels: A ``(N, 3)`` array of in-bounds voxel coordinates.
 
-        .. note:: A 4D ``ProbabilisticAtlas`` may have more volumes than
-                  labels, and a 3D ``LabelAtlas`` may have more values
-                  than labels.
+        :returns:    A ``(N, )`` array containing the label value at each
+                     voxel, or ``0`` for voxels which are not in any region.
         """
-        if (index is     None and value is     None) or \
-           (index is not None and value is not None):
-            raise ValueError('Only one of index or value may be specified')
+        raise NotImplementedError()
 
-        if index is not None: return self.labels[         index]
-        else:                 return self.__labelsByValue[int(value)]
 
+    def labelImage(self, image, threshold=None, volume=0, chunkSize=None):
+        """Labels every voxel of the given ``image`` according to this atlas.
+        The ``image`` may be in any space - each of its voxels is mapped into
+        the atlas voxel space via the image and atlas affines, and labelled
+        with the atlas region at the nearest atlas voxel.
 
-    def __eq__(self, other):
-        """Compares the ``atlasID`` of this ``AtlasDescription`` with another.
-        """
-        return self.atlasID == other.atlasID
+        The ``image`` is processed in slabs of slices, so that only the
+        returned label array, and one slab of data and coordinates, are held
+        in memory at any one time.
 
+        :arg image:     An :class:`.Image`, which is assumed to be in the same
+                        world coordinate system as the atlas (typically
+                        MNI152 space).
 
-    def __neq__(self, other):
-        """Compares the ``atlasID`` of this ``AtlasDescription`` with another.
-        """
-        return self.atlasID != other.atlasID
+        :arg threshold: If provided, only voxels with a value greater than
+                        ``threshold`` are labelled.
 
+        :arg volume:    Volume of ``image`` to use, if it is 4D.
 
-    def __lt__(self, other):
-        """Compares this ``AtlasDescription`` with another by their ``name``
-        attribute.
-        """
-        return self.name.lower() < other.name.lower()
+        :arg chunkSize: Approximate maximum number of bytes of voxel
+                        coordinates and atlas data to process at a time.
+                        Defaults to :attr:`.ImageWrapper.DEFAULT_CHUNK_SIZE`.
+                        A slab always contains at least one slice.
 
+        :returns:       A tuple containing:
 
-class Atlas(fslimage.Image):
-    """This is the base class for the :class:`LabelAtlas` and
-    :class:`ProbabilisticAtlas` classes. It contains some initialisation
-    logic common to both.
-    """
-
-
-    def __init__(self,
-                 atlasDesc,
-                 resolution=None,
-                 isLabel=False,
-                 **kwargs):
-        """Initialise an ``Atlas``.
-
-        :arg atlasDesc:  The :class:`AtlasDescription` instance which
-                         describes the atlas.
-
-        :arg resolution: Desired isotropic resolution in millimetres.
+                          - An integer array with the same shape as the
+                            first three dimensions of ``image``, containing
+                            the label value of each voxel, or ``0`` for
+                            voxels which are below the threshold, outside of
+                            the atlas, or not in any region.
 
-        :arg isLabel:    Pass in ``True`` for label atlases, ``False`` for
-                         probabilistic atlases.
+                          - A ``(L, )`` array containing the number of
+                            labelled voxels in each of the ``L`` regions,
+                            in the order that they are listed in the atlas
+                            description.
 
-        All other arguments are passed to :meth:`.Image.__init__`.
+        .. note:: Use the :meth:`find` method to retrieve the ``AtlasLabel``
+                  associated with each label value.
         """
 
-        # Get the index of the atlas with the
-        # nearest resolution to that provided.
-        # If a reslution has not been provided,
-        # choose the atlas image with the
-        # highest resolution.
-        #
-        # We divide by three to get the atlas
-        # image index because there are three
-        # pixdim values for each atlas.
-        res   = resolution
-        reses = np.concatenate(atlasDesc.pixdims)
-
-        if resolution is None: imageIdx = np.argmin(reses)
-        else:                  imageIdx = np.argmin(np.abs(reses - res))
-
-        imageIdx = imageIdx // 3
-
-        if isLabel: imageFile = atlasDesc.summaryImages[imageIdx]
-        else:       imageFile = atlasDesc.images[       imageIdx]
-
-        fslimage.Image.__init__(self, imageFile, **kwargs)
-
-        # Even though all the FSL atlases
-        # are in MNI152 space, not all of
-        # their sform_codes are correctly set
-        self.nibImage.header.set_sform(
-            None, code=constants.NIFTI_XFORM_MNI_152)
-
-        self.desc = atlasDesc
-
+        if chunkSize is None:
+            chunkSize = imagewrapper.ImageWrapper.DEFAULT_CHUNK_SIZE
+
+        shape  = image.shape[:3]
+        labels = np.zeros(shape, dtype=np.int32)
+        counts = np.zeros(len(self.desc.labels), dtype=np.int64)
+        cols   = {l.value : i for i, l in enumerate(self.desc.labels)}
+
+        # Affine from image voxels to atlas
+        # voxels, via world coordinates
+        xform = transform.concat(self.worldToVoxMat, image.voxToWorldMat)
+
+        # Each slab contains as many slices as
+        # possible, with three float64 voxel
+        # coordinates per image voxel, and the
+        # atlas values for every atlas volume
+        # at each image voxel. If the image has
+        # a lower resolution than the atlas,
+        # the atlas bounding box that is read
+        # for a slab covers proportionally
+        # more atlas voxels.
+        nvols    = int(np.prod(self.shape[3:]))
+        ratio    = np.prod(image.pixdim[:3]) / np.prod(self.pixdim[:3])
+        itemsize = 24 + int(np.ceil(self.dtype.itemsize * nvols *
+                                    max(1, ratio)))
+        slabs    = imagewrapper.calcVolumeChunks(shape, 2, itemsize, chunkSize)
+
+        for zlo, zhi in slabs:
+
+            if len(image.shape) > 3:
+                data = image[:, :, zlo:zhi, volume]
+            else:
+                data = image[:, :, zlo:zhi]
 
-    def find(self, *args, **kwargs):
-        """Find an ``AtlasLabel`` - see the :meth:`AtlasDescription.find`
-        method.
-        """
-        return self.desc.find(*args, **kwargs)
+            data = data.reshape(shape[:2] + (zhi - zlo, ))
 
+            if threshold is None: slabmask = np.ones(data.shape, dtype=bool)
+            else:                 slabmask = data > threshold
 
-    def prepareMask(self, mask):
-        """Makes sure that the given mask has the same resolution as this
-        atlas, so it can be used for querying. Used by the
-        :meth:`.LabelAtlas.maskLabels` and
-        :meth:`.ProbabilisticAtlas.maskProportions` methods.
+            imgvoxels = np.array(np.where(slabmask)).T
 
-        :arg mask: A :class:`.Image`
+            if len(imgvoxels) == 0:
+                continue
 
-        :returns:  A ``numpy`` array containing the resampled mask data.
+            imgvoxels[:, 2] += zlo
+            coords           = transform.transform(imgvoxels, xform)
+            voxels, inBounds = self.prepareCoords(coords, voxel=True)
+            imgvoxels        = imgvoxels[inBounds]
 
-        :raises:   A :exc:`MaskError` if the mask is not in the same space as
-                   this atlas, or does not have three dimensions.
-        """
+            if len(imgvoxels) == 0:
+                continue
 
-        # Make sure that the mask has the same
-        # number of voxels as the atlas image.
-        # Use nearest neighbour interpolation
-        # for resampling, as it is most likely
-        # that the mask is binary.
-        try:
-            mask, xform = mask.resample(self.shape[:3],
-                                        dtype=np.float32,
-                                        order=0)
+            vals = self.sampleLabels(voxels[inBounds])
 
-        except ValueError:
-            raise MaskError('Mask has wrong number of dimensions')
+            labels[imgvoxels[:, 0], imgvoxels[:, 1], imgvoxels[:, 2]] = vals
 
-        # TODO allow non-aligned mask - as long as it overlaps
-        #      in world coordinates, it should be allowed
-        if not fslimage.Image(mask, xform=xform).sameSpace(self):
-            raise MaskError('Mask is not in the same space as atlas')
+            # Count voxels in each region
+            # that this atlas is aware of
+            gotValues, valcounts = np.unique(vals, return_counts=True)
 
-        return mask
+            for value, count in zip(gotValues, valcounts):
+                col = cols.get(int(value), None)
+                if col is not None:
+                    counts[col] += count
 
+        return labels, counts
 
 
 class MaskError(Exception):
@@ -796,6 +658,37 @@ class LabelAtlas(Atlas):
         return self[loc[0], loc[1], loc[2]]
 
 
+    def coordLabels(self, coords, voxel=False):
+        """Looks up and returns the labels at the given locations. This is
+        equivalent to calling :meth:`coordLabel` for each coordinate, but
+        is much faster for a large number of coordinates.
+
+        :arg coords: A ``(N, 3)`` array of atlas coordinates.
+
+        :arg voxel:  Defaults to ``False``. If ``True``, the ``coords``
+                     are interpreted as voxel coordinates.
+
+        :returns:    A ``(N, )`` floating point array containing the label
+                     at each coordinate, with ``np.nan`` for coordinates
+                     which are out of bounds.
+        """
+
+        voxels, inBounds = self.prepareCoords(coords, voxel)
+        labels           = np.full(len(voxels), np.nan)
+        labels[inBounds] = self.sampleVoxels(voxels[inBounds])
+
+        return labels
+
+
+    def sampleLabels(self, voxels):
+        """Overrides :meth:`Atlas.sampleLabels`. Returns the atlas values at
+        the given voxels.
+        """
+        vals = self.sampleVoxels(voxels)
+        vals[~np.isfinite(vals)] = 0
+        return np.round(vals).astype(np.int32)
+
+
     def maskLabel(self, mask):
         """Looks up and returns the proportions of all regions that are present
         in the given ``mask``.
@@ -825,31 +718,123 @@ class LabelAtlas(Atlas):
         vals      = self[boolmask]
         weights   = mask[boolmask]
         weightsum = weights.sum()
-        gotValues = np.unique(vals)
-        values    = []
-        props     = []
+
+        # Sum the mask weights for every
+        # unique value in a single pass,
+        # rather than testing the masked
+        # values against each label in turn.
+        gotValues, inverse = np.unique(vals, return_inverse=True)
+        valsums            = np.bincount(inverse.ravel(),
+                                         weights=weights,
+                                         minlength=len(gotValues))
+        found              = []
 
         # Only consider labels that
         # this atlas is aware of
-        for label in self.desc.labels:
-            if label.value in gotValues:
-
-                # Figure out the number of all voxels
-                # in the mask with this value, weighted
-                # by the mask.
-                prop = weights[vals == label.value].sum()
-
-                # Normalise it to be a proportion
-                # of all voxels in the mask. We
-                # multiply by 100 because the FSL
-                # probabilistic atlases store their
-                # probabilities as percentages.
-                values.append(label.value)
-                props .append(100 * prop / weightsum)
+        for value, prop in zip(gotValues, valsums):
+
+            if not np.isfinite(value) or value != int(value):
+                continue
+
+            try:               label = self.find(value=int(value))
+            except KeyError:   continue
+
+            found.append((label, prop))
+
+        # Return the values in the same
+        # order as they are listed in
+        # the atlas description
+        found  = sorted(found, key=lambda lp: lp[0].index)
+        values = []
+        props  = []
+
+        for label, prop in found:
+
+            # Normalise the summed weights to be
+            # a proportion of all voxels in the
+            # mask. We multiply by 100 because the
+            # FSL probabilistic atlases store their
+            # probabilities as percentages.
+            values.append(label.value)
+            props .append(100 * prop / weightsum)
 
         return values, props
 
 
+    def maskProportionMatrix(self, masks):
+        """Looks up the proportions of all regions in each of the given
+        ``masks``. This is equivalent to calling :meth:`maskLabel` for each
+        mask, but is much faster for a large number of masks.
+
+        :arg masks: A sequence of 3D :class:`.Image` objects, or a 4D
+                    :class:`.Image`, which are interpreted as weighted masks.
+                    See :meth:`Atlas.prepareMasks`.
+
+        :returns:   A ``(M, L)`` array containing the proportion, within each
+                    of the ``M`` masks, of each of the ``L`` labels, in the
+                    order that they are listed in the atlas description.
+                    The proportions are returned as values between 0 and
+                    100.
+        """
+
+        nmasks = masks.shape[3] if isinstance(masks, fslimage.Image) \
+                 else len(masks)
+        props  = np.zeros((nmasks, len(self.desc.labels)), dtype=np.float64)
+        cols   = {l.value : i for i, l in enumerate(self.desc.labels)}
+
+        for idxs, data in self.prepareMasks(masks):
+
+            # Weights of all masks at every voxel
+            # which is in at least one of them
+            boolmask  = np.any(data > 0, axis=-1)
+            weights   = data[boolmask].astype(np.float64)
+            weights[weights < 0] = 0
+            weightsum = weights.sum(axis=0)
+            nonzero   = weightsum > 0
+
+            if not np.any(nonzero):
+                continue
+
+            # Map each atlas value to its
+            # column in the result, dropping
+            # values that this atlas is not
+            # aware of
+            vals               = self.sampleMask(boolmask)
+            gotValues, inverse = np.unique(vals, return_inverse=True)
+            valcols            = np.full(len(gotValues), -1, dtype=np.int64)
+
+            for i, value in enumerate(gotValues):
+                if np.isfinite(value) and value == int(value):
+                    valcols[i] = cols.get(int(value), -1)
+
+            vcols   = valcols[inverse.ravel()]
+            known   = vcols >= 0
+            vcols   = vcols[  known]
+            weights = weights[known]
+
+            if len(vcols) == 0:
+                continue
+
+            # Sum the weights for each column
+            # in a single pass, by sorting the
+            # voxels by column and reducing
+            # each run of equal columns
+            order   = np.argsort(vcols, kind='mergesort')
+            vcols   = vcols[  order]
+            weights = weights[order]
+            starts  = np.concatenate(([0], np.where(np.diff(vcols))[0] + 1))
+            sums    = np.add.reduceat(weights, starts, axis=0).T
+
+            sums[~nonzero]      = 0
+            weightsum[~nonzero] = 1
+
+            chunk                   = np.zeros((len(idxs), props.shape[1]))
+            chunk[:, vcols[starts]] = 100 * sums / weightsum[:, np.newaxis]
+            props[idxs]             = chunk
+
+        return props
+
+
 class ProbabilisticAtlas(Atlas):
     """A 4D atlas which contains one volume for each region.
 
@@ -857,16 +842,108 @@ class ProbabilisticAtlas(Atlas):
     which makes looking up region probabilities easy.
     """
 
-    def __init__(self, atlasDesc, resolution=None, **kwargs):
+    def __init__(self,
+                 atlasDesc,
+                 resolution=None,
+                 useSparse=False,
+                 **kwargs):
         """Create a ``ProbabilisticAtlas`` instance.
 
         :arg atlasDesc:  The :class:`AtlasDescription` instance describing
                          the atlas.
 
         :arg resolution: Desired isotropic resolution in millimetres.
+
+        :arg useSparse:  If ``True``, all queries are performed on a sparse
+                         ``(voxels, regions)`` copy of the atlas data (see
+                         :func:`loadSparseData`), rather than on the image
+                         data. The image data is then never loaded into
+                         memory, unless it is accessed directly, and the
+                         image data range is calculated from the sparse
+                         copy (see :meth:`dataRange`).
         """
+
+        if useSparse:
+            kwargs['loadData']  = False
+            kwargs['calcRange'] = False
+
+        self.__sparse      = None
+        self.__sparseRange = None
+
         Atlas.__init__(self, atlasDesc, resolution, False, **kwargs)
 
+        if useSparse:
+            self.__sparse = loadSparseData(self)
+
+
+    @property
+    def dataRange(self):
+        """Overrides :meth:`.Image.dataRange`. If this atlas has a sparse
+        copy of its data, the range is calculated from the sparse data on
+        first access, rather than from the image data.
+        """
+
+        if self.__sparse is None:
+            return Atlas.dataRange.fget(self)
+
+        if self.__sparseRange is None:
+
+            data    = self.__sparse.data
+            nvals   = self.__sparse.shape[0] * self.__sparse.shape[1]
+            drange  = []
+
+            if data.size > 0:
+                drange = [float(data.min()), float(data.max())]
+
+            # Values which are not stored
+            # in the sparse data are zero
+            if data.size < nvals:
+                drange.append(0.0)
+
+            self.__sparseRange = (min(drange), max(drange))
+
+        return self.__sparseRange
+
+
+    @property
+    def sparseData(self):
+        """Returns the sparse ``scipy.sparse.csr_matrix`` copy of the atlas
+        data, with one row per voxel (in C order), and one column per volume,
+        or ``None`` if this atlas was not created with ``useSparse=True``.
+        """
+        return self.__sparse
+
+
+    def sampleVoxels(self, voxels):
+        """Overrides :meth:`Atlas.sampleVoxels`. If this atlas has a sparse
+        copy of its data, only the rows for the given voxels are read from
+        it.
+        """
+
+        if self.__sparse is None:
+            return Atlas.sampleVoxels(self, voxels)
+
+        rows = np.ravel_multi_index(np.asarray(voxels).T, self.shape[:3])
+
+        return self.__sparse[rows].toarray()
+
+
+    def sampleMask(self, boolmask, volumes=None, chunkSize=None):
+        """Overrides :meth:`Atlas.sampleMask`. If this atlas has a sparse
+        copy of its data, only the rows for the voxels in the mask are read
+        from it.
+        """
+
+        if self.__sparse is None:
+            return Atlas.sampleMask(self, boolmask, volumes, chunkSize)
+
+        if volumes is None: volumes = slice(None)
+        else:               volumes = np.asarray(volumes, dtype=np.int64)
+
+        rows = np.flatnonzero(boolmask.ravel())
+
+        return self.__sparse[rows][:, volumes].toarray()
+
 
     def proportions(self, location, *args, **kwargs):
         """Looks up and returns the proportions of of all regions at the given
@@ -896,11 +973,32 @@ class ProbabilisticAtlas(Atlas):
             return self.coordProportions(location, *args, **kwargs)
 
 
+    def sampleLabels(self, voxels):
+        """Overrides :meth:`Atlas.sampleLabels`. Returns the value of the
+        most probable region at each of the given voxels, following the
+        summary image convention (the label ``index + 1``), or ``0`` for
+        voxels with a probability of zero for every region.
+        """
+
+        indices = [l.index for l in self.desc.labels]
+        values  = np.array([l.value for l in self.desc.labels],
+                           dtype=np.int32)
+        props   = self.sampleVoxels(voxels)[:, indices]
+        best    = np.argmax(props, axis=1)
+        labels  = values[best]
+
+        labels[props[np.arange(len(best)), best] <= 0] = 0
+
+        return labels
+
+
     def coordProportions(self, loc, voxel=False):
         """Looks up the region probabilities for the given location.
 
         :arg loc:   A sequence of three values, interpreted as atlas
-                    world or voxel coordinates.
+                    world or voxel coordinates. Alternately, a ``(N, 3)``
+                    array of coordinates may be provided, in which case all
+                    of the coordinates are looked up at once.
 
         :arg voxel: Defaults to ``False``. If ``True``, the ``loc``
                     argument is interpreted as voxel coordinates.
@@ -908,9 +1006,15 @@ class ProbabilisticAtlas(Atlas):
         :returns: a list of values, one per region, which represent
                   the probability of each region for the specified
                   location. Returns an empty list if the given
-                  location is out of bounds.
+                  location is out of bounds. If a ``(N, 3)`` array of
+                  coordinates is provided, a ``(N, L)`` array is returned,
+                  where ``L`` is the number of regions, with rows of
+                  ``np.nan`` for coordinates which are out of bounds.
         """
 
+        if np.asarray(loc).ndim == 2:
+            return self.__coordsProportions(loc, voxel)
+
         if not voxel:
             loc = transform.transform([loc], self.worldToVoxMat)[0]
             loc = [int(v) for v in loc.round()]
@@ -923,7 +1027,10 @@ class ProbabilisticAtlas(Atlas):
            loc[2] >= self.shape[2]:
             return []
 
-        props = self[loc[0], loc[1], loc[2], :]
+        if self.__sparse is not None:
+            props = self.sampleVoxels([loc])[0]
+        else:
+            props = self[loc[0], loc[1], loc[2], :]
 
         # We only return labels for this atlas -
         # the underlying image may have more
@@ -931,6 +1038,19 @@ class ProbabilisticAtlas(Atlas):
         return [props[l.index] for l in self.desc.labels]
 
 
+    def __coordsProportions(self, coords, voxel):
+        """Used by :meth:`coordProportions` to look up the region
+        probabilities at a set of coordinates.
+        """
+
+        voxels, inBounds = self.prepareCoords(coords, voxel)
+        indices          = [l.index for l in self.desc.labels]
+        props            = np.full((len(voxels), len(indices)), np.nan)
+        props[inBounds]  = self.sampleVoxels(voxels[inBounds])[:, indices]
+
+        return props
+
+
     def maskProportions(self, mask):
         """Looks up the probabilities of all regions in the given ``mask``.
 
@@ -945,8 +1065,6 @@ class ProbabilisticAtlas(Atlas):
                    values between 0 and 100.
         """
 
-        props = []
-
         mask      = self.prepareMask(mask)
         boolmask  = mask > 0
         weights   = mask[boolmask]
@@ -955,23 +1073,175 @@ class ProbabilisticAtlas(Atlas):
         if weightsum == 0:
             return [0.0] * len(self.desc.labels)
 
-        for label in self.desc.labels:
+        # Gather the atlas values for all
+        # voxels in the mask into a (voxels
+        # x regions) block, and calculate
+        # all of the weighted proportions
+        # with a single dot product.
+        indices = [l.index for l in self.desc.labels]
+        block   = self.sampleMask(boolmask, indices)
+        props   = np.dot(weights.astype(np.float64), block) / weightsum
+
+        return list(props)
 
-            vals  = self[..., label.index]
-            vals  = vals[boolmask] * weights
-            prop  = vals.sum() / weightsum
 
-            props.append(prop)
+    def maskProportionMatrix(self, masks):
+        """Looks up the probabilities of all regions in each of the given
+        ``masks``. This is equivalent to calling :meth:`maskProportions` for
+        each mask, but is much faster for a large number of masks.
+
+        :arg masks: A sequence of 3D :class:`.Image` objects, or a 4D
+                    :class:`.Image`, which are interpreted as weighted masks.
+                    See :meth:`Atlas.prepareMasks`.
+
+        :returns:   A ``(M, L)`` array containing the proportion, within each
+                    of the ``M`` masks, of each of the ``L`` regions in the
+                    atlas. The proportions are returned as values between 0
+                    and 100.
+        """
+
+        nmasks  = masks.shape[3] if isinstance(masks, fslimage.Image) \
+                  else len(masks)
+        indices = [l.index for l in self.desc.labels]
+        props   = np.zeros((nmasks, len(indices)), dtype=np.float64)
+
+        for idxs, data in self.prepareMasks(masks):
+
+            # The atlas values are read once for
+            # every voxel in any of the masks, and
+            # the proportions for all masks are
+            # calculated with one matrix product.
+            boolmask  = np.any(data > 0, axis=-1)
+            weights   = data[boolmask].astype(np.float64)
+            weights[weights < 0] = 0
+            weightsum = weights.sum(axis=0)
+            nonzero   = weightsum > 0
+
+            if not np.any(nonzero):
+                continue
+
+            block  = self.sampleMask(boolmask, indices)
+            chunk  = np.dot(weights.T, block)
+            chunk[~nonzero] = 0
+            weightsum[~nonzero] = 1
+
+            props[idxs] = chunk / weightsum[:, np.newaxis]
 
         return props
 
 
-registry            = AtlasRegistry()
-rescanAtlases       = registry.rescanAtlases
-listAtlases         = registry.listAtlases
-hasAtlas            = registry.hasAtlas
-getAtlasDescription = registry.getAtlasDescription
-loadAtlas           = registry.loadAtlas
-addAtlas            = registry.addAtlas
-removeAtlas         = registry.removeAtlas
-rescanAtlases       = registry.rescanAtlases
+def sparseCacheFile(filename):
+    """Returns the path to a file in which a sparse copy of the data in
+    the given atlas image file may be cached, or ``None`` if it cannot be
+    cached. Used by :func:`loadSparseData`.
+
+    Cache files are stored in the :mod:`.settings` directory, as the atlas
+    directory is usually not writeable - see :func:`.image.cacheFilePath`.
+    """
+    return fslimage.cacheFilePath(filename, 'atlas_sparse', '.npz')
+
+
+def loadSparseData(image, chunkSize=None):
+    """Loads a sparse copy of the data in the given 4D :class:`.Image`, from
+    the sparse cache if possible. If a cached copy does not exist, it is
+    created, and saved to the cache (see :func:`sparseCacheFile`).
+
+    :arg image:     A 4D :class:`.Image`.
+
+    :arg chunkSize: Maximum number of bytes of image data to read at a time
+                    when creating the sparse copy. Defaults to
+                    :attr:`.ImageWrapper.DEFAULT_CHUNK_SIZE`.
+
+    :returns:       A ``scipy.sparse.csr_matrix`` of shape ``(voxels,
+                    volumes)``, where voxels are in C order.
+    """
+
+    if chunkSize is None:
+        chunkSize = imagewrapper.ImageWrapper.DEFAULT_CHUNK_SIZE
+
+    shape     = image.shape
+    nvox      = int(np.prod(shape[:3]))
+    cacheFile = None
+
+    if image.dataSource is not None:
+        cacheFile = sparseCacheFile(image.dataSource)
+
+    if cacheFile is not None and op.exists(cacheFile):
+        try:
+            with np.load(cacheFile) as f:
+                arrays = (f['data'], f['indices'], f['indptr'])
+                data   = sparse.csr_matrix(arrays, shape=tuple(f['shape']))
+
+            if data.shape == (nvox, shape[3]):
+                log.debug('Loaded sparse atlas data from {}'.format(cacheFile))
+                return data
+
+        except Exception as e:
+            log.warning('Could not load sparse atlas data from {}: '
+                        '{}'.format(cacheFile, e))
+
+    # Build the sparse copy one
+    # chunk of volumes at a time
+    chunks = imagewrapper.calcVolumeChunks(shape,
+                                           3,
+                                           image.dtype.itemsize,
+                                           chunkSize)
+    blocks = []
+
+    for vlo, vhi in chunks:
+        block = image[:, :, :, vlo:vhi].reshape((nvox, vhi - vlo))
+        blocks.append(sparse.csr_matrix(block))
+
+    data = sparse.hstack(blocks, format='csr')
+
+    if cacheFile is None:
+        return data
+
+    cacheDir = op.dirname(cacheFile)
+    pathKey  = op.basename(cacheFile).split('_')[0]
+    tmpFile  = None
+
+    try:
+        if not op.exists(cacheDir):
+            os.makedirs(cacheDir)
+
+        # The cache is written to a temporary
+        # file, and then moved into place, so
+        # that a partially written cache file
+        # is never loaded. np.savez is given a
+        # file object, as it would otherwise
+        # add a .npz suffix to the file name.
+        fd, tmpFile = tempfile.mkstemp(
+            prefix='.{}.'.format(op.basename(cacheFile)),
+            dir=cacheDir)
+
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     data=data.data,
+                     indices=data.indices,
+                     indptr=data.indptr,
+                     shape=np.array(data.shape))
+
+        # os.replace is not available
+        # in python 2, but os.rename
+        # overwrites atomically on POSIX
+        getattr(os, 'replace', os.rename)(tmpFile, cacheFile)
+        tmpFile = None
+
+        # Clear out any cache files
+        # for old versions of the image
+        for f in os.listdir(cacheDir):
+            if f.startswith(pathKey) and f != op.basename(cacheFile):
+                os.remove(op.join(cacheDir, f))
+
+        log.debug('Saved sparse atlas data to {}'.format(cacheFile))
+
+    except Exception as e:
+        log.warning('Could not save sparse atlas data to {}: '
+                    '{}'.format(cacheFile, e))
+
+    finally:
+        if tmpFile is not None and op.exists(tmpFile):
+            os.remove(tmpFile)
+
+    return data
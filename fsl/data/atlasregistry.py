@@ -0,0 +1,1182 @@
+#!/usr/bin/env python
+#
+# atlasregistry.py - The AtlasRegistry and AtlasDescription classes.
+#
+# Author: Paul McCarthy <pauldmccarthy@gmail.com>
+#
+"""This module contains the :class:`AtlasRegistry`, :class:`AtlasDescription`
+and :class:`AtlasLabel` classes, which are used to find and describe the
+FSL atlases. Everything in this module is available via the :mod:`.atlases`
+module, which is where the atlas image classes are defined.
+
+This module does not import ``nibabel`` or ``scipy`` (the :mod:`.atlases`
+module is only imported when an atlas image is loaded), so it may be used by
+programs which only need to list or search the available atlases, such as
+``atlasq list``.
+
+A single :class:`.AtlasRegistry` instance is created when this module is
+first imported - it is available as a module level attribute called
+:attr:`registry`, and some of its methods are available as module-level
+functions:
+
+.. autosummary::
+   :nosignatures:
+
+   rescanAtlases
+   listAtlases
+   hasAtlas
+   getAtlasDescription
+   searchAtlases
+   loadAtlas
+   releaseAtlas
+   setAtlasCacheSize
+   atlasCacheStats
+   addAtlas
+   removeAtlas
+"""
+
+
+import xml.etree.ElementTree              as et
+import os.path                            as op
+import                                       os
+import                                       glob
+import                                       copy
+import                                       pickle
+import                                       bisect
+import                                       tempfile
+import                                       logging
+import                                       threading
+import                                       collections
+
+import numpy                              as np
+
+import fsl.data.imagepath                 as imagepath
+from   fsl.utils.platform import platform as platform
+import fsl.utils.transform                as transform
+import fsl.utils.notifier                 as notifier
+import fsl.utils.settings                 as fslsettings
+
+
+log = logging.getLogger(__name__)
+
+
+class AtlasRegistry(notifier.Notifier):
+    """The ``AtlasRegistry`` maintains a list of all known atlases.
+
+
+    When the :meth:`rescanAtlases` method is called, the ``AtlasRegistry``
+    loads all of the FSL XML atlas specification files in
+    ``$FSLDIR/data/atlases``, and builds a list of :class:`AtlasDescription`
+    instances, each of which contains information about one atlas.
+
+
+    The :meth:`addAtlas` method allows other atlases to be added to the
+    registry. Whenever a new atlas is added, the ``AtlasRegistry`` notifies
+    any registered listeners via the :class:`.Notifier` interface with the
+    topic ``'add'``, passing it the newly loaded class:`AtlasDecsription`.
+    Similarly, the :meth:`removeAtlas` method allows individual atlases to be
+    removed. When this occurs, registered listeners on the ``'remove'`` topic
+    are notified, and passed the ``AtlasDescription`` instance of the removed
+    atlas.
+
+
+    The ``AtlasRegistry`` stores a list of all known atlases via the
+    :mod:`.settings` module. When an ``AtlasRegistry`` is created, it loads
+    in any previously known atlases. Whenever a new atlas is added, this
+    list is updated. See the :meth:`__getKnownAtlases` and
+    :meth:`_saveKnownAtlases` methods.
+
+
+    The ``AtlasRegistry`` also caches the ``AtlasDescription`` instances
+    that it creates in the :mod:`.settings` directory, so that XML
+    specification files do not need to be parsed every time that
+    :meth:`rescanAtlases` is called. Each cached ``AtlasDescription`` is only
+    re-used if its XML file and image files have not changed since it was
+    cached. See the :meth:`__loadDescription` and :meth:`__loadDescCache`
+    methods.
+
+
+    *Atlas cache*
+
+
+    When the ``cache`` argument to :meth:`loadAtlas` is ``True``, the
+    ``AtlasRegistry`` keeps a least-recently-used cache of the
+    :class:`.Atlas` instances that it has loaded, keyed by the atlas ID, the
+    ``loadSummary`` and ``resolution`` arguments, and any other arguments
+    passed to :meth:`loadAtlas`. Subsequent requests for the same atlas are
+    served from the cache, rather than being re-loaded from disk. The
+    maximum size of the cache, in bytes, may be set with
+    :meth:`setAtlasCacheSize` - the least recently used atlases are dropped
+    from the cache when it exceeds this size. Cached atlases can be
+    explicitly released with :meth:`releaseAtlas`.
+    """
+
+
+    DEFAULT_ATLAS_CACHE_SIZE = 1024 * 1048576
+    """Default maximum size, in bytes, of the atlas cache. """
+
+
+    DESC_CACHE_FILE = 'atlas_registry.pkl'
+    """Name of the file, in the :mod:`.settings` directory, in which
+    ``AtlasDescription`` instances are cached.
+    """
+
+
+    DESC_CACHE_VERSION = 3
+    """Version of the ``AtlasDescription`` cache format. Cache files with a
+    different version are ignored. This must be incremented whenever the
+    ``AtlasDescription`` attributes change.
+    """
+
+
+    def __init__(self):
+        """Create an ``AtlasRegistry``. """
+
+        # A list of all AtlasDescription
+        # instances in existence, sorted
+        # by AtlasDescription.name.
+        self.__atlasDescs = []
+
+        # The same AtlasDescription instances,
+        # indexed by atlasID, and by lower-case
+        # name and ID ({name : [desc, ...]}).
+        self.__descsByID      = {}
+        self.__descsByName    = {}
+        self.__descsByLowerID = {}
+
+        # Substring index used by
+        # searchAtlases - created
+        # on demand by __searchIndex.
+        self.__suffixes = None
+
+        # Cached AtlasDescription instances,
+        # stored as {specPath : (stamp, desc)}
+        # mappings - see __loadDescription.
+        # The cache is only saved if it has
+        # been changed since it was loaded.
+        self.__descCache      = None
+        self.__descCacheDirty = False
+
+        # Loaded Atlas instances, stored as
+        # {key : (atlas, nbytes)} mappings,
+        # in least to most recently used
+        # order - see loadAtlas.
+        self.__atlasCache      = collections.OrderedDict()
+        self.__atlasCacheSize  = AtlasRegistry.DEFAULT_ATLAS_CACHE_SIZE
+        self.__atlasCacheBytes = 0
+        self.__atlasCacheLock  = threading.Lock()
+
+
+    def rescanAtlases(self):
+        """Causes the ``AtlasRegistry`` to rescan available atlases from
+        ``$FSLDIR``. Atlases are loaded from the ``fsl.data.atlases`` setting
+        (via the :mod:`.settings` module), and from ``$FSLDIR/data/atlases/``.
+
+        The atlas cache (see :meth:`loadAtlas`) is cleared, as the cached
+        atlases may refer to descriptions which have changed, or which are
+        no longer available.
+        """
+
+        log.debug('Initialising atlas registry')
+        self.releaseAtlas()
+        self.__atlasDescs     = []
+        self.__descsByID      = {}
+        self.__descsByName    = {}
+        self.__descsByLowerID = {}
+        self.__suffixes       = None
+        self.__descCache      = self.__loadDescCache()
+        self.__descCacheDirty = False
+
+        # Get $FSLDIR atlases
+        fslPaths = []
+        if platform.fsldir is not None:
+            fsldir   = op.join(platform.fsldir, 'data', 'atlases')
+            fslPaths = sorted(glob.glob(op.join(fsldir, '*.xml')))
+
+        # Any extra atlases that have
+        # been loaded in the past
+        extraIDs, extraPaths = self.__getKnownAtlases()
+
+        # FSLDIR atlases first, any
+        # other atlases second.
+        atlasPaths = list(fslPaths)         + extraPaths
+        atlasIDs   = [None] * len(fslPaths) + extraIDs
+
+        with self.skipAll():
+            for atlasID, atlasPath in zip(atlasIDs, atlasPaths):
+
+                # The FSLDIR atlases are probably
+                # listed twice - from the above glob,
+                # and from the saved extraPaths. So
+                # we remove any duplicates.
+                if atlasID is not None and self.hasAtlas(atlasID):
+                    continue
+
+                try:
+                    self.addAtlas(atlasPath, atlasID, save=False)
+                except Exception:
+                    log.warning('Failed to load atlas '
+                                'specification {}'.format(atlasPath),
+                                exc_info=True)
+
+        self.__saveDescCache()
+
+
+    def listAtlases(self):
+        """Returns a list containing :class:`AtlasDescription` objects for
+        all available atlases. The atlases are ordered in terms of the
+        ``AtlasDescription.name`` attribute (converted to lower case).
+        """
+        return list(self.__atlasDescs)
+
+
+    def hasAtlas(self, atlasID):
+        """Returns ``True`` if this ``AtlasRegistry`` has an atlas with the
+        specified ``atlasID``.
+        """
+        return atlasID in self.__descsByID
+
+
+    def getAtlasDescription(self, atlasID):
+        """Returns an :class:`AtlasDescription` instance describing the
+        atlas with the given ``atlasID``.
+        """
+
+        try:
+            return self.__descsByID[atlasID]
+        except KeyError:
+            raise KeyError('Unknown atlas ID: {}'.format(atlasID))
+
+
+    def searchAtlases(self, text, exact=False):
+        """Searches for atlases with a name or ID which matches the given
+        ``text``. The search is case-insensitive.
+
+        :arg text:  Text to search for.
+
+        :arg exact: If ``True``, only atlases with a name or ID equal to
+                    ``text`` are returned. Otherwise (the default), atlases
+                    with a name or ID which contains ``text`` are returned.
+
+        :returns:   A tuple containing:
+
+                      - A list of :class:`AtlasDescription` objects for
+                        atlases with a matching name
+                      - A list of :class:`AtlasDescription` objects for
+                        atlases with a matching ID
+
+                    Both lists are ordered in the same way as
+                    :meth:`listAtlases`.
+        """
+
+        text = text.lower()
+
+        if exact:
+            nameMatches = list(self.__descsByName  .get(text, []))
+            idMatches   = list(self.__descsByLowerID.get(text, []))
+            return nameMatches, idMatches
+
+        # Every substring of a name or ID is a
+        # prefix of one of its suffixes, so we
+        # can find all matches with a binary
+        # search over the sorted suffixes.
+        suffixes = self.__searchIndex()
+        start    = bisect.bisect_left(suffixes, (text, ))
+        nameIDs  = set()
+        idIDs    = set()
+
+        for suffix, isName, atlasID in suffixes[start:]:
+            if not suffix.startswith(text):
+                break
+
+            if isName: nameIDs.add(atlasID)
+            else:      idIDs  .add(atlasID)
+
+        nameMatches = [d for d in self.__atlasDescs if d.atlasID in nameIDs]
+        idMatches   = [d for d in self.__atlasDescs if d.atlasID in idIDs]
+
+        return nameMatches, idMatches
+
+
+    def loadAtlas(self,
+                  atlasID,
+                  loadSummary=False,
+                  resolution=None,
+                  cache=False,
+                  **kwargs):
+        """Loads and returns an :class:`.Atlas` instance for the atlas
+        with the given  ``atlasID``.
+
+        :arg loadSummary: If ``True``, a 3D :class:`.LabelAtlas` image is
+                          loaded. Otherwise, if the atlas is probabilistic,
+                          a 4D :class:`.ProbabilisticAtlas` image is loaded.
+
+        :arg resolution: Optional. Desired isotropic atlas resolution in
+                         millimetres, e.g. ``1.0`` or ``2.0``. The available
+                         atlas with the nearest resolution to this value
+                         will be returned. If not provided, the highest
+                         resolution atlas will be loaded.
+
+        :arg cache:      If ``True``, a previously loaded atlas is returned
+                         from the atlas cache if possible, and a newly
+                         loaded atlas is added to the cache. Cached atlases
+                         are shared, so must not be modified.
+
+        All other arguments are passed through to the :class:`.Atlas`
+        sub-class.
+        """
+
+        # The atlases module is imported here,
+        # rather than at the top of this module,
+        # because it depends on nibabel/scipy.
+        import fsl.data.atlases as fslatlases
+
+        atlasDesc = self.getAtlasDescription(atlasID)
+
+        # label atlases are only
+        # available in 'summary' form
+        if atlasDesc.atlasType == 'label':
+            loadSummary = True
+
+        if loadSummary: atype = fslatlases.LabelAtlas
+        else:           atype = fslatlases.ProbabilisticAtlas
+
+        if not cache:
+            return atype(atlasDesc, resolution, **kwargs)
+
+        key = (atlasID, loadSummary, resolution,
+               tuple(sorted(kwargs.items())))
+
+        # Atlases loaded with unhashable
+        # arguments are not cached
+        try:
+            hash(key)
+        except TypeError:
+            return atype(atlasDesc, resolution, **kwargs)
+
+        with self.__atlasCacheLock:
+            cached = self.__atlasCache.pop(key, None)
+            if cached is not None:
+                self.__atlasCache[key] = cached
+                return cached[0]
+
+        atlas = atype(atlasDesc, resolution, **kwargs)
+
+        with self.__atlasCacheLock:
+            self.__cacheAtlas(key, atlas)
+
+        return atlas
+
+
+    def releaseAtlas(self, atlasID=None):
+        """Removes all cached atlases with the given ``atlasID`` from the
+        atlas cache (see :meth:`loadAtlas`). If ``atlasID`` is ``None``,
+        the atlas cache is cleared.
+        """
+
+        with self.__atlasCacheLock:
+            for key in list(self.__atlasCache.keys()):
+                if atlasID is None or key[0] == atlasID:
+                    _, nbytes = self.__atlasCache.pop(key)
+                    self.__atlasCacheBytes -= nbytes
+
+
+    def setAtlasCacheSize(self, nbytes):
+        """Sets the maximum size, in bytes, of the atlas cache (see
+        :meth:`loadAtlas`). Least recently used atlases are dropped from the
+        cache if it is larger than the new size.
+        """
+
+        with self.__atlasCacheLock:
+            self.__atlasCacheSize = nbytes
+            self.__trimAtlasCache()
+
+
+    def atlasCacheStats(self):
+        """Returns a tuple containing the number of atlases, and the number of
+        bytes, currently in the atlas cache.
+        """
+        with self.__atlasCacheLock:
+            return len(self.__atlasCache), self.__atlasCacheBytes
+
+
+    def __cacheAtlas(self, key, atlas):
+        """Used by :meth:`loadAtlas`. Adds the given atlas to the atlas cache,
+        and drops least recently used atlases if the cache has grown too
+        large. Must be called with the cache lock held.
+        """
+
+        nbytes = atlasSize(atlas)
+
+        # Another thread may have
+        # loaded the same atlas
+        old = self.__atlasCache.pop(key, None)
+        if old is not None:
+            self.__atlasCacheBytes -= old[1]
+
+        if nbytes > self.__atlasCacheSize:
+            return
+
+        self.__atlasCache[key]  = (atlas, nbytes)
+        self.__atlasCacheBytes += nbytes
+        self.__trimAtlasCache()
+
+
+    def __trimAtlasCache(self):
+        """Drops least recently used atlases from the atlas cache until it
+        is no larger than the maximum cache size. Must be called with the
+        cache lock held.
+        """
+        while self.__atlasCacheBytes > self.__atlasCacheSize:
+            _, (_, nbytes) = self.__atlasCache.popitem(last=False)
+            self.__atlasCacheBytes -= nbytes
+
+
+    def addAtlas(self, filename, atlasID=None, save=True):
+        """Add an atlas from the given XML specification file to the registry.
+
+        :arg filename: Path to a FSL XML atlas specification file.
+
+        :arg atlasID:  ID to give this atlas. If not provided, the file
+                       base name (converted to lower-case) is used. If an
+                       atlas with the given ID already exists, this new atlas
+                       is given a unique id.
+
+        :arg save:     If ``True`` (the default), this atlas will be saved
+                       so that it will be available in future instantiations.
+        """
+
+        filename = op.abspath(filename)
+
+        if atlasID is None:
+            atlasIDBase = op.splitext(op.basename(filename))[0].lower()
+            atlasID     = atlasIDBase
+        else:
+            atlasIDBase = atlasID
+
+        # If an atlas with the same ID/path
+        # already exists, raise an error
+        if self.hasAtlas(atlasID):
+            raise KeyError('An atlas with ID "{}" already '
+                           'exists'.format(atlasID))
+
+        desc = self.__loadDescription(filename, atlasID)
+
+        log.debug('Adding atlas to registry: {} / {}'.format(
+            desc.atlasID,
+            desc.specPath))
+
+        bisect.insort_left(self.__atlasDescs, desc)
+
+        self.__descsByID[desc.atlasID] = desc
+        self.__suffixes                = None
+
+        for index, key in ((self.__descsByName,    desc.name   .lower()),
+                           (self.__descsByLowerID, desc.atlasID.lower())):
+            bisect.insort_left(index.setdefault(key, []), desc)
+
+        if save:
+            self.__saveKnownAtlases()
+            self.__saveDescCache()
+
+        self.notify(topic='add', value=desc)
+
+        return desc
+
+
+    def removeAtlas(self, atlasID):
+        """Removes the atlas with the specified ``atlasID`` from this
+        ``AtlasRegistry``.
+        """
+
+        remove = self.__descsByID.pop(atlasID, None)
+
+        if remove is not None:
+
+            log.debug('Removing atlas from registry: {} / {}'.format(
+                remove.atlasID,
+                remove.specPath))
+
+            self.releaseAtlas(atlasID)
+
+            # AtlasDescription equality
+            # is determined by atlasID
+            self.__atlasDescs.remove(remove)
+
+            name    = remove.name   .lower()
+            lowerID = remove.atlasID.lower()
+
+            for index, key in ((self.__descsByName,    name),
+                               (self.__descsByLowerID, lowerID)):
+                index[key].remove(remove)
+                if len(index[key]) == 0:
+                    index.pop(key)
+
+            self.__suffixes = None
+
+        self.__saveKnownAtlases()
+
+        if remove is not None:
+            self.notify(topic='remove', value=remove)
+
+
+    def __searchIndex(self):
+        """Used by :meth:`searchAtlases`. Returns a sorted list of
+        ``(suffix, isName, atlasID)`` tuples, containing every suffix of the
+        lower-case name and ID of every atlas. The list is created on the
+        first call after an atlas has been added or removed.
+        """
+
+        if self.__suffixes is not None:
+            return self.__suffixes
+
+        suffixes = []
+
+        for desc in self.__atlasDescs:
+            for isName, text in ((True,  desc.name   .lower()),
+                                 (False, desc.atlasID.lower())):
+                for i in range(len(text)):
+                    suffixes.append((text[i:], isName, desc.atlasID))
+
+        self.__suffixes = sorted(suffixes)
+
+        return self.__suffixes
+
+
+    def __loadDescription(self, filename, atlasID):
+        """Creates and returns an :class:`AtlasDescription` for the given XML
+        specification file, or returns a cached one if the file, and the
+        atlas image files, have not changed since it was cached.
+        """
+
+        if self.__descCache is None:
+            self.__descCache = {}
+
+        cached = self.__descCache.get(filename, None)
+
+        if cached is not None:
+            stamp, desc = cached
+            if stamp == descStamp(desc):
+                log.debug('Using cached atlas description '
+                          'for {}'.format(filename))
+                desc         = copy.copy(desc)
+                desc.atlasID = atlasID
+                return desc
+
+        desc  = AtlasDescription(filename, atlasID)
+        stamp = descStamp(desc)
+
+        if stamp is not None:
+            self.__descCache[filename] = (stamp, desc)
+            self.__descCacheDirty      = True
+
+        return desc
+
+
+    def __loadDescCache(self):
+        """Loads and returns the cached ``AtlasDescription`` instances
+        from the :mod:`.settings` directory, Returns an empty ``dict`` if
+        there is no cache, or it cannot be loaded. See
+        :meth:`__loadDescription`.
+        """
+
+        cacheFile = fslsettings.filePath(AtlasRegistry.DESC_CACHE_FILE)
+
+        if cacheFile is None or not op.exists(cacheFile):
+            return {}
+
+        try:
+            with open(cacheFile, 'rb') as f:
+                version, cache = pickle.load(f)
+
+            if version == AtlasRegistry.DESC_CACHE_VERSION:
+                return cache
+            else:
+                return {}
+
+        except Exception as e:
+            log.warning('Could not load atlas description cache from '
+                        '{}: {}'.format(cacheFile, e))
+            return {}
+
+
+    def __saveDescCache(self):
+        """Saves the ``AtlasDescription`` instances for all atlases which are
+        currently in the registry to the :mod:`.settings` directory. See
+        :meth:`__loadDescription`.
+
+        Nothing is saved if the cache has not changed since it was loaded.
+        The cache is written to a temporary file, which is then renamed, so
+        that other processes never see a partially written cache file.
+        """
+
+        if self.__descCache is None:
+            return
+
+        cacheFile = fslsettings.filePath(AtlasRegistry.DESC_CACHE_FILE)
+
+        if cacheFile is None:
+            return
+
+        # Drop atlases which are no
+        # longer in the registry
+        paths = set([d.specPath for d in self.__atlasDescs])
+        cache = {p : c for p, c in self.__descCache.items() if p in paths}
+
+        if not self.__descCacheDirty and len(cache) == len(self.__descCache):
+            return
+
+        tmpFile = None
+
+        try:
+            cacheDir = op.dirname(cacheFile)
+            if not op.exists(cacheDir):
+                os.makedirs(cacheDir)
+
+            fd, tmpFile = tempfile.mkstemp(
+                prefix='.{}.'.format(op.basename(cacheFile)),
+                dir=cacheDir)
+
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((AtlasRegistry.DESC_CACHE_VERSION, cache),
+                            f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+            # os.replace is not available
+            # in python 2, but os.rename
+            # overwrites atomically on POSIX
+            getattr(os, 'replace', os.rename)(tmpFile, cacheFile)
+            tmpFile = None
+
+            self.__descCache      = cache
+            self.__descCacheDirty = False
+
+        except Exception as e:
+            log.warning('Could not save atlas description cache to '
+                        '{}: {}'.format(cacheFile, e))
+
+        finally:
+            if tmpFile is not None and op.exists(tmpFile):
+                os.remove(tmpFile)
+
+
+    def __getKnownAtlases(self):
+        """Returns a list of tuples containing the IDs and paths of all known
+        atlases .
+
+        The atlases are retrieved via the :mod:`.settings` module - a setting
+        with the name ``fsl.data.atlases`` is assumed to contain a string of
+        ``atlasID=specPath`` pairs, separated with the operating system file
+        path separator (``:`` on Unix/Linux).
+        See also :meth:`__saveKnownAtlases`.
+        """
+        try:
+            atlases = fslsettings.read('fsl.data.atlases')
+
+            if atlases is None: atlases = []
+            else:               atlases = atlases.split(op.pathsep)
+
+            atlases = [e.split('=') for e in atlases]
+            atlases = [(name.strip(), path.strip())
+                       for name, path in atlases
+                       if op.exists(path)]
+
+            names = [e[0] for e in atlases]
+            paths = [e[1] for e in atlases]
+
+            return names, paths
+
+        except Exception:
+            return [], []
+
+
+    def __saveKnownAtlases(self):
+        """Saves the IDs and paths of all atlases which are currently in
+        the registry. The atlases are saved via the :mod:`.settings` module.
+        """
+
+        if self.__atlasDescs is None:
+            return
+
+        atlases = []
+
+        for desc in self.__atlasDescs:
+            atlases.append((desc.atlasID, desc.specPath))
+
+        atlases = ['{}={}'.format(name, path) for name, path in atlases]
+        atlases = op.pathsep.join(atlases)
+
+        fslsettings.write('fsl.data.atlases', atlases)
+
+
+def atlasSize(atlas):
+    """Returns an estimate of the number of bytes of memory used by the
+    given :class:`.Atlas`. Used by the :class:`AtlasRegistry` atlas cache.
+    Atlases which are kept on disk are assumed to use no memory.
+    """
+
+    sparseData = getattr(atlas, 'sparseData', None)
+
+    if sparseData is not None:
+        return (sparseData.data   .nbytes +
+                sparseData.indices.nbytes +
+                sparseData.indptr .nbytes)
+
+    if atlas.nibImage.in_memory:
+        return int(np.prod(atlas.shape)) * atlas.dtype.itemsize
+
+    return 0
+
+
+def descStamp(desc):
+    """Returns a value which identifies the current state of the XML
+    specification file, and of all of the image files, for the given
+    :class:`AtlasDescription`, or ``None`` if any of those files cannot be
+    accessed. Used by the :class:`AtlasRegistry` to determine whether a
+    cached ``AtlasDescription`` can be re-used.
+    """
+
+    paths = [desc.specPath] + list(desc.images) + list(desc.summaryImages)
+    stamp = []
+
+    for i, path in enumerate(paths):
+
+        # Image file paths in atlas XML
+        # files do not usually have a suffix
+        try:
+            if i > 0: path = imagepath.addExt(path, mustExist=True)
+            stat = os.stat(path)
+        except Exception:
+            return None
+
+        stamp.append((path, stat.st_size, int(stat.st_mtime * 1000)))
+
+    return tuple(stamp)
+
+
+class AtlasLabel(object):
+    """The ``AtlasLabel`` class is used by the :class:`AtlasDescription` class
+    as a container object used for storing atlas label information.
+
+    An ``AtlasLabel`` instance contains the following attributes:
+
+    ========= ================================================================
+    ``name``  Region name
+    ``index`` The index of this label into the list of all labels in the
+              ``AtlasDescription`` that owns it. For probabilistic atlases,
+              this is also the index into the 4D atlas image of the volume
+              that corresponds to this region.
+    ``value`` For label atlases and summary images, the value of voxels that
+              are in this region.
+    ``x``     X coordinate of the region in world space
+    ``y``     Y coordinate of the region in world space
+    ``z``     Z coordinate of the region in world space
+    ========= ================================================================
+
+    .. note:: The ``x``, ``y`` and ``z`` label coordinates are pre-calculated
+              centre-of-gravity coordinates, as listed in the atlas xml file.
+              They are in the coordinate system defined by the transformation
+              matrix for the first image in the ``images`` list of the atlas
+              XML file (typically MNI152 space).
+    """
+
+    def __init__(self, name, index, value, x, y, z):
+        self.name  = name
+        self.index = index
+        self.value = value
+        self.x     = x
+        self.y     = y
+        self.z     = z
+
+
+    def __eq__(self, other):
+        """Compares the ``index`` of this ``AtlasLabel`` with another.
+        """
+        return self.index == other.index
+
+
+    def __neq__(self, other):
+        """Compares the ``index`` of this ``AtlasLabel`` with another.
+        """
+        return self.index != other.index
+
+
+    def __lt__(self, other):
+        """Compares this ``AtlasLabel`` with another by their ``index``
+        attribute.
+        """
+        return self.index < other.index
+
+
+class AtlasDescription(object):
+    """An ``AtlasDescription`` instance parses and stores the information
+    stored in the FSL XML file that describes a single FSL atlas.  An XML
+    atlas specification file is assumed to have a structure that looks like
+    the following:
+
+    .. code-block:: xml
+
+       <atlas>
+         <header>
+           <name></name>        # Atlas name
+           <type></type>        # 'Probabilistic' or 'Label'
+           <images>
+            <imagefile>
+            </imagefile>        # If type is Probabilistic, path
+                                # to 4D image file, one volume per
+                                # label, Otherwise, if type is
+                                # Label, path to 3D label file
+                                # (identical to the summaryimagefile
+                                # below). The path must be specified
+                                # as relative to the location of this
+                                # XML file.
+
+            <summaryimagefile>  # Path to 3D label summary file,
+            </summaryimagefile> # Every <image> must be accompanied
+                                # by a <summaryimage> - for label
+                                # atlases, they will typically refer
+                                # to the same image file.
+
+           </images>
+           ...                  # More images - generally both
+                                # 1mm and 2mm  versions (in
+                                # MNI152 space) are available
+         </header>
+        <data>
+
+         # index - For probabilistic atlases, index of corresponding volume in
+         #         4D image file. For label images, the value of voxels which
+         #         are in the corresponding region. For probabilistic atlases,
+         #         it is assumed that the value for each region in the  summary
+         #         image(s) are equal to ``index + 1``.
+         #
+         #
+         # x    |
+         # y    |- XYZ *voxel* coordinates into the first image of the <images>
+         #      |  list
+         # z    |
+         <label index="0" x="0" y="0" z="0">Name</label>
+         ...
+        </data>
+       </atlas>
+
+
+    Each ``AtlasDescription`` is assigned an identifier, which is simply the
+    XML file name describing the atlas, sans-suffix, and converted to lower
+    case.  For exmaple, the atlas described by:
+
+        ``$FSLDIR/data/atlases/HarvardOxford-Cortical.xml``
+
+    is given the identifier
+
+        ``harvardoxford-cortical``
+
+
+    This identifier is intended to be unique.
+
+
+    The following attributes are available on an ``AtlasDescription`` instance:
+
+    ================= ======================================================
+    ``atlasID``       The atlas ID, as described above.
+
+    ``name``          Name of the atlas.
+
+    ``specPath``      Path to the atlas XML specification file.
+
+    ``atlasType``     Atlas type - either *probabilistic* or *label*.
+
+    ``images``        A list of images available for this atlas - usually
+                      :math:`1mm^3` and :math:`2mm^3` images are present.
+
+    ``summaryImages`` For probabilistic atlases, a list of *summary* images,
+                      which are just 3D labelled variants of the atlas.
+
+    ``pixdims``       A list of ``(x, y, z)`` pixdim tuples in mm, one for
+                      each image in ``images``.
+
+    ``xforms``        A list of affine transformation matrices (as ``4*4``
+                      ``numpy`` arrays), one for each image in ``images``,
+                      defining the voxel to world coordinate transformations.
+
+    ``labels``        A list of :class`AtlasLabel` objects, describing each
+                      region / label in the atlas.
+    ================= ======================================================
+    """
+
+
+    def __init__(self, filename, atlasID=None):
+        """Create an ``AtlasDescription`` instance.
+
+        Only the ``<header>`` section of the XML file is parsed when an
+        ``AtlasDescription`` is created, and the atlas image files are
+        checked to exist. The atlas image headers are read, and the labels
+        are parsed, the first time that the ``pixdims`` or ``xforms``, or the
+        ``labels``, are accessed. If this fails, a warning is logged, and the
+        atlas is given no labels (or no pixdims/xforms), so that one
+        malformed atlas does not break code which uses other atlases.
+
+        :arg filename: Name of the XML file describing the atlas.
+
+        :arg atlasID:  ID to use for this atlas. If not provided, the file
+                       base name is used.
+        """
+
+        log.debug('Loading atlas description from {}'.format(filename))
+
+        # Stop parsing as soon as we
+        # reach the end of the header
+        header = None
+        with open(filename, 'rb') as f:
+            for event, elem in et.iterparse(f, events=('end', )):
+                if elem.tag == 'header':
+                    header = elem
+                    break
+
+        if header is None:
+            raise ValueError('Atlas specification {} does not '
+                             'contain a header'.format(filename))
+
+        if atlasID is None:
+            atlasID = op.splitext(op.basename(filename))[0].lower()
+
+        self.atlasID   = atlasID
+        self.specPath  = op.abspath(filename)
+        self.name      = header.find('name').text.strip()
+        self.atlasType = header.find('type').text.strip().lower()
+
+        # Spelling error in some of the atlas.xml files.
+        if self.atlasType == 'probabalistic':
+            self.atlasType = 'probabilistic'
+
+        images             = header.findall('images')
+        self.images        = []
+        self.summaryImages = []
+
+        atlasDir = op.dirname(self.specPath)
+
+        for image in images:
+
+            # Every image must also have a summary image
+            imagefile        = image.find('imagefile')       .text.strip()
+            summaryimagefile = image.find('summaryimagefile').text.strip()
+
+            # Assuming that the path
+            # names begin with a slash
+            imagefile        = op.normpath(atlasDir + imagefile)
+            summaryimagefile = op.normpath(atlasDir + summaryimagefile)
+
+            # Make sure that the image exists
+            # now, as it is not otherwise
+            # accessed until later on. A
+            # PathError is raised if not.
+            imagepath.addExt(imagefile, mustExist=True)
+
+            self.images       .append(imagefile)
+            self.summaryImages.append(summaryimagefile)
+
+        # These are loaded on demand -
+        # see the __loadImageHeaders
+        # and __loadLabels methods.
+        self.__pixdims       = None
+        self.__xforms        = None
+        self.__labels        = None
+        self.__labelsByValue = None
+
+
+    @property
+    def pixdims(self):
+        """A list of ``(x, y, z)`` pixdim tuples in mm, one for each image in
+        ``images``.
+        """
+        if self.__pixdims is None:
+            self.__loadImageHeaders()
+        return self.__pixdims
+
+
+    @property
+    def xforms(self):
+        """A list of affine transformation matrices, one for each image in
+        ``images``.
+        """
+        if self.__xforms is None:
+            self.__loadImageHeaders()
+        return self.__xforms
+
+
+    @property
+    def labels(self):
+        """A list of :class:`AtlasLabel` objects, describing each region /
+        label in the atlas.
+        """
+        if self.__labels is None:
+            self.__loadLabels()
+        return self.__labels
+
+
+    def __loadImageHeaders(self):
+        """Called on the first access of the :meth:`pixdims` or :meth:`xforms`
+        properties. Reads the header of each atlas image. If any header
+        cannot be read, a warning is logged, and the ``pixdims`` and
+        ``xforms`` are set to empty lists.
+        """
+
+        import fsl.data.image as fslimage
+
+        pixdims = []
+        xforms  = []
+
+        try:
+            for imagefile in self.images:
+                i = fslimage.Nifti(fslimage.readHeader(imagefile))
+                pixdims.append(i.pixdim[:3])
+                xforms .append(i.voxToWorldMat)
+
+        except Exception:
+            log.warning('Could not read image headers for '
+                        'atlas {}'.format(self.specPath), exc_info=True)
+            pixdims = []
+            xforms  = []
+
+        self.__pixdims = pixdims
+        self.__xforms  = xforms
+
+
+    def __loadLabels(self):
+        """Called on the first access of the :meth:`labels` property, or on
+        the first call to :meth:`find`. Parses the labels from the XML file
+        (see :meth:`__parseLabels`). If the labels cannot be parsed, a
+        warning is logged, and the atlas is given no labels.
+        """
+
+        try:
+            self.__parseLabels()
+
+        except Exception:
+            log.warning('Could not load labels for '
+                        'atlas {}'.format(self.specPath), exc_info=True)
+            self.__labels        = []
+            self.__labelsByValue = {}
+
+
+    def __parseLabels(self):
+        """Called by :meth:`__loadLabels`. Parses the labels from the XML
+        file.
+        """
+
+        log.debug('Loading atlas labels from {}'.format(self.specPath))
+
+        root      = et.parse(self.specPath)
+        labels    = root.find('data').findall('label')
+        allLabels = []
+
+        # Refs to AtlasLabel objects
+        # indexed by their value.
+        # Used by the find method.
+        labelsByValue = {}
+
+        # The xyz coordinates for each label are in terms
+        # of the voxel space of the first images element
+        # in the header. For convenience, we're going to
+        # transform all of these voxel coordinates into
+        # MNI152 space coordinates.
+        coords = np.zeros((len(labels), 3), dtype=np.float32)
+
+        for i, label in enumerate(labels):
+
+            name  = label.text.strip()
+            index = int(  label.attrib['index'])
+            x     = float(label.attrib['x'])
+            y     = float(label.attrib['y'])
+            z     = float(label.attrib['z'])
+
+            # For label images, the index field
+            # contains the region value
+            if self.atlasType == 'label':
+                value = index
+                index = i
+
+            # For probablistic images, the index
+            # field specifies the volume in the
+            # 4D atlas corresponding to the region.
+            # It is assumed that the summary value
+            # for each region is index + 1
+            else:
+                value = index + 1
+
+            al        = AtlasLabel(name, index, value, x, y, z)
+            coords[i] = (x, y, z)
+
+            allLabels.append(al)
+            labelsByValue[value] = al
+
+        # Load the appropriate transformation matrix
+        # and transform all those voxel coordinates
+        # into world coordinates
+        coords = transform.transform(coords, self.xforms[0])
+
+        # Update the coordinates
+        # in our label objects
+        for i, label in enumerate(allLabels):
+            label.x, label.y, label.z = coords[i]
+
+        # Make sure the labels are sorted by index
+        self.__labels        = list(sorted(allLabels))
+        self.__labelsByValue = labelsByValue
+
+
+    def find(self, index=None, value=None):
+        """Find an :class:`.AtlasLabel` either by ``index``, or by ``value``.
+
+        Exactly one of ``index`` or ``value`` may be specified - a
+        ``ValueError`` is raised otherwise. If an invalid ``index`` or
+        ``value`` is specified, an ``IndexError`` or ``KeyError`` will be
+        raised.
+
+        .. note:: A 4D ``ProbabilisticAtlas`` may have more volumes than
+                  labels, and a 3D ``LabelAtlas`` may have more values
+                  than labels.
+        """
+        if (index is     None and value is     None) or \
+           (index is not None and value is not None):
+            raise ValueError('Only one of index or value may be specified')
+
+        if self.__labels is None:
+            self.__loadLabels()
+
+        if index is not None: return self.labels[         index]
+        else:                 return self.__labelsByValue[int(value)]
+
+
+    def __eq__(self, other):
+        """Compares the ``atlasID`` of this ``AtlasDescription`` with another.
+        """
+        return self.atlasID == other.atlasID
+
+
+    def __neq__(self, other):
+        """Compares the ``atlasID`` of this ``AtlasDescription`` with another.
+        """
+        return self.atlasID != other.atlasID
+
+
+    def __lt__(self, other):
+        """Compares this ``AtlasDescription`` with another by their ``name``
+        attribute.
+        """
+        return self.name.lower() < other.name.lower()
+
+
+registry            = AtlasRegistry()
+rescanAtlases       = registry.rescanAtlases
+listAtlases         = registry.listAtlases
+hasAtlas            = registry.hasAtlas
+getAtlasDescription = registry.getAtlasDescription
+searchAtlases       = registry.searchAtlases
+loadAtlas           = registry.loadAtlas
+releaseAtlas        = registry.releaseAtlas
+setAtlasCacheSize   = registry.setAtlasCacheSize
+atlasCacheStats     = registry.atlasCacheStats
+addAtlas            = registry.addAtlas
+removeAtlas         = registry.removeAtlas
+rescanAtlases       = registry.rescanAtlases
@@ -361,9 +361,8 @@ def loadClusterResults(featdir, settings, contrast):
         # space, the cluster coordinates are in standard
         # space. We transform them to voxel coordinates.
         # later on.
-        coordXform = fslimage.Image(
-            getDataFile(featdir),
-            loadData=False).worldToVoxMat
+        coordXform = fslimage.Nifti(
+            fslimage.readHeader(getDataFile(featdir))).worldToVoxMat
 
         if not op.exists(clusterFile):
             return None
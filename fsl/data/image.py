@@ -16,6 +16,14 @@ It is very easy to load a NIFTI image::
     myimg = Image('MNI152_T1_2mm.nii.gz')
 
 
+If you only need information from the image header (e.g. the shape, voxel
+sizes, or affine), the :func:`readHeader` function is much faster, as it only
+reads the header bytes from the file::
+
+    from fsl.data.image import Nifti, readHeader
+    hdr = Nifti(readHeader('MNI152_T1_2mm.nii.gz'))
+
+
 A handful of other functions are also provided for working with image files
 and file names:
 
@@ -28,14 +36,23 @@ and file names:
    getExt
    removeExt
    defaultExt
+   readHeader
    loadIndexedImageFile
+   cacheFilePath
+   indexCacheFile
+   saveIndexCache
+   rebuildIndex
 """
 
 
 import                      os
 import os.path           as op
+import                      gzip
 import                      string
+import                      contextlib
+import                      hashlib
 import                      logging
+import                      tempfile
 
 import                      six
 import                      deprecation
@@ -47,9 +64,11 @@ import nibabel.fileslice as fileslice
 
 import fsl.utils.transform   as transform
 import fsl.utils.notifier    as notifier
+import fsl.utils.cache       as cache
 import fsl.utils.memoize     as memoize
-import fsl.utils.path        as fslpath
+import fsl.utils.settings    as fslsettings
 import fsl.data.constants    as constants
+import fsl.data.imagepath    as imagepath
 import fsl.data.imagewrapper as imagewrapper
 
 
@@ -721,6 +740,12 @@ class Image(Nifti):
     ``'dataRange'`` This topic is notified whenever the image data range
                     is changed/adjusted.
     =============== ======================================================
+
+
+    When many small edits are to be made to the image data (e.g. painting),
+    the :meth:`batchEdit` context manager may be used to coalesce the
+    notifications that would otherwise be emitted on every call to
+    :meth:`__setitem__`.
     """
 
 
@@ -733,6 +758,8 @@ class Image(Nifti):
                  calcRange=True,
                  indexed=False,
                  threaded=False,
+                 mmap=None,
+                 volumeCacheSize=0,
                  **kwargs):
         """Create an ``Image`` object with the given image data or file name.
 
@@ -774,12 +801,26 @@ class Image(Nifti):
         :arg indexed:   If ``True``, and the file is gzipped, it is opened
                         using the :mod:`indexed_gzip` package. Otherwise the
                         file is opened by ``nibabel``. Ignored if ``loadData``
-                        is ``True``.
+                        is ``True``. See :func:`loadIndexedImageFile` for
+                        details on how the seek point index is cached
+                        between sessions.
 
         :arg threaded:  If ``True``, the :class:`.ImageWrapper` will use a
                         separate thread for data range calculation. Defaults
                         to ``False``. Ignored if ``loadData`` is ``True``.
 
+        :arg mmap:      If ``True``, ``loadData`` is ``False``, and the file
+                        is not compressed, the :class:`.ImageWrapper` will
+                        access the image data through a read-only memory map,
+                        which avoids copying the data on every access. If
+                        provided, this argument is also passed through to the
+                        ``nibabel.load`` function.
+
+        :arg volumeCacheSize: Maximum size, in bytes, of the
+                        :class:`.ImageWrapper` volume cache, which is used to
+                        avoid repeatedly reading the same volumes from disk
+                        when ``loadData`` is ``False``. Disabled by default.
+
         All other arguments are passed through to the ``nibabel.load`` function
         (if it is called).
         """
@@ -788,9 +829,13 @@ class Image(Nifti):
         dataSource = None
         fileobj    = None
 
+        if mmap is not None:
+            kwargs['mmap'] = mmap
+
         if loadData:
             indexed  = False
             threaded = False
+            mmap     = False
 
         # Take a copy of the header if one has
         # been provided
@@ -895,12 +940,24 @@ class Image(Nifti):
         self.__dataSource        = dataSource
         self.__fileobj           = fileobj
         self.__threaded          = threaded
+        self.__volumeCacheSize   = volumeCacheSize
+
+        # Used by batchEdit - the batch nesting
+        # level, the bounding region of all edits
+        # made in the batch, and the data range
+        # at the start of the batch.
+        self.__batchLevel        = 0
+        self.__batchSlices       = None
+        self.__batchRange        = None
         self.__nibImage          = nibImage
         self.__saveState         = dataSource is not None
-        self.__imageWrapper      = imagewrapper.ImageWrapper(self.nibImage,
-                                                             self.name,
-                                                             loadData=loadData,
-                                                             threaded=threaded)
+        self.__imageWrapper      = imagewrapper.ImageWrapper(
+            self.nibImage,
+            self.name,
+            loadData=loadData,
+            threaded=threaded,
+            mmap=bool(mmap),
+            volumeCacheSize=volumeCacheSize)
 
         # Listen to ourself for changes
         # to the voxToWorldMat, so we
@@ -933,13 +990,39 @@ class Image(Nifti):
 
 
     def __del__(self):
-        """Closes any open file handles, and clears some references. """
+        """Closes any open file handles, and clears some references. The
+        ``indexed_gzip`` seek point index is not saved here - call
+        :meth:`close` for that.
+        """
 
         self.__nibImage     = None
         self.__imageWrapper = None
 
-        if getattr(self, '__fileobj', None) is not None:
-            self.__fileobj.close()
+        fileobj = getattr(self, '_Image__fileobj', None)
+
+        if fileobj is not None:
+            fileobj.close()
+
+
+    def close(self):
+        """Closes any open file handles. If this ``Image`` was opened with
+        ``indexed_gzip``, the seek point index is first saved to the index
+        cache (see :func:`saveIndexCache`), so that it can be re-used the next
+        time the file is opened.
+
+        The image data cannot be accessed from the file after this method
+        has been called.
+        """
+
+        fileobj = self.__fileobj
+
+        if fileobj is None:
+            return
+
+        self.__fileobj = None
+
+        saveIndexCache(fileobj)
+        fileobj.close()
 
 
     def getImageWrapper(self):
@@ -1040,14 +1123,33 @@ class Image(Nifti):
         self.notify(topic='dataRange')
 
 
-    def calcRange(self, sizethres=None):
+    def calcRange(self,
+                  sizethres=None,
+                  chunkSize=None,
+                  nthreads=None,
+                  percentiles=None):
         """Forces calculation of the image data range.
 
-        :arg sizethres: If not ``None``, specifies an image size threshold
-                        (total number of bytes). If the number of bytes in
-                        the image is greater than this threshold, the range
-                        is calculated on a sample (the first volume for a
-                        4D image, or slice for a 3D image).
+        :arg sizethres:   If not ``None``, specifies an image size threshold
+                          (total number of bytes). If the number of bytes in
+                          the image is greater than this threshold, the range
+                          is calculated on a sample (the first volume for a
+                          4D image, or slice for a 3D image).
+
+        :arg chunkSize:   Maximum number of bytes to read at a time when
+                          calculating the full data range. See
+                          :meth:`.ImageWrapper.calcRange`.
+
+        :arg nthreads:    Number of threads to use when calculating the full
+                          data range. See :meth:`.ImageWrapper.calcRange`.
+
+        :arg percentiles: Sequence of percentiles to calculate for each
+                          volume (or slice for a 3D image). Only used when
+                          the full data range is calculated.
+
+        :returns:         A ``numpy`` array containing the requested
+                          ``percentiles`` for each volume, if they were
+                          calculated, ``None`` otherwise.
         """
 
         # The ImageWrapper automatically calculates
@@ -1059,10 +1161,14 @@ class Image(Nifti):
 
         # If an image size threshold has not been specified,
         # then we'll calculate the full data range right now.
+        # The ImageWrapper reads the data in chunks, so the
+        # entire image is not read into memory at once.
         if sizethres is None or nbytes < sizethres:
             log.debug('{}: Forcing calculation of full '
                       'data range'.format(self.name))
-            self.__imageWrapper[:]
+            return self.__imageWrapper.calcRange(chunkSize=chunkSize,
+                                                 nthreads=nthreads,
+                                                 percentiles=percentiles)
 
         else:
             log.debug('{}: Calculating data range '
@@ -1072,6 +1178,7 @@ class Image(Nifti):
             # image is bigger than the size threshold,
             # we'll calculate the range from a sample:
             self.__imageWrapper[..., 0]
+            return None
 
 
     def loadData(self):
@@ -1110,34 +1217,45 @@ class Image(Nifti):
             # to save the image, then close and re-open
             # the file.
             #
-            # Unfortunately this means that we'll
-            # lose the file index (and fast random
-            # access) - I'll fix this when I get a
-            # chance to work on indexed_gzip a bit
-            # more.
-            #
-            # Hopefully I should be able to add write
-            # support to indexed_gzip, such that it
-            # re-builds the index while writing the
-            # compressed data. And then be able to
-            # transfer the index generated from the
-            # write to a new read-only file handle.
+            # Make sure that any pending data range
+            # updates (which may read from the file)
+            # have completed before we close it.
+            oldWrapper = self.__imageWrapper
+            if oldWrapper.getTaskThread():
+                oldWrapper.getTaskThread().waitUntilIdle()
+
             nib.save(self.__nibImage, filename)
             self.__fileobj.close()
-            self.__nibImage, self.__fileobj = loadIndexedImageFile(filename)
+            self.__nibImage, self.__fileobj = loadIndexedImageFile(
+                filename, indexCache=False)
             self.header = self.__nibImage.header
 
+            # The re-opened file has no seek point
+            # index, so we build a full index now,
+            # while the newly written file is still
+            # likely to be in the OS disk cache -
+            # otherwise the first access to each
+            # volume would require the file to be
+            # decompressed from the beginning. The
+            # new index is also saved to the index
+            # cache (see saveIndexCache).
+            rebuildIndex(self.__fileobj)
+
             # We have to create a new ImageWrapper
             # instance too, as we have just destroyed
             # the nibabel image we gave to the last
-            # one.
-            self.__imageWrapper.deregister(self.__lName)
+            # one. The image data has not changed,
+            # so the data range and coverage are
+            # carried over from the old one.
+            oldWrapper.deregister(self.__lName)
             self.__imageWrapper = imagewrapper.ImageWrapper(
                 self.nibImage,
                 self.name,
                 loadData=False,
                 dataRange=self.dataRange,
-                threaded=self.__threaded)
+                threaded=self.__threaded,
+                volumeCacheSize=self.__volumeCacheSize)
+            self.__imageWrapper.copyState(oldWrapper)
             self.__imageWrapper.register(self.__lName, self.__dataRangeChanged)
 
         self.__dataSource = filename
@@ -1248,6 +1366,72 @@ class Image(Nifti):
         return self.__imageWrapper.__getitem__(sliceobj)
 
 
+    @contextlib.contextmanager
+    def batchEdit(self):
+        """Context manager which may be used to make a batch of changes to the
+        image data via :meth:`__setitem__`. Within the batch, no
+        notifications are emitted. When the batch ends, a single ``'data'``
+        notification is emitted, with a slice object which encompasses all of
+        the regions that were modified passed as the value. The
+        ``'saveState'`` and ``'dataRange'`` topics are notified at most once.
+        Calls to ``batchEdit`` may be nested - notifications are emitted when
+        the outermost batch ends.
+
+        The known data range is also only updated when the outermost batch
+        ends, once, over a region which encompasses all of the modified
+        regions. The :meth:`dataRange` may therefore be out of date within
+        a batch.
+        """
+
+        if self.__batchLevel == 0:
+            self.__batchSlices = None
+            self.__batchRange  = self.__imageWrapper.dataRange
+
+        self.__batchLevel += 1
+
+        try:
+            yield
+
+        finally:
+            self.__batchLevel -= 1
+
+            if self.__batchLevel == 0:
+
+                slices             = self.__batchSlices
+                oldRange           = self.__batchRange
+                self.__batchSlices = None
+                self.__batchRange  = None
+
+                with self.__imageWrapper.skip(self.__lName):
+                    self.__imageWrapper.updateDeferredRange()
+
+                if slices is not None:
+                    self.__notifyDataChanged(
+                        imagewrapper.sliceTupleToSliceObj(slices),
+                        oldRange)
+
+
+    def __notifyDataChanged(self, sliceobj, oldRange):
+        """Called by :meth:`__setitem__` and :meth:`batchEdit`. Notifies the
+        ``'data'`` topic, and the ``'saveState'`` and ``'dataRange'`` topics
+        if necessary.
+
+        :arg sliceobj: Slice object describing the modified region.
+        :arg oldRange: Data range before the modification.
+        """
+
+        newRange = self.__imageWrapper.dataRange
+
+        self.notify(topic='data', value=sliceobj)
+
+        if self.__saveState:
+            self.__saveState = False
+            self.notify(topic='saveState')
+
+        if not np.all(np.isclose(oldRange, newRange)):
+            self.notify(topic='dataRange')
+
+
     def __setitem__(self, sliceobj, values):
         """Set the image data at ``sliceobj`` to ``values``.
 
@@ -1256,6 +1440,10 @@ class Image(Nifti):
 
         .. note:: Modifying image data will force the entire image to be
                   loaded into memory if it has not already been loaded.
+
+        .. note:: If called within a :meth:`batchEdit` block, notification
+                  of the change, and the update of the data range, are
+                  deferred until the end of the batch.
         """
         values = np.array(values)
 
@@ -1266,127 +1454,159 @@ class Image(Nifti):
         with self.__imageWrapper.skip(self.__lName):
 
             oldRange = self.__imageWrapper.dataRange
-            self.__imageWrapper.__setitem__(sliceobj, values)
-            newRange = self.__imageWrapper.dataRange
-
-        if values.size > 0:
-
-            self.notify(topic='data', value=sliceobj)
-
-            if self.__saveState:
-                self.__saveState = False
-                self.notify(topic='saveState')
-
-            if not np.all(np.isclose(oldRange, newRange)):
-                self.notify(topic='dataRange')
-
-
-ALLOWED_EXTENSIONS = ['.nii.gz', '.nii', '.img', '.hdr', '.img.gz', '.hdr.gz']
-"""The file extensions which we understand. This list is used as the default
-if the ``allowedExts`` parameter is not passed to any of the functions
-below.
-"""
-
-
-EXTENSION_DESCRIPTIONS = ['Compressed NIFTI images',
-                          'NIFTI images',
-                          'ANALYZE75 images',
-                          'NIFTI/ANALYZE75 headers',
-                          'Compressed NIFTI/ANALYZE75 images',
-                          'Compressed NIFTI/ANALYZE75 headers']
-"""Descriptions for each of the extensions in :data:`ALLOWED_EXTENSIONS`. """
-
+            self.__imageWrapper.__setitem__(
+                sliceobj, values, updateRange=self.__batchLevel == 0)
+
+        if values.size == 0:
+            return
+
+        # Not in a batch - notify
+        # listeners immediately
+        if self.__batchLevel == 0:
+            self.__notifyDataChanged(sliceobj, oldRange)
+            return
+
+        # In a batch - expand the region
+        # that has been modified to
+        # include this slice
+        shape = self.shape
+        try:
+            slices = imagewrapper.sliceObjToSliceTuple(
+                imagewrapper.canonicalSliceObj(sliceobj, shape), shape)
+        except Exception:
+            slices = tuple((0, s) for s in shape)
 
-FILE_GROUPS = [('.hdr',    '.img'),
-               ('.hdr.gz', '.img.gz')]
-"""File suffix groups used by :func:`addExt` to resolve file path
-ambiguities - see :func:`fsl.utils.path.addExt`.
+        if self.__batchSlices is None:
+            self.__batchSlices = slices
+        else:
+            self.__batchSlices = tuple(
+                (min(lo1, lo2), max(hi1, hi2))
+                for (lo1, hi1), (lo2, hi2) in zip(self.__batchSlices, slices))
+
+
+# The file name functions are defined in the
+# imagepath module, so that they can be used
+# without importing nibabel - they are made
+# available here for convenience and
+# backwards compatibility.
+ALLOWED_EXTENSIONS     = imagepath.ALLOWED_EXTENSIONS
+EXTENSION_DESCRIPTIONS = imagepath.EXTENSION_DESCRIPTIONS
+FILE_GROUPS            = imagepath.FILE_GROUPS
+PathError              = imagepath.PathError
+looksLikeImage         = imagepath.looksLikeImage
+addExt                 = imagepath.addExt
+splitExt               = imagepath.splitExt
+getExt                 = imagepath.getExt
+removeExt              = imagepath.removeExt
+defaultExt             = imagepath.defaultExt
+
+
+HEADER_CACHE_SIZE = 1000
+"""Maximum number of headers stored in the :func:`readHeader` cache. """
+
+
+_headerCache = cache.Cache(maxsize=HEADER_CACHE_SIZE)
+"""Cache used by the :func:`readHeader` function, containing
+``{ (path, size, mtime) : header }`` mappings.
 """
 
 
-PathError = fslpath.PathError
-"""Error raised by :mod:`fsl.utils.path` functions when an error occurs.
-Made available in this module for convenience.
-"""
-
+def readHeader(filename):
+    """Reads and returns the header of the given NIFTI1, NIFTI2 or ANALYZE
+    image file, without reading any of the image data.
 
-def looksLikeImage(filename, allowedExts=None):
-    """Returns ``True`` if the given file looks like an image, ``False``
-    otherwise.
+    Only the header bytes (348 bytes for NIFTI1/ANALYZE, 540 bytes for
+    NIFTI2) are read from the file - NIFTI extensions are not read. Headers
+    are cached, keyed on the file path, size and modification time, so
+    repeated calls for the same unmodified file do not touch the file
+    contents at all.
 
-    .. note:: The ``filename`` cannot just be a file prefix - it must
-              include the file suffix (e.g. ``myfile.nii.gz``, not
-              ``myfile``).
+    This function is intended for situations where only header information
+    (e.g. shape, pixdims, affine) is needed from a large number of files - it
+    avoids the overhead of creating an :class:`Image`. The returned header
+    may be passed to :class:`Nifti` to access the header information in the
+    same way as for an :class:`Image`.
 
-    :arg filename:    The file name to test.
+    :arg filename: Image file name, with or without a file extension. For
+                   NIFTI/ANALYZE file pairs, either the header or image file
+                   may be specified.
 
-    :arg allowedExts: A list of strings containing the allowed file
-                      extensions - defaults to :attr:`ALLOWED_EXTENSIONS`.
+    :returns:      A ``nibabel`` header object, of the same type that would
+                   be created by ``nibabel.load``. A copy is returned, so it
+                   may be modified without affecting the cache.
     """
 
-    if allowedExts is None: allowedExts = ALLOWED_EXTENSIONS
+    filename = addExt(filename, mustExist=True)
+    base     = removeExt(filename)
+    ext      = getExt(  filename)
 
-    # TODO A much more robust approach would be
-    #      to try loading the file using nibabel.
-
-    return any([filename.endswith(ext) for ext in allowedExts])
-
-
-def addExt(prefix, mustExist=True, unambiguous=True):
-    """Adds a file extension to the given file ``prefix``.  See
-    :func:`~fsl.utils.path.addExt`.
-    """
-    return fslpath.addExt(prefix,
-                          allowedExts=ALLOWED_EXTENSIONS,
-                          mustExist=mustExist,
-                          defaultExt=defaultExt(),
-                          fileGroups=FILE_GROUPS,
-                          unambiguous=unambiguous)
+    # The header for an image
+    # pair is in the .hdr file
+    if   ext == '.img':    filename = base + '.hdr'
+    elif ext == '.img.gz': filename = base + '.hdr.gz'
 
+    filename = op.abspath(filename)
+    stat     = os.stat(filename)
+    key      = (filename, stat.st_size, stat.st_mtime)
+    header   = _headerCache.get(key, None)
 
-def splitExt(filename):
-    """Splits the base name and extension for the given ``filename``.  See
-    :func:`~fsl.utils.path.splitExt`.
-    """
-    return fslpath.splitExt(filename, ALLOWED_EXTENSIONS)
+    if header is not None:
+        return header.copy()
 
+    if filename.endswith('.gz'): opener = gzip.open
+    else:                        opener = open
 
-def getExt(filename):
-    """Gets the extension for the given file name.  See
-    :func:`~fsl.utils.path.getExt`.
-    """
-    return fslpath.getExt(filename, ALLOWED_EXTENSIONS)
+    with opener(filename, 'rb') as f:
+        raw = f.read(4)
 
+        # sizeof_hdr is 348 for NIFTI1/ANALYZE,
+        # and 540 for NIFTI2 - the byte order
+        # of the file is determined from this.
+        sizeof = np.frombuffer(raw, dtype='<i4')[0]
+        if sizeof not in (348, 540):
+            sizeof = np.frombuffer(raw, dtype='>i4')[0]
 
-def removeExt(filename):
-    """Removes the extension from the given file name. See
-    :func:`~fsl.utils.path.removeExt`.
-    """
-    return fslpath.removeExt(filename, ALLOWED_EXTENSIONS)
+        if sizeof not in (348, 540):
+            raise ValueError('{} does not look like a NIFTI/ANALYZE '
+                             'image file'.format(filename))
 
+        raw = raw + f.read(sizeof - 4)
 
-def defaultExt():
-    """Returns the default NIFTI file extension that should be used.
+    if len(raw) != sizeof:
+        raise ValueError('{} is truncated'.format(filename))
 
-    If the ``$FSLOUTPUTTYPE`` variable is set, its value is used.
-    Otherwise, ``.nii.gz`` is returned.
-    """
+    # Figure out the header type from
+    # the magic string, in the same
+    # way that nibabel.load does.
+    if sizeof == 540:
+        magic = raw[4:8]
+        if   magic == b'n+2\0': htype = nib.Nifti2Header
+        elif magic == b'ni2\0': htype = nib.nifti2.Nifti2PairHeader
+        else: raise ValueError('{} has an invalid NIFTI2 magic '
+                               'string'.format(filename))
+    else:
+        magic = raw[344:348]
+        if   magic == b'n+1\0': htype = nib.Nifti1Header
+        elif magic == b'ni1\0': htype = nib.nifti1.Nifti1PairHeader
+        else:                   htype = nib.spm2analyze.Spm2AnalyzeHeader
 
-    # TODO: Add analyze support.
-    options = {
-        'NIFTI'      : '.nii',
-        'NIFTI_PAIR' : '.img',
-        'NIFTI_GZ'   : '.nii.gz',
-    }
+    header = htype(binaryblock=raw, check=False)
 
-    outputType = os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ')
+    _headerCache.put(key, header)
 
-    return options.get(outputType, '.nii.gz')
+    return header.copy()
 
 
-def loadIndexedImageFile(filename):
+def loadIndexedImageFile(filename, indexCache=True):
     """Loads the given image file using ``nibabel`` and ``indexed_gzip``.
 
+    If ``indexCache`` is ``True``, and a seek point index for the file was
+    saved during a previous session (see :func:`saveIndexCache`), the index
+    is imported, so that fast random access to the file is available
+    immediately. Otherwise, the index is built as the file is read. Index
+    caching requires version 0.8.0 or newer of ``indexed_gzip``, and is
+    disabled if the :mod:`.settings` module has not been initialised.
+
     Returns a tuple containing the ``nibabel`` NIFTI image, and the open
     ``IndexedGzipFile`` handle.
     """
@@ -1409,6 +1629,34 @@ def loadIndexedImageFile(filename):
     # function below
     fobj._arrayproxy_lock = threading.Lock()
 
+    # Used by the saveIndexCache and
+    # rebuildIndex functions - the file
+    # name, the location of the cached
+    # index, whether it has been imported,
+    # and the size of the imported index.
+    fobj._index_filename     = filename
+    fobj._index_cache_file   = None
+    fobj._index_cache_loaded = False
+    fobj._index_cache_size   = 0
+
+    if indexCache and hasattr(fobj, 'import_index'):
+
+        cacheFile = indexCacheFile(filename)
+
+        if cacheFile is not None and op.exists(cacheFile):
+            try:
+                fobj.import_index(filename=cacheFile)
+                fobj._index_cache_loaded = True
+                fobj._index_cache_size   = op.getsize(cacheFile)
+                log.debug('Imported index for {} from {}'.format(
+                    filename, cacheFile))
+
+            except Exception as e:
+                log.warning('Could not import index for {} from {}: '
+                            '{}'.format(filename, cacheFile, e))
+
+        fobj._index_cache_file = cacheFile
+
     fmap = ftype.make_file_map()
     fmap['image'].fileobj = fobj
     image = ftype.from_file_map(fmap)
@@ -1416,6 +1664,139 @@ def loadIndexedImageFile(filename):
     return image, fobj
 
 
+def cacheFilePath(filename, cacheName, suffix):
+    """Returns the path to a file in which data derived from the given file
+    may be cached, or ``None`` if it cannot be cached.
+
+    Cache files are stored in the ``cacheName`` sub-directory of the
+    :mod:`.settings` directory, with a name derived from the absolute path of
+    the file, so there is at most one cache file for each file. The file
+    size and modification time are also incorporated into the name, so that
+    a cache file is not re-used after a file has changed. The name starts
+    with a key derived from the path alone, followed by an underscore, so
+    that cache files for old versions of a file can be identified.
+
+    :arg filename:  The file from which the cached data is derived.
+
+    :arg cacheName: Name of the cache directory, within the :mod:`.settings`
+                    directory.
+
+    :arg suffix:    File suffix for the cache file.
+    """
+
+    filename = op.abspath(filename)
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    pathKey  = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    statKey  = '{}_{}'.format(stat.st_size, int(stat.st_mtime * 1000))
+    statKey  = hashlib.md5(statKey.encode('utf-8')).hexdigest()[:8]
+    cacheDir = fslsettings.filePath(cacheName)
+
+    # The settings module has
+    # not been initialised
+    if cacheDir is None:
+        return None
+
+    return op.join(cacheDir, '{}_{}{}'.format(pathKey, statKey, suffix))
+
+
+def indexCacheFile(filename):
+    """Returns the path to a file in which an ``indexed_gzip`` seek point
+    index for the given compressed image file may be cached, or ``None`` if
+    the index cannot be cached. See :func:`cacheFilePath`.
+    """
+    return cacheFilePath(filename, 'indexed_gzip', '.gzidx')
+
+
+def saveIndexCache(fileobj):
+    """Saves the seek point index of the given ``IndexedGzipFile`` (which
+    must have been opened via :func:`loadIndexedImageFile`) to the index
+    cache, so it can be imported the next time the file is opened.
+
+    The index is built incrementally as the file is read, so an index which
+    was imported from the cache may have grown since. The index is exported
+    to a temporary file, and only replaces the cached index if it is larger
+    (i.e. contains more seek points) than the index that was imported. Any
+    other cached indices for the same file (i.e. for older versions of it)
+    are then deleted. Nothing is done if caching is not possible.
+    """
+
+    cacheFile = getattr(fileobj, '_index_cache_file', None)
+    cacheSize = getattr(fileobj, '_index_cache_size', 0)
+
+    if cacheFile is None:
+        return
+
+    cacheDir = op.dirname(cacheFile)
+    pathKey  = op.basename(cacheFile).split('_')[0]
+    tmpFile  = None
+
+    try:
+        if not op.exists(cacheDir):
+            os.makedirs(cacheDir)
+
+        fd, tmpFile = tempfile.mkstemp(
+            prefix='.{}.'.format(op.basename(cacheFile)),
+            dir=cacheDir)
+        os.close(fd)
+
+        fileobj.export_index(filename=tmpFile)
+
+        newSize = op.getsize(tmpFile)
+
+        # The index has not grown since it
+        # was imported (or last saved)
+        if newSize <= cacheSize:
+            return
+
+        getattr(os, 'replace', os.rename)(tmpFile, cacheFile)
+        tmpFile = None
+
+        fileobj._index_cache_loaded = True
+        fileobj._index_cache_size   = newSize
+
+        for f in os.listdir(cacheDir):
+            if f.startswith(pathKey) and f != op.basename(cacheFile):
+                os.remove(op.join(cacheDir, f))
+
+        log.debug('Saved index to {}'.format(cacheFile))
+
+    except Exception as e:
+        log.warning('Could not save index to {}: {}'.format(cacheFile, e))
+
+    finally:
+        if tmpFile is not None and op.exists(tmpFile):
+            os.remove(tmpFile)
+
+
+def rebuildIndex(fileobj):
+    """Builds a full seek point index for the given ``IndexedGzipFile``
+    (which must have been opened via :func:`loadIndexedImageFile`), and then
+    saves it to the index cache via :func:`saveIndexCache`. The index cache
+    location for the file is re-calculated, as this function is intended to
+    be used after a file has been (re-)written.
+
+    Nothing is done if the installed version of ``indexed_gzip`` does not
+    support building a full index.
+    """
+
+    if not hasattr(fileobj, 'build_full_index'):
+        return
+
+    with fileobj._arrayproxy_lock:
+        fileobj.build_full_index()
+
+    if hasattr(fileobj, 'export_index'):
+        fileobj._index_cache_file   = indexCacheFile(fileobj._index_filename)
+        fileobj._index_cache_loaded = False
+        fileobj._index_cache_size   = 0
+        saveIndexCache(fileobj)
+
+
 @deprecation.deprecated(deprecated_in='1.3.0',
                         removed_in='2.0.0',
                         details='Upgrade to nibabel 2.2.0')
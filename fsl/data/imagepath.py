@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#
+# imagepath.py - Functions for working with NIFTI/ANALYZE image file names.
+#
+# Author: Paul McCarthy <pauldmccarthy@gmail.com>
+#
+"""This module contains constants and functions for working with NIFTI and
+ANALYZE image file names. They are all available via the :mod:`.image`
+module, but are kept here so that they can be used without importing
+``nibabel``, ``scipy``, or any of the other dependencies of the
+:mod:`.image` module. The :mod:`.imglob`, :mod:`.imcp` and :mod:`.immv`
+scripts use this module directly, as they only need to manipulate file
+names.
+
+.. autosummary::
+   :nosignatures:
+
+   looksLikeImage
+   addExt
+   splitExt
+   getExt
+   removeExt
+   defaultExt
+"""
+
+
+import os
+
+import fsl.utils.path as fslpath
+
+
+ALLOWED_EXTENSIONS = ['.nii.gz', '.nii', '.img', '.hdr', '.img.gz', '.hdr.gz']
+"""The file extensions which we understand. This list is used as the default
+if the ``allowedExts`` parameter is not passed to any of the functions
+below.
+"""
+
+
+EXTENSION_DESCRIPTIONS = ['Compressed NIFTI images',
+                          'NIFTI images',
+                          'ANALYZE75 images',
+                          'NIFTI/ANALYZE75 headers',
+                          'Compressed NIFTI/ANALYZE75 images',
+                          'Compressed NIFTI/ANALYZE75 headers']
+"""Descriptions for each of the extensions in :data:`ALLOWED_EXTENSIONS`. """
+
+
+FILE_GROUPS = [('.hdr',    '.img'),
+               ('.hdr.gz', '.img.gz')]
+"""File suffix groups used by :func:`addExt` to resolve file path
+ambiguities - see :func:`fsl.utils.path.addExt`.
+"""
+
+
+PathError = fslpath.PathError
+"""Error raised by :mod:`fsl.utils.path` functions when an error occurs.
+Made available in this module for convenience.
+"""
+
+
+def looksLikeImage(filename, allowedExts=None):
+    """Returns ``True`` if the given file looks like an image, ``False``
+    otherwise.
+
+    .. note:: The ``filename`` cannot just be a file prefix - it must
+              include the file suffix (e.g. ``myfile.nii.gz``, not
+              ``myfile``).
+
+    :arg filename:    The file name to test.
+
+    :arg allowedExts: A list of strings containing the allowed file
+                      extensions - defaults to :attr:`ALLOWED_EXTENSIONS`.
+    """
+
+    if allowedExts is None: allowedExts = ALLOWED_EXTENSIONS
+
+    # TODO A much more robust approach would be
+    #      to try loading the file using nibabel.
+
+    return any([filename.endswith(ext) for ext in allowedExts])
+
+
+def addExt(prefix, mustExist=True, unambiguous=True):
+    """Adds a file extension to the given file ``prefix``.  See
+    :func:`~fsl.utils.path.addExt`.
+    """
+    return fslpath.addExt(prefix,
+                          allowedExts=ALLOWED_EXTENSIONS,
+                          mustExist=mustExist,
+                          defaultExt=defaultExt(),
+                          fileGroups=FILE_GROUPS,
+                          unambiguous=unambiguous)
+
+
+def splitExt(filename):
+    """Splits the base name and extension for the given ``filename``.  See
+    :func:`~fsl.utils.path.splitExt`.
+    """
+    return fslpath.splitExt(filename, ALLOWED_EXTENSIONS)
+
+
+def getExt(filename):
+    """Gets the extension for the given file name.  See
+    :func:`~fsl.utils.path.getExt`.
+    """
+    return fslpath.getExt(filename, ALLOWED_EXTENSIONS)
+
+
+def removeExt(filename):
+    """Removes the extension from the given file name. See
+    :func:`~fsl.utils.path.removeExt`.
+    """
+    return fslpath.removeExt(filename, ALLOWED_EXTENSIONS)
+
+
+def defaultExt():
+    """Returns the default NIFTI file extension that should be used.
+
+    If the ``$FSLOUTPUTTYPE`` variable is set, its value is used.
+    Otherwise, ``.nii.gz`` is returned.
+    """
+
+    # TODO: Add analyze support.
+    options = {
+        'NIFTI'      : '.nii',
+        'NIFTI_PAIR' : '.img',
+        'NIFTI_GZ'   : '.nii.gz',
+    }
+
+    outputType = os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ')
+
+    return options.get(outputType, '.nii.gz')
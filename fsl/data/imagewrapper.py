@@ -38,8 +38,12 @@ get their definitions straight:
 
 
 import logging
+import warnings
+import threading
 import collections
-import itertools as it
+import multiprocessing
+import multiprocessing.pool as mppool
+import itertools            as it
 
 import numpy     as np
 import nibabel   as nib
@@ -78,6 +82,41 @@ class ImageWrapper(notifier.Notifier):
     method.
 
 
+    *Memory-mapped access*
+
+
+    If the ``mmap`` parameter to :meth:`__init__` is ``True``, and the image
+    data is kept on disk in an uncompressed file (e.g. ``.nii`` or ``.img``),
+    the ``ImageWrapper`` will bypass the ``nibabel`` array proxy, and will
+    instead access the data through a read-only ``numpy.memmap``. For images
+    which have no scaling parameters (``scl_slope``/``scl_inter``), data
+    accesses will then return views into the memory map, so no data is copied
+    or allocated. If the image does have scaling parameters, they are applied
+    to the data on each access - the raw memory map, and the scaling
+    parameters, are available via the :meth:`memmap` and :meth:`scaling`
+    properties. Memory-mapped access is not possible for compressed files -
+    the ``mmap`` parameter is ignored for such images.
+
+
+    *Volume cache*
+
+
+    If the ``volumeCacheSize`` parameter to :meth:`__init__` is greater than
+    zero, and the image data is being accessed through the ``nibabel`` array
+    proxy, the ``ImageWrapper`` will keep a least-recently-used cache of 3D
+    volumes (for a 4D image), or 2D slices (for a 3D image), which have been
+    read from disk. Whenever a request is made for data from within a single
+    volume/slice, the entire volume/slice is read and cached, and subsequent
+    requests for data from that volume/slice are served from the cache. This
+    means that repeated accesses to the same volumes (e.g. when scrubbing
+    through the time series of a compressed 4D image) will not require the
+    data to be re-read from disk. The ``volumeCacheSize`` is specified in
+    bytes - the least recently used volumes are dropped from the cache when
+    it exceeds this size. Cache hit/miss counts are available via the
+    :meth:`volumeCacheStats` method. The cache is cleared whenever the image
+    data is loaded into memory.
+
+
     *Image dimensionality*
 
 
@@ -138,22 +177,34 @@ class ImageWrapper(notifier.Notifier):
        :nosignatures:
 
        naninfrange
+       naninfrangePerVolume
+       percentilesPerVolume
+       calcVolumeChunks
        isValidFancySliceObj
        canonicalSliceObj
        sliceObjToSliceTuple
        sliceTupleToSliceObj
        sliceCovered
        calcExpansion
+       splitExpansion
        adjustCoverage
     """
 
 
+    DEFAULT_CHUNK_SIZE = 128 * 1048576
+    """Default maximum chunk size, in bytes, used by the :meth:`calcRange`
+    method.
+    """
+
+
     def __init__(self,
                  image,
                  name=None,
                  loadData=False,
                  dataRange=None,
-                 threaded=False):
+                 threaded=False,
+                 mmap=False,
+                 volumeCacheSize=0):
         """Create an ``ImageWrapper``.
 
         :arg image:     A ``nibabel.Nifti1Image`` or ``nibabel.Nifti2Image``.
@@ -173,11 +224,36 @@ class ImageWrapper(notifier.Notifier):
         :arg threaded:  If ``True``, the data range is updated on a
                         :class:`.TaskThread`. Otherwise (the default), the
                         data range is updated directly on reads/writes.
+
+        :arg mmap:      If ``True``, and the image data is stored in an
+                        uncompressed file, the data is accessed through a
+                        read-only ``numpy.memmap``, instead of through the
+                        ``nibabel`` array proxy. Ignored if ``loadData`` is
+                        ``True``.
+
+        :arg volumeCacheSize: Maximum size, in bytes, of the volume cache
+                              (see the class documentation). The volume
+                              cache is disabled if ``0`` (the default).
         """
 
         self.__image      = image
         self.__name       = name
         self.__taskThread = None
+        self.__memmap     = None
+        self.__scaling    = (1.0, 0.0)
+
+        # The volume cache is an OrderedDict of
+        # { volume index : numpy array } mappings,
+        # ordered from least to most recently
+        # used. The lock is needed as data may
+        # be read from both the calling thread
+        # and the task thread.
+        self.__volCache      = collections.OrderedDict()
+        self.__volCacheSize  = volumeCacheSize
+        self.__volCacheBytes = 0
+        self.__volCacheHits  = 0
+        self.__volCacheMiss  = 0
+        self.__volCacheLock  = threading.Lock()
 
         # Save the number of 'real' dimensions,
         # that is the number of dimensions minus
@@ -213,11 +289,24 @@ class ImageWrapper(notifier.Notifier):
         self.__volRanges = None
         self.__covered   = False
 
+        # Used by __setitem__ when the range
+        # update is deferred - the region that
+        # has been written to, the per-volume
+        # range of the data that was overwritten,
+        # and whether that range is unknown. See
+        # the updateDeferredRange method.
+        self.__deferredSlices = None
+        self.__deferredRanges = None
+        self.__deferredReset  = False
+
         self.reset(dataRange)
 
         if loadData:
             self.loadData()
 
+        elif mmap:
+            self.__memmap, self.__scaling = memoryMapImage(image)
+
         if threaded:
             self.__taskThread = idle.TaskThread()
             self.__taskThread.daemon = True
@@ -344,6 +433,27 @@ class ImageWrapper(notifier.Notifier):
         return self.__canonicalShape
 
 
+    @property
+    def memmap(self):
+        """Returns the read-only ``numpy.memmap`` through which the image
+        data is being accessed, or ``None`` if the image data is not being
+        accessed through a memory map. The values in the memory map are
+        stored as they are on disk, i.e. without scaling - see
+        :meth:`scaling`.
+        """
+        return self.__memmap
+
+
+    @property
+    def scaling(self):
+        """Returns a tuple containing the ``(slope, intercept)`` scaling
+        parameters which are applied to the on-disk voxel values when they
+        are accessed. If the image has no scaling parameters, ``(1.0, 0.0)``
+        is returned.
+        """
+        return self.__scaling
+
+
     def coverage(self, vol):
         """Returns the current image data coverage for the specified volume
         (for a 4D image, slice for a 3D image, or vector for a 2D images).
@@ -361,6 +471,146 @@ class ImageWrapper(notifier.Notifier):
         return np.array(self.__coverage[..., vol])
 
 
+    def volumeCacheStats(self):
+        """Returns a tuple containing the number of volume cache hits, misses,
+        currently cached volumes, and the number of bytes currently used by
+        the volume cache.
+        """
+        with self.__volCacheLock:
+            return (self.__volCacheHits,
+                    self.__volCacheMiss,
+                    len(self.__volCache),
+                    self.__volCacheBytes)
+
+
+    def clearVolumeCache(self):
+        """Clears the volume cache. The hit/miss counts are not reset. """
+        with self.__volCacheLock:
+            self.__volCache      = collections.OrderedDict()
+            self.__volCacheBytes = 0
+
+
+    def volumeRanges(self):
+        """Returns a ``numpy`` array of shape ``(nvols, 2)`` containing the
+        currently known ``(min, max)`` data range for each volume (for a 4D
+        image, slice for a 3D image, or vector for a 2D image). Volumes which
+        have not yet been covered contain ``np.nan``.
+        """
+        return np.array(self.__volRanges)
+
+
+    def calcRange(self, chunkSize=None, nthreads=None, percentiles=None):
+        """Calculates the full data range of the image.
+
+        The image data is read in chunks of volumes (or slices for a 3D
+        image), and the per-volume data ranges of each chunk are calculated
+        in a pool of threads. The image coverage, and the known data range,
+        are then updated in one step. Peak memory usage is approximately
+        ``chunkSize * nthreads``, so the full image data is never held in
+        memory at once (unless it is already loaded).
+
+        :arg chunkSize:   Maximum chunk size in bytes. Defaults to
+                          :attr:`DEFAULT_CHUNK_SIZE`. A chunk always
+                          contains at least one volume/slice.
+
+        :arg nthreads:    Number of threads to use. Defaults to the number of
+                          CPUs.
+
+        :arg percentiles: Sequence of percentiles (between 0 and 100) to
+                          calculate for each volume/slice. ``nan`` and
+                          ``inf`` values are ignored.
+
+        :returns:         If ``percentiles`` is provided, a ``numpy`` array
+                          of shape ``(nvols, len(percentiles))``, containing
+                          the percentiles for each volume/slice. Otherwise
+                          ``None``. The per-volume ranges are available via
+                          :meth:`volumeRanges`.
+        """
+
+        if chunkSize is None: chunkSize = ImageWrapper.DEFAULT_CHUNK_SIZE
+        if nthreads  is None: nthreads  = multiprocessing.cpu_count()
+
+        # Make sure that no range updates
+        # are pending on the task thread
+        if self.__taskThread is not None:
+            self.__taskThread.waitUntilIdle()
+
+        shape  = self.__image.shape
+        volDim = self.__numRealDims - 1
+        nvols  = shape[volDim]
+        chunks = calcVolumeChunks(shape,
+                                  volDim,
+                                  self.__image.get_data_dtype().itemsize,
+                                  chunkSize)
+
+        # Padding dimensions are squeezed out,
+        # but the volume dimension is retained
+        squeezeDims = tuple(range(self.__numRealDims,
+                                  self.__numRealDims + self.__numPadDims))
+
+        def calcChunk(chunk):
+            vlo, vhi = chunk
+            sliceobj = [slice(None)] * len(shape)
+            sliceobj[volDim] = slice(vlo, vhi)
+
+            data    = self.__getData(tuple(sliceobj)).squeeze(squeezeDims)
+            vranges = naninfrangePerVolume(data)
+
+            if percentiles is None:
+                return vranges, None
+
+            return vranges, percentilesPerVolume(data, percentiles)
+
+        log.debug('Calculating data range of {} in {} '
+                  'chunks ({} threads)'.format(
+                      self.__name, len(chunks), nthreads))
+
+        if nthreads > 1 and len(chunks) > 1:
+            pool = mppool.ThreadPool(min(nthreads, len(chunks)))
+            try:
+                results = pool.map(calcChunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [calcChunk(c) for c in chunks]
+
+        self.__volRanges     = np.concatenate([r[0] for r in results])
+        self.__volRanges     = self.__volRanges.astype(np.float32)
+        self.__coverage[0]   = 0
+        self.__coverage[1]   = np.array(shape[:volDim]).reshape(-1, 1)
+
+        self.__updateRange()
+
+        if percentiles is None:
+            return None
+
+        return np.concatenate([r[1] for r in results]).reshape(
+            nvols, len(percentiles))
+
+
+    def copyState(self, other):
+        """Copies the known data range and coverage from another
+        ``ImageWrapper``, which must be wrapping an image of the same shape
+        and containing the same data (e.g. the same image, after it has been
+        saved and re-opened). This allows the data range calculation state
+        to be carried over to a new ``ImageWrapper`` without having to
+        re-read any data.
+
+        :arg other: The ``ImageWrapper`` to copy state from.
+        """
+
+        if other.__coverage.shape != self.__coverage.shape:
+            raise ValueError('Incompatible ImageWrapper: coverage shape {} '
+                             '!= {}'.format(other.__coverage.shape,
+                                            self.__coverage.shape))
+
+        self.__range     = tuple(other.__range)
+        self.__coverage  = np.array(other.__coverage)
+        self.__volRanges = np.array(other.__volRanges)
+        self.__covered   = other.__covered
+
+
     def loadData(self):
         """Forces all of the image data to be loaded into memory.
 
@@ -376,6 +626,11 @@ class ImageWrapper(notifier.Notifier):
         # have been made to the data array.
         self.__image.get_data()
 
+        # Cached volumes are not needed
+        # once the data is in memory
+        if len(self.__volCache) > 0:
+            self.clearVolumeCache()
+
 
     def __getData(self, sliceobj, isTuple=False):
         """Retrieves the image data at the location specified by ``sliceobj``.
@@ -410,8 +665,110 @@ class ImageWrapper(notifier.Notifier):
         # (the dataobj attribute) cannot handle
         # fancy indexing. In this case an error
         # will be raised.
-        if self.__image.in_memory: return self.__image.get_data()[sliceobj]
-        else:                      return self.__image.dataobj[   sliceobj]
+        #
+        # If we have a memory map, we can use
+        # it instead of the ArrayProxy - this
+        # gives us a view into the memory map,
+        # and does support fancy indexing. The
+        # scaling parameters (if any) are only
+        # applied to the region being accessed.
+        if self.__image.in_memory:
+            return self.__image.get_data()[sliceobj]
+
+        elif self.__memmap is not None:
+            slope, inter = self.__scaling
+            data         = self.__memmap[sliceobj]
+
+            if slope != 1 or inter != 0:
+                data = nib.volumeutils.apply_read_scaling(data, slope, inter)
+
+            return data
+
+        elif self.__volCacheSize > 0:
+            return self.__getCachedData(sliceobj)
+
+        else:
+            return self.__image.dataobj[sliceobj]
+
+
+    def __getCachedData(self, sliceobj):
+        """Used by :meth:`__getData`. Retrieves image data via the volume
+        cache. If ``sliceobj`` does not refer to a single volume (or slice for
+        3D images), the data is read directly from the ``nibabel`` array
+        proxy.
+
+        :arg sliceobj: A canonical slice object (see
+                       :func:`canonicalSliceObj`) into the image data.
+        """
+
+        volDim = self.__numRealDims - 1
+
+        # We only cache volumes for 4D
+        # images (or slices for 3D images),
+        # and only for basic slicing.
+        if self.__numRealDims < 3 or \
+           isinstance(sliceobj, np.ndarray):
+            return self.__image.dataobj[sliceobj]
+
+        volIdx = sliceobj[volDim]
+
+        if isinstance(volIdx, slice):
+            start, stop, step = volIdx.indices(self.__image.shape[volDim])
+            if (stop - start) != 1 or step != 1:
+                return self.__image.dataobj[sliceobj]
+            vol = start
+
+        else:
+            vol = int(volIdx)
+
+        with self.__volCacheLock:
+            volData = self.__volCache.get(vol, None)
+
+            if volData is not None:
+                self.__volCacheHits += 1
+                self.__volCache[vol] = self.__volCache.pop(vol)
+            else:
+                self.__volCacheMiss += 1
+
+        if volData is None:
+
+            volSlice         = [slice(None)] * len(self.__image.shape)
+            volSlice[volDim] = vol
+            volData          = self.__image.dataobj[tuple(volSlice)]
+
+            with self.__volCacheLock:
+                self.__cacheVolume(vol, volData)
+
+        # Re-insert the volume dimension,
+        # so we can apply the slice object
+        # as-is (apart from the volume
+        # index), and return a copy, so
+        # callers cannot modify the cache.
+        sliceobj = list(sliceobj)
+        volData  = np.expand_dims(volData, volDim)
+
+        if isinstance(volIdx, slice): sliceobj[volDim] = slice(None)
+        else:                         sliceobj[volDim] = 0
+
+        return np.array(volData[tuple(sliceobj)])
+
+
+    def __cacheVolume(self, vol, data):
+        """Used by :meth:`__getCachedData`. Adds the given volume data to the
+        volume cache, and drops the least recently used volumes if the cache
+        size limit has been exceeded. Must be called with the volume cache
+        lock held.
+        """
+
+        if data.nbytes > self.__volCacheSize or vol in self.__volCache:
+            return
+
+        self.__volCache[vol]  = data
+        self.__volCacheBytes += data.nbytes
+
+        while self.__volCacheBytes > self.__volCacheSize:
+            _, dropped = self.__volCache.popitem(last=False)
+            self.__volCacheBytes -= dropped.nbytes
 
 
     def __imageIsCovered(self):
@@ -424,9 +781,18 @@ class ImageWrapper(notifier.Notifier):
         return sliceCovered(slices, self.__coverage)
 
 
-    def __expandCoverage(self, slices):
+    def __expandCoverage(self, slices, data=None):
         """Expands the current image data range and coverage to encompass the
         given ``slices``.
+
+        :arg slices: A tuple of tuples, each tuple being a ``(low, high)``
+                     index pair, one for each dimension in the image.
+
+        :arg data:   The image data at the given ``slices``, if it has
+                     already been read, with one dimension for each entry in
+                     ``slices``. Any parts of the coverage expansion which lie
+                     within ``slices`` are taken from this array, instead of
+                     being read in again. May be ``None``.
         """
 
         _, expansions = calcExpansion(slices, self.__coverage)
@@ -454,6 +820,9 @@ class ImageWrapper(notifier.Notifier):
         squeezeDims = tuple(range(self.__numRealDims,
                                   self.__numRealDims + self.__numPadDims))
 
+        if data is not None:
+            data = data.squeeze(squeezeDims)
+
         # The calcExpansion function splits up the
         # expansions on volumes - here we calculate
         # the min/max per volume/expansion, and
@@ -461,30 +830,61 @@ class ImageWrapper(notifier.Notifier):
         # coverage and data range.
         for exp in expansions:
 
-            data = self.__getData(exp, isTuple=True)
-            data = data.squeeze(squeezeDims)
-
-            vlo, vhi = exp[self.__numRealDims - 1]
-
-            for vi, vol in enumerate(range(vlo, vhi)):
+            # Each expansion is made up of one or
+            # more pieces - the part which lies
+            # within the data that has already
+            # been read, and the parts which do
+            # not, and need to be read in.
+            pieces = []
 
-                oldvlo, oldvhi = self.__volRanges[vol, :]
-                voldata        = data[..., vi]
+            for piece, inData in splitExpansion(exp, slices, data is not None):
 
-                newvlo, newvhi = naninfrange(voldata)
+                if inData:
+                    offsets = [s[0] for s in slices]
+                    pslice  = tuple(slice(lo - off, hi - off)
+                                    for (lo, hi), off in zip(piece, offsets))
+                    pdata   = data[pslice[:self.__numRealDims]]
+                else:
+                    pdata = self.__getData(piece, isTuple=True)
+                    pdata = pdata.squeeze(squeezeDims)
 
-                if (not np.isnan(oldvlo)) and oldvlo < newvlo: newvlo = oldvlo
-                if (not np.isnan(oldvhi)) and oldvhi > newvhi: newvhi = oldvhi
+                pieces.append(pdata)
 
-                # Update the stored range and
-                # coverage for each volume
-                self.__volRanges[vol, :]  = newvlo, newvhi
-                self.__coverage[..., vol] = adjustCoverage(
-                    self.__coverage[..., vol], exp)
+            vlo, vhi = exp[self.__numRealDims - 1]
+            ndims    = self.__numRealDims - 1
+
+            # Calculate the min/max of every
+            # volume in each piece in one go,
+            # and combine them with the known
+            # per-volume ranges (fmin/fmax
+            # ignore nans, which denote
+            # unknown ranges).
+            ranges = [naninfrangePerVolume(p) for p in pieces]
+            ranges = np.array(ranges + [self.__volRanges[vlo:vhi, :]])
+
+            self.__volRanges[vlo:vhi, 0] = np.fmin.reduce(ranges[..., 0])
+            self.__volRanges[vlo:vhi, 1] = np.fmax.reduce(ranges[..., 1])
+
+            # Expand the coverage of
+            # every volume in one go
+            explo = np.array([e[0] for e in exp[:ndims]]).reshape(-1, 1)
+            exphi = np.array([e[1] for e in exp[:ndims]]).reshape(-1, 1)
+
+            self.__coverage[0, :, vlo:vhi] = np.fmin(
+                self.__coverage[0, :, vlo:vhi], explo)
+            self.__coverage[1, :, vlo:vhi] = np.fmax(
+                self.__coverage[1, :, vlo:vhi], exphi)
+
+        self.__updateRange()
+
+
+    def __updateRange(self):
+        """Called by :meth:`__expandCoverage` and :meth:`calcRange`.
+        Re-calculates the known data range over the entire image (i.e. over
+        all volumes), from the stored per-volume ranges, and notifies
+        listeners if it has changed.
+        """
 
-        # Calculate the new known data
-        # range over the entire image
-        # (i.e. over all volumes).
         newmin, newmax = naninfrange(self.__volRanges)
 
         oldmin, oldmax = self.__range
@@ -515,32 +915,57 @@ class ImageWrapper(notifier.Notifier):
                      array).
         """
 
-        # TODO You could do something with
-        #      the provided data to avoid
-        #      reading it in again.
+        # Give the data a dimension for each
+        # entry in slices, so the coverage
+        # engine can use it instead of reading
+        # it in again. This is not possible
+        # for fancy-indexed (1D) data.
+        shape = [hi - lo for lo, hi in slices]
+
+        if data is None or np.prod(shape) != np.asarray(data).size:
+            data = None
+        else:
+            data = np.asarray(data).reshape(shape)
 
         if self.__taskThread is None:
-            self.__expandCoverage(slices)
+            self.__expandCoverage(slices, data)
         else:
             name = '{}_read_{}'.format(id(self), slices)
             if not self.__taskThread.isQueued(name):
+
+                # If the image is in memory, it
+                # is just as fast to re-read the
+                # data on the task thread. Otherwise
+                # we copy the data, as the caller
+                # may modify it before the task runs.
+                if self.__image.in_memory: data = None
+                elif data is not None:     data = np.array(data)
+
                 self.__taskThread.enqueue(
-                    self.__expandCoverage, slices, taskName=name)
+                    self.__expandCoverage, slices, data, taskName=name)
 
 
-    def __updateDataRangeOnWrite(self, slices, data):
+    def __updateDataRangeOnWrite(self, slices, oldRanges, newRanges):
         """Called by :meth:`__setitem__`. Assumes that the image data has
-        been changed (the data at ``slices`` has been replaced with ``data``.
+        been changed (the data at ``slices`` has been replaced).
         Updates the image data coverage, and known data range accordingly.
 
-        :arg slices: A tuple of tuples, each tuple being a ``(low, high)``
-                     index pair, one for each dimension in the image.
+        :arg slices:    A tuple of tuples, each tuple being a ``(low, high)``
+                        index pair, one for each dimension in the image.
 
-        :arg data:   The image data at the given ``slices`` (as a ``numpy``
-                     array).
+        :arg oldRanges: A ``numpy`` array of shape ``(nvols, 2)`` containing
+                        the ``(min, max)`` values, for each volume in
+                        ``slices``, of the data that was overwritten, or
+                        ``None`` if they are not known.
+
+        :arg newRanges: A ``numpy`` array of shape ``(nvols, 2)`` containing
+                        the ``(min, max)`` values, for each volume in
+                        ``slices``, of the data that was written, or ``None``
+                        if they are not known.
         """
 
-        overlap = sliceOverlap(slices, self.__coverage)
+        overlap         = sliceOverlap(slices, self.__coverage)
+        lowVol, highVol = slices[self.__numRealDims - 1]
 
         # If there's no overlap between the written
         # area and the current coverage, then it's
@@ -552,45 +977,83 @@ class ImageWrapper(notifier.Notifier):
         # more complicated, because the portion of
         # the image that has been written over may
         # have contained the currently known data
-        # minimum/maximum. We have no way of knowing
-        # this, so we have to reset the coverage (on
-        # the affected volumes), and recalculate the
-        # data range.
+        # minimum/maximum. We check this by comparing
+        # the range of the data that was overwritten
+        # against the known range of each volume -
+        # if the overwritten data did not contain
+        # the known minimum/maximum, we can just
+        # widen the known range to include the new
+        # data. Otherwise we have to reset the
+        # coverage (on the affected volumes), and
+        # recalculate the data range.
         if overlap in (OVERLAP_SOME, OVERLAP_ALL):
 
-            # TODO Could you store the location of the
-            #      data minimum/maximum (in each volume),
-            #      so you know whether resetting the
-            #      coverage is necessary?
-            lowVol, highVol = slices[self.__numRealDims - 1]
+            volRanges = self.__volRanges[lowVol:highVol, :]
 
-            # We create a single slice which
-            # encompasses the given slice, and
-            # all existing coverages for each
-            # volume in the given slice. The
-            # data range for this slice will
-            # be recalculated.
-            slices = adjustCoverage(self.__coverage[:, :, lowVol], slices)
-            for vol in range(lowVol + 1, highVol):
-                slices = adjustCoverage(slices, self.__coverage[:, :, vol].T)
-
-            slices = np.array(slices.T, dtype=np.uint32)
-            slices = tuple(it.chain(map(tuple, slices), [(lowVol, highVol)]))
-
-            log.debug('Image {} data written - clearing known data '
-                      'range on volumes {} - {} (write slice: {}; '
-                      'coverage: {}; volRanges: {})'.format(
-                          self.__name,
-                          lowVol,
-                          highVol,
-                          slices,
-                          self.__coverage[:, :, lowVol:highVol],
-                          self.__volRanges[lowVol:highVol, :]))
-
-            for vol in range(lowVol, highVol):
-                self.__coverage[:, :, vol]    = np.nan
-                self.__volRanges[     vol, :] = np.nan
+            if oldRanges is None or newRanges is None:
+                reset = True
+            else:
+
+                # The known ranges are stored as
+                # float32, so the overwritten
+                # ranges must be compared at the
+                # same precision - the stored
+                # value may have been rounded up
+                # (max) or down (min).
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', category=RuntimeWarning)
+                    oldRanges = np.asarray(oldRanges, dtype=np.float32)
+                    reset     = np.any(
+                        (oldRanges[:, 0] <= volRanges[:, 0]) |
+                        (oldRanges[:, 1] >= volRanges[:, 1]))
+
+            # The overwritten data did not contain
+            # the minimum/maximum of any volume, so
+            # we can just widen the known ranges.
+            # Any part of the written area which
+            # lies outside of the coverage is
+            # handled by __expandCoverage below.
+            if not reset:
+                ranges = np.array([volRanges, newRanges])
+                self.__volRanges[lowVol:highVol, 0] = \
+                    np.fmin.reduce(ranges[..., 0])
+                self.__volRanges[lowVol:highVol, 1] = \
+                    np.fmax.reduce(ranges[..., 1])
+
+                if overlap == OVERLAP_ALL:
+                    self.__updateRange()
+                    return
+
+            else:
 
+                # We create a single slice which
+                # encompasses the given slice, and
+                # all existing coverages for each
+                # volume in the given slice. The
+                # data range for this slice will
+                # be recalculated.
+                slices = adjustCoverage(self.__coverage[:, :, lowVol], slices)
+                for vol in range(lowVol + 1, highVol):
+                    slices = adjustCoverage(slices,
+                                            self.__coverage[:, :, vol].T)
+
+                slices = np.array(slices.T, dtype=np.uint32)
+                slices = tuple(it.chain(map(tuple, slices),
+                                        [(lowVol, highVol)]))
+
+                log.debug('Image {} data written - clearing known data '
+                          'range on volumes {} - {} (write slice: {}; '
+                          'coverage: {}; volRanges: {})'.format(
+                              self.__name,
+                              lowVol,
+                              highVol,
+                              slices,
+                              self.__coverage[:, :, lowVol:highVol],
+                              self.__volRanges[lowVol:highVol, :]))
+
+                for vol in range(lowVol, highVol):
+                    self.__coverage[:, :, vol]    = np.nan
+                    self.__volRanges[     vol, :] = np.nan
 
         if self.__taskThread is None:
             self.__expandCoverage(slices)
@@ -601,6 +1064,25 @@ class ImageWrapper(notifier.Notifier):
                     self.__expandCoverage, slices, taskName=name)
 
 
+    def __writeRegionRanges(self, sliceobj, slices):
+        """Used by :meth:`__setitem__`. Returns the per-volume ``(min, max)``
+        values of the in-memory image data at the given ``sliceobj``, or
+        ``None`` if they cannot be calculated (e.g. for a fancy slice object).
+        Only the data at ``sliceobj`` is accessed.
+        """
+
+        if isinstance(sliceobj, np.ndarray):
+            return None
+
+        squeezeDims = tuple(range(self.__numRealDims,
+                                  self.__numRealDims + self.__numPadDims))
+        shape       = [hi - lo for lo, hi in slices]
+        data        = self.__image.get_data()[sliceobj]
+        data        = np.asarray(data).reshape(shape).squeeze(squeezeDims)
+
+        return naninfrangePerVolume(data)
+
+
     def __getitem__(self, sliceobj):
         """Returns the image data for the given ``sliceobj``, and updates
         the known image data range if necessary.
@@ -616,9 +1098,6 @@ class ImageWrapper(notifier.Notifier):
         fancy              = isValidFancySliceObj(sliceobj, shape)
         expNdims, expShape = expectedShape(       sliceobj, shape)
 
-        # TODO Cache 3D images for large 4D volumes,
-        #      so you don't have to hit the disk?
-
         # Make the slice object compatible with the
         # actual image shape, and retrieve the data.
         sliceobj = canonicalSliceObj(sliceobj, realShape)
@@ -630,8 +1109,21 @@ class ImageWrapper(notifier.Notifier):
 
             slices = sliceObjToSliceTuple(sliceobj, realShape)
 
+            # The data can only be re-used by
+            # the coverage engine if it was
+            # read in order - the slices tuple
+            # does not record a slice step.
+            if fancy: steps = []
+            else:     steps = [s.step for s in sliceobj
+                               if isinstance(s, slice)]
+
+            if any(step not in (None, 1) for step in steps):
+                rangeData = None
+            else:
+                rangeData = data
+
             if not sliceCovered(slices, self.__coverage):
-                self.__updateDataRangeOnRead(slices, data)
+                self.__updateDataRangeOnRead(slices, rangeData)
 
         # Make sure that the result has the
         # shape that the caller is expecting.
@@ -657,12 +1149,17 @@ class ImageWrapper(notifier.Notifier):
         return data
 
 
-    def __setitem__(self, sliceobj, values):
+    def __setitem__(self, sliceobj, values, updateRange=True):
         """Writes the given ``values`` to the image at the given ``sliceobj``.
 
 
-        :arg sliceobj: Something which can be used to slice the array.
-        :arg values:   Data to write to the image.
+        :arg sliceobj:    Something which can be used to slice the array.
+        :arg values:      Data to write to the image.
+        :arg updateRange: If ``False``, the known data range is not updated.
+                          Instead, the written region is accumulated, and the
+                          data range is updated over all of the regions
+                          written since, when :meth:`updateDeferredRange` is
+                          called.
 
 
         .. note:: Modifying image data will cause the entire image to be
@@ -707,8 +1204,159 @@ class ImageWrapper(notifier.Notifier):
         # have any effect.
         self.loadData()
 
+        # The range of the data being overwritten,
+        # and of the new data, are used to figure
+        # out whether the data range needs to be
+        # re-calculated. This is only necessary if
+        # the write overlaps with the coverage.
+        # Only the written region is accessed, so
+        # this is proportional to the number of
+        # written voxels.
+        overlap   = sliceOverlap(slices, self.__coverage)
+        oldRanges = None
+        newRanges = None
+
+        if overlap in (OVERLAP_SOME, OVERLAP_ALL):
+            oldRanges = self.__writeRegionRanges(sliceobj, slices)
+
         self.__image.get_data()[sliceobj] = values
-        self.__updateDataRangeOnWrite(slices, values)
+
+        if not updateRange:
+            self.__deferRangeUpdate(slices, overlap, oldRanges)
+            return
+
+        if overlap in (OVERLAP_SOME, OVERLAP_ALL):
+            newRanges = self.__writeRegionRanges(sliceobj, slices)
+
+        self.__updateDataRangeOnWrite(slices, oldRanges, newRanges)
+
+
+    def __deferRangeUpdate(self, slices, overlap, oldRanges):
+        """Called by :meth:`__setitem__` when the data range update is to be
+        deferred. Expands the deferred region to include ``slices``, and
+        accumulates the range of the data that was overwritten.
+
+        :arg slices:    A tuple of ``(low, high)`` index pairs describing the
+                        written region.
+
+        :arg overlap:   Overlap between the written region and the coverage.
+
+        :arg oldRanges: Per-volume ``(min, max)`` values of the data that was
+                        overwritten, or ``None`` if they are not known.
+        """
+
+        if self.__deferredSlices is None:
+            nvols                 = self.__volRanges.shape[0]
+            self.__deferredSlices = slices
+            self.__deferredRanges = np.full((nvols, 2), np.nan)
+            self.__deferredReset  = False
+        else:
+            self.__deferredSlices = tuple(
+                (min(lo1, lo2), max(hi1, hi2))
+                for (lo1, hi1), (lo2, hi2)
+                in zip(self.__deferredSlices, slices))
+
+        if overlap not in (OVERLAP_SOME, OVERLAP_ALL):
+            return
+
+        if oldRanges is None:
+            self.__deferredReset = True
+            return
+
+        lowVol, highVol = slices[self.__numRealDims - 1]
+        ranges          = self.__deferredRanges[lowVol:highVol]
+
+        ranges[:, 0] = np.fmin(ranges[:, 0], oldRanges[:, 0])
+        ranges[:, 1] = np.fmax(ranges[:, 1], oldRanges[:, 1])
+
+
+    def updateDeferredRange(self):
+        """Updates the known data range after one or more calls to
+        :meth:`__setitem__` with ``updateRange=False``. The data range is
+        updated once, over a region which encompasses all of the regions
+        that were written. The range of the data in that region is only
+        re-calculated if one of the writes overwrote the known minimum or
+        maximum of a volume.
+        """
+
+        slices    = self.__deferredSlices
+        oldRanges = self.__deferredRanges
+        reset     = self.__deferredReset
+
+        if slices is None:
+            return
+
+        self.__deferredSlices = None
+        self.__deferredRanges = None
+        self.__deferredReset  = False
+
+        overlap   = sliceOverlap(slices, self.__coverage)
+        newRanges = None
+
+        if reset or overlap not in (OVERLAP_SOME, OVERLAP_ALL):
+            oldRanges = None
+
+        else:
+            lowVol, highVol = slices[self.__numRealDims - 1]
+            oldRanges       = oldRanges[lowVol:highVol]
+            newRanges       = self.__writeRegionRanges(
+                sliceTupleToSliceObj(slices), slices)
+
+        self.__updateDataRangeOnWrite(slices, oldRanges, newRanges)
+
+
+def memoryMapImage(image):
+    """Creates a read-only ``numpy.memmap`` for the data of the given
+    ``nibabel`` image, if possible.
+
+    :arg image: A ``nibabel.Nifti1Image`` or ``nibabel.Nifti2Image``.
+
+    :returns:   A tuple containing:
+
+                  - The ``numpy.memmap``, or ``None`` if the image data cannot
+                    be memory-mapped (e.g. it is in memory, or is stored in a
+                    compressed file).
+
+                  - A tuple containing the ``(slope, intercept)`` scaling
+                    parameters which need to be applied to the values in the
+                    memory map.
+    """
+
+    dataobj = image.dataobj
+
+    if image.in_memory or not nib.is_proxy(dataobj):
+        return None, (1.0, 0.0)
+
+    # We can't memory-map a file which has
+    # already been opened by someone else
+    # (e.g. an IndexedGzipFile), or which
+    # is compressed.
+    fmap     = image.file_map['image']
+    filename = fmap.filename
+
+    if fmap.fileobj is not None or \
+       filename     is     None or \
+       filename.lower().endswith(('.gz', '.bz2')):
+        log.debug('Image {} cannot be memory-mapped'.format(filename))
+        return None, (1.0, 0.0)
+
+    slope = dataobj.slope
+    inter = dataobj.inter
+
+    if slope is None: slope = 1.0
+    if inter is None: inter = 0.0
+
+    mmap = np.memmap(filename,
+                     dtype=dataobj.dtype,
+                     mode='r',
+                     offset=dataobj.offset,
+                     shape=dataobj.shape,
+                     order=getattr(dataobj, 'order', 'F'))
+
+    log.debug('Memory-mapped {} (scaling: {}, {})'.format(
+        filename, slope, inter))
+
+    return mmap, (float(slope), float(inter))
 
 
 def naninfrange(data):
@@ -720,7 +1368,7 @@ def naninfrange(data):
     use an alternate approach to calculating the minimum/maximum.
     """
 
-    if not np.issubdtype(data.dtype, np.float):
+    if not np.issubdtype(data.dtype, np.floating):
         return data.min(), data.max()
 
     # But np.nanmin/nanmax are substantially
@@ -754,6 +1402,84 @@ def naninfrange(data):
         return np.nan, np.nan
 
 
+def naninfrangePerVolume(data):
+    """Calculates the minimum and maximum values of every volume in the given
+    ``numpy`` array, ignoring ``nan`` and ``inf`` values. The volumes are
+    assumed to lie along the last axis of the array.
+
+    The minimum/maximum values are calculated for all volumes in one pass,
+    using ``numpy.nanmin``/``numpy.nanmax``. The slower :func:`naninfrange`
+    function is only used for those volumes which contain ``inf`` values, or
+    which only contain ``nan`` values.
+
+    :returns: A ``numpy`` array of shape ``(nvols, 2)``, containing the
+              ``(min, max)`` values for each volume.
+    """
+
+    axes = tuple(range(data.ndim - 1))
+
+    if not np.issubdtype(data.dtype, np.floating):
+        return np.stack((data.min(axis=axes), data.max(axis=axes)), axis=1)
+
+    # nanmin/nanmax warn
+    # for all-nan volumes
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        dmin = np.nanmin(data, axis=axes)
+        dmax = np.nanmax(data, axis=axes)
+
+    ranges = np.stack((dmin, dmax), axis=1)
+    bad    = ~(np.isfinite(dmin) & np.isfinite(dmax))
+
+    for vol in np.where(bad)[0]:
+        ranges[vol, :] = naninfrange(data[..., vol])
+
+    return ranges
+
+
+def percentilesPerVolume(data, percentiles):
+    """Calculates the given percentiles of every volume in the given
+    ``numpy`` array, ignoring ``nan`` and ``inf`` values. The volumes are
+    assumed to lie along the last axis of the array.
+
+    :returns: A ``numpy`` array of shape ``(nvols, len(percentiles))``.
+    """
+
+    axes = tuple(range(data.ndim - 1))
+
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.where(np.isfinite(data), data, np.nan)
+
+    # nanpercentile warns
+    # for all-nan volumes
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        result = np.nanpercentile(data, percentiles, axis=axes)
+
+    return np.atleast_2d(result.T).reshape(data.shape[-1], -1)
+
+
+def calcVolumeChunks(shape, volDim, itemsize, chunkSize):
+    """Splits an image into chunks of volumes (or slices, for a 3D image),
+    where the size of each chunk is no larger than ``chunkSize`` bytes. Each
+    chunk contains at least one volume/slice.
+
+    :arg shape:     Image shape.
+    :arg volDim:    Index of the volume/slice dimension.
+    :arg itemsize:  Number of bytes per voxel.
+    :arg chunkSize: Maximum number of bytes per chunk.
+
+    :returns:       A list of ``(low, high)`` volume index pairs.
+    """
+
+    nvols    = shape[volDim]
+    volBytes = int(np.prod(shape[:volDim])) * itemsize
+    perChunk = max(1, int(chunkSize // max(1, volBytes)))
+
+    return [(lo, min(lo + perChunk, nvols))
+            for lo in range(0, nvols, perChunk)]
+
+
 def isValidFancySliceObj(sliceobj, shape):
     """Returns ``True`` if the given ``sliceobj`` is a valid and fancy slice
     object.
@@ -1243,6 +1969,64 @@ def calcExpansion(slices, coverage):
     return volumes, expansions
 
 
+def splitExpansion(expansion, slices, haveData=True):
+    """Splits the given ``expansion`` into a set of non-overlapping pieces,
+    according to whether or not they lie within the given ``slices``.
+
+    This function is used by the :class:`ImageWrapper` to avoid re-reading
+    image data which has already been read - the part of a coverage expansion
+    which lies within the region of the image that was just accessed can be
+    taken from the data that was read, and only the remainder of the
+    expansion needs to be read from disk.
+
+    :arg expansion: A sequence of ``(low, high)`` index pairs, one for each
+                    image dimension.
+
+    :arg slices:    A sequence of ``(low, high)`` index pairs, one for each
+                    image dimension, specifying the region of the image for
+                    which data is available.
+
+    :arg haveData:  If ``False``, the expansion is returned as-is.
+
+    :returns:       A list of ``(piece, inData)`` tuples, where ``piece`` is a
+                    list of ``(low, high)`` index pairs, and ``inData`` is
+                    ``True`` if the piece lies within ``slices``, ``False``
+                    otherwise.
+    """
+
+    expansion = [tuple(int(i) for i in e) for e in expansion]
+    slices    = [tuple(int(i) for i in s) for s in slices]
+
+    if not haveData:
+        return [(expansion, False)]
+
+    inter = [(max(elo, slo), min(ehi, shi))
+             for (elo, ehi), (slo, shi) in zip(expansion, slices)]
+
+    # The expansion does not
+    # overlap with the slices
+    if any(lo >= hi for lo, hi in inter):
+        return [(expansion, False)]
+
+    pieces = [(list(inter), True)]
+
+    # The remainder of the expansion is split
+    # up into slabs, one below and one above
+    # the intersection along each dimension.
+    # Each slab spans the intersection along
+    # the preceding dimensions, and the full
+    # expansion along the remaining dimensions,
+    # so none of the slabs overlap.
+    for dim, ((elo, ehi), (ilo, ihi)) in enumerate(zip(expansion, inter)):
+
+        for lo, hi in ((elo, ilo), (ihi, ehi)):
+            if lo < hi:
+                piece = list(inter[:dim]) + [(lo, hi)] + expansion[dim + 1:]
+                pieces.append((piece, False))
+
+    return pieces
+
+
 def collapseExpansions(expansions, numDims):
     """Scans through the given list of expansions (each assumed to pertain
     to a single 3D image), and combines any which cover the same
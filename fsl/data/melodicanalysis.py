@@ -173,7 +173,7 @@ def getNumComponents(meldir):
     contained in the given directrory.
     """
 
-    icImg = fslimage.Image(getICFile(meldir), loadData=False, calcRange=False)
+    icImg = fslimage.Nifti(fslimage.readHeader(getICFile(meldir)))
     return icImg.shape[3]
 
 
@@ -6,21 +6,32 @@
 #
 """This module contains the FSL ``atlasq`` program, the successor to
 ``atlasquery``.
+
+The :mod:`.atlases` and :mod:`.image` modules (and hence ``nibabel`` and
+``scipy``) are only imported by the commands which need to load images, so
+that commands such as ``atlasq list`` start up quickly.
 """
 
 
 from __future__ import print_function
 
 import itertools as it
+import os.path   as op
+import              os
 import              sys
+import              csv
+import              json
+import              stat
+import              socket
 import              argparse
 import              textwrap
 import              logging
+import              tempfile
 import numpy     as np
+import six
 
-import fsl.data.atlases as fslatlases
-import fsl.version      as fslversion
-import fsl.data.image   as fslimage
+import fsl.data.atlasregistry as atlasregistry
+import fsl.version            as fslversion
 
 
 log = logging.getLogger(__name__)
@@ -29,6 +40,31 @@ log = logging.getLogger(__name__)
 SHORT_QUERY_DELIM = '\t'
 
 
+SERVER_COMMANDS = ('query', 'summary', 'ohi')
+"""Commands which are sent to an ``atlasq`` server, if one is running. See
+:func:`serve` and :func:`clientRequest`.
+"""
+
+
+SERVER_TIMEOUT = 60
+"""Default time, in seconds, that :func:`clientRequest` will wait for an
+``atlasq`` server to respond, before giving up and running the command in
+the calling process instead.
+"""
+
+
+BATCH_COORD_CHUNK = 10000
+"""Number of coordinates which are looked up at a time by the ``batch``
+command.
+"""
+
+
+BATCH_MASK_CHUNK = 100
+"""Number of masks which are loaded and looked up at a time by the ``batch``
+command.
+"""
+
+
 class IdentifyError(Exception):
     """Exception raised by the ``identifyAtlas`` when an atlas cannot be
     identified.
@@ -36,6 +72,13 @@ class IdentifyError(Exception):
     pass
 
 
+class SocketError(Exception):
+    """Exception raised by :func:`checkSocketPath` when an ``atlasq`` server
+    socket path is not safe to use.
+    """
+    pass
+
+
 class HelpFormatter(argparse.RawDescriptionHelpFormatter):
     """A custom ``argparse.HelpFormatter`` class which customises a few
     annoying things about default ``argparse`` behaviour.
@@ -49,7 +92,7 @@ class HelpFormatter(argparse.RawDescriptionHelpFormatter):
 
 def listAtlases(namespace):
     """List all available atlases. """
-    atlases = fslatlases.listAtlases()
+    atlases = atlasregistry.listAtlases()
 
     if namespace.extended:
         for a in atlases:
@@ -96,6 +139,8 @@ def summariseAtlas(namespace):
 def queryAtlas(namespace):
     """Query an atlas with coordinates or masks."""
 
+    import fsl.data.image as fslimage
+
     atlasDesc = identifyAtlas(namespace.atlas)
     wcoords   = namespace.coord
     vcoords   = namespace.voxel
@@ -103,9 +148,10 @@ def queryAtlas(namespace):
     worder    = namespace.coord_order
     vorder    = namespace.voxel_order
     morder    = namespace.mask_order
-    atlas     = fslatlases.loadAtlas(atlasDesc.atlasID,
-                                     loadSummary=namespace.label,
-                                     resolution=namespace.resolution)
+    atlas     = atlasregistry.loadAtlas(atlasDesc.atlasID,
+                                        loadSummary=namespace.label,
+                                        resolution=namespace.resolution,
+                                        cache=True)
 
     mlabels, mprops = maskQuery( atlas, masks)
     wlabels, wprops = coordQuery(atlas, wcoords, False)
@@ -131,6 +177,8 @@ def queryAtlas(namespace):
 def queryShortOutput(atlas, sources, types, allLabels, allProps):
     """Called by ``queryAtlas`` when short output is requested. """
 
+    import fsl.data.atlases as fslatlases
+
     for source, stype, labels, props in zip(sources,
                                             types,
                                             allLabels,
@@ -166,6 +214,8 @@ def queryShortOutput(atlas, sources, types, allLabels, allProps):
 def queryLongOutput(atlas, sources, types, allLabels, allProps):
     """Called by ``queryAtlas`` when long output is requested. """
 
+    import fsl.data.atlases as fslatlases
+
     def summaryCoord(source, stype, labels, props, names):
 
         label = labels[0]
@@ -240,20 +290,471 @@ def queryLongOutput(atlas, sources, types, allLabels, allProps):
         print()
 
 
+def batchQuery(namespace):
+    """Query an atlas with coordinates and masks read from files. Queries
+    are performed in chunks of :attr:`BATCH_COORD_CHUNK` coordinates, or
+    :attr:`BATCH_MASK_CHUNK` masks, and the results for each chunk are
+    written out before the next chunk is queried. Masks which cannot be
+    loaded or queried are reported in the output (see :func:`batchMaskQuery`).
+    """
+
+    atlasDesc = identifyAtlas(namespace.atlas)
+    atlas     = atlasregistry.loadAtlas(atlasDesc.atlasID,
+                                        loadSummary=namespace.label,
+                                        resolution=namespace.resolution,
+                                        cache=True)
+
+    if namespace.output is None: outf = sys.stdout
+    else:                        outf = open(namespace.output, 'wt')
+
+    try:
+        writer = batchWriter(atlas, outf, namespace.format)
+
+        for filename in namespace.coord:
+            coords = loadCoordinates(filename)
+            for i in range(0, len(coords), BATCH_COORD_CHUNK):
+                chunk         = coords[i:i + BATCH_COORD_CHUNK]
+                labels, props = coordQuery(atlas, chunk, False)
+                writer('coordinate', chunk, labels, props)
+
+        for filename in namespace.voxel:
+            voxels = loadCoordinates(filename)
+            for i in range(0, len(voxels), BATCH_COORD_CHUNK):
+                chunk         = voxels[i:i + BATCH_COORD_CHUNK]
+                labels, props = coordQuery(atlas, chunk, True)
+                writer('voxel', chunk, labels, props)
+
+        for filename in namespace.mask:
+            masks = loadMaskList(filename)
+            for i in range(0, len(masks), BATCH_MASK_CHUNK):
+                chunk                 = masks[i:i + BATCH_MASK_CHUNK]
+                labels, props, errors = batchMaskQuery(atlas, chunk)
+                writer('mask', chunk, labels, props, errors)
+
+    finally:
+        if outf is not sys.stdout:
+            outf.close()
+
+
+def batchMaskQuery(atlas, filenames):
+    """Used by :func:`batchQuery`. Loads the given mask files, and queries
+    the atlas with them via :func:`maskQuery`. The masks are queried
+    together, unless that fails, in which case they are queried one by one,
+    so that one bad mask (e.g. one which cannot be read, or which is not in
+    the atlas space) does not prevent the others from being queried.
+
+    :returns: A tuple containing lists of the labels, proportions, and
+              errors for each mask. For masks which could not be loaded or
+              queried, the labels and proportions are empty, and the error
+              is a message describing the problem. The error is ``None``
+              for all other masks.
+    """
+
+    import fsl.data.image as fslimage
+
+    allLabels = [[]   for f in filenames]
+    allProps  = [[]   for f in filenames]
+    errors    = [None for f in filenames]
+    images    = []
+    indices   = []
+
+    for i, filename in enumerate(filenames):
+        try:
+            images .append(fslimage.Image(filename))
+            indices.append(i)
+        except Exception as e:
+            errors[i] = str(e)
+
+    try:
+        results = [maskQuery(atlas, images)]
+
+    # Query the masks one by one
+    # to find the one(s) at fault
+    except Exception:
+        results = []
+        for i, image in zip(list(indices), images):
+            try:
+                results.append(maskQuery(atlas, [image]))
+            except Exception as e:
+                errors[i] = str(e)
+                indices.remove(i)
+
+    labels = [l for r in results for l in r[0]]
+    props  = [p for r in results for p in r[1]]
+
+    for i, l, p in zip(indices, labels, props):
+        allLabels[i] = l
+        allProps[ i] = p
+
+    return allLabels, allProps, errors
+
+
+def loadCoordinates(filename):
+    """Loads a ``(N, 3)`` array of coordinates from the given file, for the
+    ``batch`` command. The file may either be a ``numpy`` ``.npy`` file, or
+    a text file with three values per line. Text files may be comma
+    separated (``.csv``), tab separated (``.tsv``), or white space separated,
+    and lines starting with ``#`` are ignored.
+    """
+
+    ext = op.splitext(filename)[1].lower()
+
+    if ext == '.npy':
+        coords = np.load(filename)
+    else:
+        if   ext == '.csv': delimiter = ','
+        elif ext == '.tsv': delimiter = '\t'
+        else:               delimiter = None
+        coords = np.loadtxt(filename, delimiter=delimiter, ndmin=2)
+
+    return np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+
+def loadMaskList(filename):
+    """Loads a list of mask image file names from the given file, for the
+    ``batch`` command. The file is assumed to contain one file name per
+    line - empty lines, and lines starting with ``#``, are ignored. Relative
+    file names are interpreted relative to the directory containing the
+    file.
+    """
+
+    basedir = op.dirname(op.abspath(filename))
+    masks   = []
+
+    with open(filename, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            masks.append(op.join(basedir, line))
+
+    return masks
+
+
+def batchWriter(atlas, outf, fmt):
+    """Creates and returns a function which writes the results of a
+    ``batch`` query to ``outf``, in either ``'csv'`` or ``'json'`` (JSON
+    lines) format.
+
+    In CSV format, one row is written for each region that is present at
+    each coordinate or mask, containing the query type, the query source,
+    the region index, name, and proportion, and an error message. Queries
+    with no results, or which failed, are written as a single row with empty
+    region fields. In JSON format, one JSON object is written per coordinate
+    or mask.
+
+    The returned function must be passed the query type (``'coordinate'``,
+    ``'voxel'``, or ``'mask'``), and lists of the query sources, labels and
+    proportions, as returned by :func:`coordQuery` or :func:`maskQuery`.
+    It may also be passed a list of error messages, one for each source,
+    as returned by :func:`batchMaskQuery`.
+    """
+
+    fields = ['type', 'source', 'index', 'name', 'proportion', 'error']
+
+    if fmt == 'csv':
+        csvw = csv.writer(outf, lineterminator='\n')
+        csvw.writerow(fields)
+
+    def formatSource(stype, source):
+        if   stype == 'coordinate': fmt = '{:0.2f} {:0.2f} {:0.2f}'
+        elif stype == 'voxel':      fmt = '{:0.0f} {:0.0f} {:0.0f}'
+        else:                       return source
+        return fmt.format(*source)
+
+    def write(stype, sources, allLabels, allProps, errors=None):
+
+        if errors is None:
+            errors = [None] * len(sources)
+
+        for source, labels, props, error in zip(
+                sources, allLabels, allProps, errors):
+
+            source = formatSource(stype, source)
+            labels = [l for l in labels if l is not None]
+            props  = [p for p in props  if p is not None] or \
+                     [None] * len(labels)
+            names  = labelNames(atlas, labels)
+
+            if fmt == 'json':
+                outf.write(json.dumps({
+                    'type'        : stype,
+                    'source'      : source,
+                    'indices'     : [int(l) for l in labels],
+                    'names'       : names,
+                    'proportions' : [None if p is None else float(p)
+                                     for p in props],
+                    'error'       : error}))
+                outf.write('\n')
+
+            elif len(labels) == 0:
+                csvw.writerow([stype, source, '', '', '', error or ''])
+
+            else:
+                for label, name, prop in zip(labels, names, props):
+                    if prop is not None: prop = '{:0.4f}'.format(prop)
+                    else:                prop = ''
+                    csvw.writerow([stype, source, int(label), name, prop, ''])
+
+        outf.flush()
+
+    return write
+
+
+def socketPath():
+    """Returns the path to the Unix domain socket used by the ``atlasq
+    serve`` command. This is taken from the ``ATLASQ_SOCKET`` environment
+    variable if it is set, or is otherwise a file within a directory, in the
+    system temporary directory, which is private to the current user (see
+    :func:`checkSocketPath`).
+    """
+
+    path = os.environ.get('ATLASQ_SOCKET', None)
+
+    if path is None:
+        uid  = getattr(os, 'getuid', lambda: 0)()
+        path = op.join(tempfile.gettempdir(),
+                       'atlasq-{}'.format(uid),
+                       'atlasq.sock')
+
+    return path
+
+
+def checkSocketPath(sockPath, create=False):
+    """Makes sure that the given ``atlasq`` server socket path is safe to
+    use. The directory containing the socket must be owned by the current
+    user, and must not be writable by anybody else, and the socket (if it
+    exists) must also be owned by the current user. Otherwise another user
+    could replace the socket, and answer requests intended for our server.
+
+    :arg sockPath: Path to the server socket.
+
+    :arg create:   If ``True``, and the directory containing the socket does
+                   not exist, it is created, accessible only by the current
+                   user.
+
+    :raises:       A :exc:`SocketError` if ``sockPath`` is not safe to use.
+    """
+
+    uid     = os.getuid()
+    dirname = op.dirname(op.abspath(sockPath))
+
+    if create and not op.exists(dirname):
+        try:
+            os.mkdir(dirname, 0o700)
+
+        # Somebody else may have created the
+        # directory in the meantime - it is
+        # checked below.
+        except OSError:
+            if not op.lexists(dirname):
+                raise
+
+    try:
+        dirstat = os.lstat(dirname)
+    except OSError as e:
+        raise SocketError('Cannot access socket directory '
+                          '{}: {}'.format(dirname, e))
+
+    if not stat.S_ISDIR(dirstat.st_mode) or \
+       dirstat.st_uid != uid             or \
+       dirstat.st_mode & 0o022:
+        raise SocketError('Socket directory {} is not a directory which is '
+                          'owned by, and only writable by, the current '
+                          'user'.format(dirname))
+
+    if op.lexists(sockPath):
+        sockstat = os.lstat(sockPath)
+
+        if not stat.S_ISSOCK(sockstat.st_mode) or sockstat.st_uid != uid:
+            raise SocketError('{} is not a socket owned by the current '
+                              'user'.format(sockPath))
+
+
+def serve(namespace):
+    """Runs an ``atlasq`` server, which keeps the atlas registry, and loaded
+    atlases, resident in memory, and answers requests sent by
+    :func:`clientRequest` until it is killed. Returns an exit status.
+    """
+
+    sockPath = namespace.socket
+    if sockPath is None:
+        sockPath = socketPath()
+
+    try:
+        server = makeServer(sockPath)
+    except SocketError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    log.debug('atlasq server listening on {}'.format(sockPath))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if op.exists(sockPath):
+            os.remove(sockPath)
+
+    return 0
+
+
+def makeServer(sockPath):
+    """Creates and returns a ``socketserver.UnixStreamServer`` listening on
+    ``sockPath``, for use by the :func:`serve` function.
+
+    Each request is a single line containing a JSON object with an ``args``
+    list (``atlasq`` command line arguments) and a ``cwd`` (the client's
+    working directory). The response is a JSON object containing the exit
+    ``status``, and the ``stdout`` and ``stderr`` produced by the command.
+    Requests are handled one at a time.
+
+    A :exc:`SocketError` is raised if ``sockPath`` is not safe to use - see
+    :func:`checkSocketPath`.
+    """
+
+    socketserver = six.moves.socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            args    = request['args']
+            cwd     = request.get('cwd', None)
+            stdout  = six.StringIO()
+            stderr  = six.StringIO()
+            realout = sys.stdout
+            realerr = sys.stderr
+            prevdir = os.getcwd()
+
+            # Relative paths in the arguments
+            # are relative to the client
+            try:
+                if cwd is not None:
+                    os.chdir(cwd)
+                sys.stdout = stdout
+                sys.stderr = stderr
+                status     = runCommand(parseArgs(args))
+
+            except SystemExit as e:
+                status = e.code
+            except Exception as e:
+                log.warning('atlasq server error: {}'.format(e),
+                            exc_info=True)
+                stderr.write('{}\n'.format(e))
+                status = 1
+            finally:
+                sys.stdout = realout
+                sys.stderr = realerr
+                os.chdir(prevdir)
+
+            if not isinstance(status, int):
+                status = 0 if status is None else 1
+
+            response = json.dumps({'status' : status,
+                                   'stdout' : stdout.getvalue(),
+                                   'stderr' : stderr.getvalue()})
+            self.wfile.write(response.encode('utf-8'))
+
+    # Remove any stale socket
+    # file left behind by a
+    # server which has died
+    checkSocketPath(sockPath, create=True)
+    if op.exists(sockPath):
+        os.remove(sockPath)
+
+    # The server is long-lived, so we import
+    # the atlas image classes now, rather
+    # than on the first request.
+    import fsl.data.atlases  # noqa
+
+    atlasregistry.rescanAtlases()
+
+    server = socketserver.UnixStreamServer(sockPath, Handler)
+
+    # Only the current user
+    # may send requests
+    os.chmod(sockPath, 0o600)
+
+    return server
+
+
+def clientRequest(args, sockPath=None, timeout=None):
+    """Sends the given ``atlasq`` command line arguments to a running
+    ``atlasq`` server (see :func:`serve`), and returns its response.
+
+    :arg args:     Sequence of command line arguments.
+
+    :arg sockPath: Path to the server socket. Defaults to
+                   :func:`socketPath`.
+
+    :arg timeout:  Socket timeout in seconds. Defaults to
+                   :attr:`SERVER_TIMEOUT`.
+
+    :returns:      A tuple containing the exit status, standard output, and
+                   standard error of the command, or ``None`` if a server
+                   is not running, could not be contacted, did not respond
+                   within ``timeout`` seconds, or if ``sockPath`` is not
+                   safe to use (see :func:`checkSocketPath`).
+    """
+
+    if sockPath is None: sockPath = socketPath()
+    if timeout  is None: timeout  = SERVER_TIMEOUT
+
+    if not hasattr(socket, 'AF_UNIX') or not op.exists(sockPath):
+        return None
+
+    try:
+        checkSocketPath(sockPath)
+    except SocketError as e:
+        log.warning('Not using atlasq server: {}'.format(e))
+        return None
+
+    request = json.dumps({'args' : list(args), 'cwd' : os.getcwd()})
+    sock    = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.settimeout(timeout)
+        sock.connect(sockPath)
+        sock.sendall(request.encode('utf-8') + b'\n')
+
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        response = json.loads(b''.join(chunks).decode('utf-8'))
+
+    except (socket.error, ValueError) as e:
+        log.debug('Could not contact atlasq server at {}: '
+                  '{}'.format(sockPath, e))
+        return None
+
+    finally:
+        sock.close()
+
+    return response['status'], response['stdout'], response['stderr']
+
+
 def ohi(namespace):
     """Emulates the FSL ``atlasquery`` tool."""
 
     atlasDesc = None
 
     def dumpatlases():
-        atlases = [a.name for a in fslatlases.listAtlases()]
+        atlases = [a.name for a in atlasregistry.listAtlases()]
         print('\n'.join(sorted(atlases)))
 
     if namespace.dumpatlases:
         dumpatlases()
         return
 
-    for a in fslatlases.listAtlases():
+    for a in atlasregistry.listAtlases():
         if a.name == namespace.atlas:
             atlasDesc = a
             break
@@ -266,6 +767,8 @@ def ohi(namespace):
     # Mask query.
     if namespace.ohiMask is not None:
 
+        import fsl.data.image as fslimage
+
         # atlasquery always uses 2mm atlas versions
         mask          = fslimage.Image(namespace.ohiMask)
         labels, props = maskQuery(atlasDesc, [mask], resolution=2)
@@ -316,12 +819,16 @@ def ohi(namespace):
 def atlasOrDesc(aord, *args, **kwargs):
     """If ``aord`` is an ``Atlas`` it is returned. Otherwise it is assumed to
     be an ``AtlasDescription``, in which case the corresponding ``Atlas`` is
-    loaded and returned.
+    loaded (or retrieved from the atlas cache) and returned.
     """
+
+    import fsl.data.atlases as fslatlases
+
     if isinstance(aord, fslatlases.Atlas):
         return aord
     else:
-        return fslatlases.loadAtlas(aord.atlasID, *args, **kwargs)
+        kwargs.setdefault('cache', True)
+        return atlasregistry.loadAtlas(aord.atlasID, *args, **kwargs)
 
 
 def labelNames(atlas, labels):
@@ -339,32 +846,44 @@ def labelNames(atlas, labels):
 def maskQuery(atlas, masks, *args, **kwargs):
     """Queries the ``atlas`` at the given ``masks``. """
 
+    import fsl.data.atlases as fslatlases
+
     allLabels = []
     allProps  = []
     atlas     = atlasOrDesc(atlas, *args, **kwargs)
 
-    for mask in masks:
+    if len(masks) == 0:
+        return allLabels, allProps
 
-        if isinstance(atlas, fslatlases.LabelAtlas):
+    # All masks are looked up in one go -
+    # masks which share the same space
+    # are resampled together.
+    allZprops = atlas.maskProportionMatrix(masks)
 
-            labels, props = atlas.maskLabel(mask)
+    for zprops in allZprops:
 
-            # We need to subtract 1 from summary
-            # image label values to get the label
-            # index, for probabilistic atlases.
-            if atlas.desc.atlasType == 'probabilistic':
-                labels = [l - 1 for l in labels]
+        labels = []
+        props  = []
+
+        for label, prop in zip(atlas.desc.labels, zprops):
+
+            if prop <= 0:
+                continue
 
-        elif isinstance(atlas, fslatlases.ProbabilisticAtlas):
+            props.append(prop)
 
-            labels = []
-            props  = []
-            zprops = atlas.maskProportions(mask)
+            if isinstance(atlas, fslatlases.LabelAtlas):
 
-            for i in range(len(zprops)):
-                if zprops[i] > 0:
-                    props.append(zprops[i])
-                    labels.append(atlas.desc.labels[i].index)
+                # We need to subtract 1 from summary
+                # image label values to get the label
+                # index, for probabilistic atlases.
+                if atlas.desc.atlasType == 'probabilistic':
+                    labels.append(label.value - 1)
+                else:
+                    labels.append(label.value)
+
+            else:
+                labels.append(label.index)
 
         allLabels.append(labels)
         allProps .append(props)
@@ -375,29 +894,42 @@ def maskQuery(atlas, masks, *args, **kwargs):
 def coordQuery(atlas, coords, voxel, *args, **kwargs):
     """Queries the ``atlas`` at the given ``coords``. """
 
+    import fsl.data.atlases as fslatlases
+
     atlas     = atlasOrDesc(atlas, *args, **kwargs)
     allLabels = []
     allProps  = []
 
-    for coord in coords:
+    if len(coords) == 0:
+        return allLabels, allProps
+
+    # All coordinates are looked up in one go
+    coords = np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+    if isinstance(atlas, fslatlases.ProbabilisticAtlas):
+
+        allprops = atlas.proportions(coords, voxel=voxel)
 
-        if isinstance(atlas, fslatlases.ProbabilisticAtlas):
+        for props in allprops:
 
-            props   = atlas.proportions(coord, voxel=voxel)
             labels  = []
             nzprops = []
 
             for i, p in enumerate(props):
-                if p != 0:
+                if p != 0 and not np.isnan(p):
                     nzprops.append(p)
                     labels .append(atlas.desc.labels[i].index)
 
             allLabels.append(labels)
             allProps .append(nzprops)
 
-        elif isinstance(atlas, fslatlases.LabelAtlas):
+    elif isinstance(atlas, fslatlases.LabelAtlas):
 
-            label = atlas.label(coord, voxel=voxel)
+        for label in atlas.coordLabels(coords, voxel=voxel):
+
+            # out of bounds
+            if np.isnan(label): label = None
+            else:               label = int(label)
 
             # we need to subtract 1 from the label
             # value to get the label index, for
@@ -422,28 +954,15 @@ def identifyAtlas(idOrName):
     # TODO Use difflib or some fuzzy matching library?
 
     idOrName = idOrName.lower().strip()
-    atlases  = fslatlases.listAtlases()
-
-    allNames = [a.name   .lower() for a in atlases]
-    allIDs   = [a.atlasID.lower() for a in atlases]
 
     # First test for an exact match
-    nameMatches = [idOrName == n for n in allNames]
-    idMatches   = [idOrName == i for i in allIDs]
-
-    nameMatches = [i for i in range(len(nameMatches)) if nameMatches[i]]
-    idMatches   = [i for i in range(len(idMatches))   if idMatches[  i]]
+    nameMatches, idMatches = atlasregistry.searchAtlases(idOrName, exact=True)
 
     if len(nameMatches) + len(idMatches) == 1:
-        if len(nameMatches) == 1: return atlases[nameMatches[0]]
-        else:                     return atlases[idMatches[  0]]
+        return (nameMatches + idMatches)[0]
 
     # If no exact match, test for a partial match
-    nameMatches = [idOrName in n for n in allNames]
-    idMatches   = [idOrName in i for i in allIDs]
-
-    nameMatches = [i for i in range(len(nameMatches)) if nameMatches[i]]
-    idMatches   = [i for i in range(len(idMatches))   if idMatches[  i]]
+    nameMatches, idMatches = atlasregistry.searchAtlases(idOrName)
 
     totalMatches = len(nameMatches) + len(idMatches)
 
@@ -456,16 +975,15 @@ def identifyAtlas(idOrName):
     # different ID/name pair matched
     if totalMatches > 2 or (totalMatches == 2 and nameMatches != idMatches):
 
-        possible = [allNames[m] for m in nameMatches] + \
-                   [allIDs[  m] for m in idMatches]
+        possible = [a.name   .lower() for a in nameMatches] + \
+                   [a.atlasID.lower() for a in idMatches]
 
         raise IdentifyError('{} matched multiple atlases! Could match one '
                             'of: {}'.format(idOrName, ', '.join(possible)))
 
     # Either one exact match to an ID or name,
     # or a match to an equivalent ID/name
-    if len(nameMatches) == 1: return atlases[nameMatches[0]]
-    else:                     return atlases[idMatches[  0]]
+    return (nameMatches + idMatches)[0]
 
 
 def printColumns(columns, titles=None, delim=' | ', sep=True, strip=False):
@@ -521,7 +1039,7 @@ def parseArgs(args):
 
     # Show help if no args are provided
     if  len(args) == 0 or \
-       (len(args) == 1 and args[0] in ('ohi', 'summary', 'query')):
+       (len(args) == 1 and args[0] in ('ohi', 'summary', 'query', 'batch')):
         args = list(args) + ['-h']
 
     # Hack to make argparse accept
@@ -541,7 +1059,9 @@ def parseArgs(args):
         'ohi'     : 'Emulate the FSL atlasquery tool',
         'list'    : 'List available atlases',
         'summary' : 'Print a summary of one atlas',
-        'query'   : 'Query an atlas at specific coordinates'
+        'query'   : 'Query an atlas at specific coordinates',
+        'batch'   : 'Query an atlas with coordinates and masks from files',
+        'serve'   : 'Run an atlasq server'
     }
 
     usages = {
@@ -561,6 +1081,11 @@ def parseArgs(args):
                      usage: atlasq query atlas [options] -v X Y Z \\
                                                         [-c X Y Z [-m mask]...]
         """).strip(),
+        'batch' : textwrap.dedent("""
+                     usage: atlasq batch atlas [options] [-c file] [-v file] \\
+                                                        [-m file]
+        """).strip(),
+        'serve'   : 'usage: atlasq serve [-s socket]',
     }
 
     for k in usages:
@@ -592,6 +1117,16 @@ def parseArgs(args):
         help=helps['query'],
         usage=usages['query'],
         formatter_class=HelpFormatter)
+    batchParser = subParsers.add_parser(
+        'batch',
+        help=helps['batch'],
+        usage=usages['batch'],
+        formatter_class=HelpFormatter)
+    serveParser = subParsers.add_parser(
+        'serve',
+        help=helps['serve'],
+        usage=usages['serve'],
+        formatter_class=HelpFormatter)
 
     # This is a custom argparse.Action used by the
     # query command parser which keeps track of the
@@ -694,6 +1229,61 @@ def parseArgs(args):
         help='Voxel coordinates to look up. Must be in terms of the atlas '
         'at the specified (or default) --resolution.')
 
+    # Batch parser
+    batchParser.add_argument(
+        'atlas',
+        help='Name or ID of atlas to query.')
+    batchParser.add_argument(
+        '-r', '--resolution',
+        type=float,
+        help='Desired atlas resolution (mm). Default is highest available '
+             'resolution.')
+    batchParser.add_argument(
+        '-l', '--label',
+        action='store_true',
+        help='Query label/maxprob version of atlas (for probabilistic '
+             'atlases).')
+    batchParser.add_argument(
+        '-c', '--coord',
+        action='append',
+        default=[],
+        metavar='FILE',
+        help='File containing world coordinates to look up - a .npy file, '
+             'or a .csv, .tsv, or white space separated text file with '
+             'three values per line.')
+    batchParser.add_argument(
+        '-v', '--voxel',
+        action='append',
+        default=[],
+        metavar='FILE',
+        help='File containing voxel coordinates to look up, in the same '
+             'format as for --coord. Must be in terms of the atlas at the '
+             'specified (or default) --resolution.')
+    batchParser.add_argument(
+        '-m', '--mask',
+        action='append',
+        default=[],
+        metavar='FILE',
+        help='File containing a list of mask files to query with, one '
+             'per line.')
+    batchParser.add_argument(
+        '-f', '--format',
+        choices=('csv', 'json'),
+        default='csv',
+        help='Output format - CSV (default), or JSON lines.')
+    batchParser.add_argument(
+        '-o', '--output',
+        metavar='FILE',
+        help='Write results to FILE (default: standard output).')
+
+    # Serve parser
+    serveParser.add_argument(
+        '-s', '--socket',
+        metavar='FILE',
+        help='Unix domain socket to listen on. Default is the value of '
+             '$ATLASQ_SOCKET, or a file in a private directory in the '
+             'system temporary directory.')
+
     namespace = parser.parse_args(args)
 
     if namespace.command != 'query':
@@ -712,26 +1302,56 @@ def parseArgs(args):
 
 def main(args=None):
     """Entry point for ``atlasq``. Parses arguments, and runs the requested
-    command.
+    command. Query, summary, and ohi commands are sent to an ``atlasq``
+    server if one is running (see :func:`serve`), and are otherwise run
+    in this process.
     """
 
     if args is None:
         args = sys.argv[1:]
 
+    if len(args) > 0 and args[0] in SERVER_COMMANDS:
+        response = clientRequest(args)
+
+        if response is not None:
+            status, stdout, stderr = response
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            return status
+
     # Parse command line arguments
     namespace = parseArgs(args)
 
+    if namespace.command == 'serve':
+        return serve(namespace)
+
     # Initialise the atlas library
-    fslatlases.rescanAtlases()
+    atlasregistry.rescanAtlases()
+
+    return runCommand(namespace)
+
+
+def runCommand(namespace):
+    """Runs the command specified by the given ``argparse.Namespace``. The
+    atlas registry must have been initialised. Returns an exit status.
+    """
+
+    errors = (IdentifyError, )
+
+    # The atlases module is only imported
+    # by commands which load atlas images
+    if namespace.command in ('query', 'batch', 'ohi'):
+        import fsl.data.atlases as fslatlases
+        errors = errors + (fslatlases.MaskError, )
 
-    # Run the command
     try:
         if   namespace.command == 'list':    listAtlases(   namespace)
         elif namespace.command == 'query':   queryAtlas(    namespace)
+        elif namespace.command == 'batch':   batchQuery(    namespace)
         elif namespace.command == 'summary': summariseAtlas(namespace)
         elif namespace.command == 'ohi':     ohi(           namespace)
 
-    except (IdentifyError, fslatlases.MaskError) as e:
+    except errors as e:
         print(str(e))
         return 1
 
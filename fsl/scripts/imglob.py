@@ -11,9 +11,9 @@ NIFTI/ANALYZE image files.
 
 from __future__ import print_function
 
-import                   sys
-import fsl.utils.path as fslpath
-import fsl.data.image as fslimage
+import                       sys
+import fsl.utils.path     as fslpath
+import fsl.data.imagepath as imagepath
 
 
 usage = """
@@ -22,8 +22,8 @@ Usage: imglob [-extension/extensions] <list of names>
        -extensions for image list with full extensions
 """.strip()
 
-exts   = fslimage.ALLOWED_EXTENSIONS
-groups = fslimage.FILE_GROUPS
+exts   = imagepath.ALLOWED_EXTENSIONS
+groups = imagepath.FILE_GROUPS
 
 
 def imglob(paths, output=None):
@@ -60,8 +60,8 @@ def imglob(paths, output=None):
     # hdr and img and otherwise) that match
     for path in paths:
         try:
-            path = fslimage.removeExt(path)
-            imgfiles.extend(fslimage.addExt(path, unambiguous=False))
+            path = imagepath.removeExt(path)
+            imgfiles.extend(imagepath.addExt(path, unambiguous=False))
         except fslpath.PathError:
             continue
 
@@ -9,40 +9,53 @@
 files.
 
 The :func:`main` function is essentially a wrapper around the
-:func:`fsl.utils.imcp.immv` function - see its documentation for more details.
+:func:`fsl.utils.imcp.imcp_many` function - see its documentation for more
+details.
 """
 
 
 from __future__ import print_function
 
-import os.path        as op
-import                   sys
-import fsl.utils.path as fslpath
-import fsl.utils.imcp as imcp
-import fsl.data.image as fslimage
+import os.path            as op
+import                       sys
+import fsl.utils.path     as fslpath
+import fsl.utils.imcp     as imcp
+import fsl.data.imagepath as imagepath
 
 
 usage = """Usage:
-  immv <file1> <file2>
-  immv <file1> <directory>
-  immv <file1> <file2> ... <fileN> <directory>
+  immv [-j <N>] <file1> <file2>
+  immv [-j <N>] <file1> <directory>
+  immv [-j <N>] <file1> <file2> ... <fileN> <directory>
 
 Moves images from <file1> to <file2>, or move all <file>s to <directory>
 
 NB: filenames can be basenames or include an extension.
 
+-j <N>: Process up to N files at once (0: one per CPU, default: 1).
+
 Recognised file extensions: {}
-""".format(', '.join(fslimage.ALLOWED_EXTENSIONS))
+""".format(', '.join(imagepath.ALLOWED_EXTENSIONS))
 
 
 def main(argv=None):
     """Parses CLI arguments (see the usage string), and calls the
-    fsl.utils.imcp.immv function on each input.
+    :func:`fsl.utils.imcp.imcp_many` function on the inputs.
     """
 
     if argv is None:
         argv = sys.argv[1:]
 
+    nprocs = 1
+
+    if len(argv) > 0 and argv[0].startswith('-j'):
+        try:
+            if argv[0] == '-j': nprocs, argv = int(argv[1]),     argv[2:]
+            else:               nprocs, argv = int(argv[0][2:]), argv[1:]
+        except (IndexError, ValueError):
+            print(usage)
+            return 1
+
     if len(argv) < 2:
         print(usage)
         return 1
@@ -57,11 +70,15 @@ def main(argv=None):
     try:
         srcs = fslpath.removeDuplicates(
             srcs,
-            allowedExts=fslimage.ALLOWED_EXTENSIONS,
-            fileGroups=fslimage.FILE_GROUPS)
-
-        for src in srcs:
-            imcp.immv(src, dest, useDefaultExt=True, overwrite=True)
+            allowedExts=imagepath.ALLOWED_EXTENSIONS,
+            fileGroups=imagepath.FILE_GROUPS)
+
+        imcp.imcp_many(srcs,
+                       dest,
+                       useDefaultExt=True,
+                       overwrite=True,
+                       move=True,
+                       nprocs=nprocs)
 
     except Exception as e:
         print(str(e))
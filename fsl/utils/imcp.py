@@ -11,15 +11,39 @@
 
    imcp
    immv
+   imcp_many
+
+
+The :func:`resolveCopy` and :func:`runCopy` functions are used by
+:func:`imcp` and :func:`imcp_many` to check, and then perform, a copy.
+Conversions between file types are performed by the :func:`convertImage`
+function, which streams the image data from one file to another, rather than
+loading the image into memory.
 """
 
 
-import                   os
-import os.path        as op
-import                   shutil
+import                       os
+import os.path            as op
+import                       gzip
+import                       struct
+import                       shutil
+import                       multiprocessing
+
+import                       six
+
+import fsl.utils.path     as fslpath
+import fsl.data.imagepath as imagepath
+
 
-import fsl.utils.path as fslpath
-import fsl.data.image as fslimage
+CONVERT_CHUNK_SIZE = 16 * 1048576
+"""Number of bytes which are read/written at a time by :func:`convertImage`.
+"""
+
+
+COMPRESSION_LEVEL = 1
+"""``gzip`` compression level used by :func:`convertImage` when writing
+compressed files. This is the same as the ``nibabel`` default.
+"""
 
 
 def imcp(src,
@@ -44,22 +68,47 @@ def imcp(src,
     :arg useDefaultExt: Defaults to ``False``. If ``True``, the destination
                         file type will be set according to the default
                         extension, specified by
-                        :func:`~fsl.data.image.defaultExt`. If the source
-                        file does not have the same type as the default
-                        extension, it will be converted. If ``False``, the
-                        source file type is not changed.
+                        :func:`~fsl.data.imagepath.defaultExt`. If the
+                        source file does not have the same type as the
+                        default extension, it will be converted. If
+                        ``False``, the source file type is not changed.
 
     :arg move:          If ``True``, the files are moved, instead of being
                         copied. See :func:`immv`.
     """
 
-    import nibabel as nib
+    runCopy(resolveCopy(src, dest, overwrite, useDefaultExt, move))
+
+
+def resolveCopy(src,
+                dest,
+                overwrite=False,
+                useDefaultExt=False,
+                move=False):
+    """Used by :func:`imcp` and :func:`imcp_many`. Resolves the full source
+    and destination file paths for the given ``src`` and ``dest``, and checks
+    that the copy can be performed, without touching any files. See
+    :func:`imcp` for details on the arguments.
+
+    A :class:`.fsl.utils.path.PathError` is raised if the copy cannot be
+    performed.
+
+    :returns: A tuple containing:
+
+               - ``True`` if the file needs to be converted to a different
+                 file type, ``False`` if it can just be copied.
+               - The value of ``move``.
+               - A list of source files.
+               - A list of destination files, one for each source file.
+
+              This tuple can be passed to :func:`runCopy`.
+    """
 
     if op.isdir(dest):
         dest = op.join(dest, op.basename(src))
 
-    srcBase,  srcExt  = fslimage.splitExt(src)
-    destBase, destExt = fslimage.splitExt(dest)
+    srcBase,  srcExt  = imagepath.splitExt(src)
+    destBase, destExt = imagepath.splitExt(dest)
 
     # src was specified without an
     # extension, or the specified
@@ -71,12 +120,12 @@ def imcp(src,
         # path - if src does not exist, or
         # does not have an allowed extension,
         # addExt will raise an error
-        src = fslimage.addExt(src, mustExist=True)
+        src = imagepath.addExt(src, mustExist=True)
 
         # We've resolved src to a
         # full filename - split it
         # again to get its extension
-        srcBase, srcExt = fslimage.splitExt(src)
+        srcBase, srcExt = imagepath.splitExt(src)
 
     if not op.exists(src):
         raise fslpath.PathError('imcp error - source path '
@@ -89,7 +138,7 @@ def imcp(src,
     # destination file extension is
     # provided, we use the source
     # extension.
-    if   useDefaultExt: destExt = fslimage.defaultExt()
+    if   useDefaultExt: destExt = imagepath.defaultExt()
     elif destExt == '': destExt = srcExt
 
     # Resolve any file group differences
@@ -100,7 +149,7 @@ def imcp(src,
     # group, we replace the dest extension
     # with the src extension.
     if srcExt != destExt:
-        for group in fslimage.FILE_GROUPS:
+        for group in imagepath.FILE_GROUPS:
             if srcExt in group and destExt in group:
                 destExt = srcExt
                 break
@@ -116,25 +165,26 @@ def imcp(src,
 
     # If the source file type does not
     # match the destination file type,
-    # we need to perform a conversion.
-    #
-    # This is more expensive in terms of
-    # io and cpu, but programmatically
-    # very easy - nibabel does all the
-    # hard work.
+    # we need to perform a conversion
+    # (see runCopy). If the source or
+    # destination is a hdr/img pair, all
+    # of the files in the pair are listed.
     if srcExt != destExt:
 
-        if not overwrite and op.exists(dest):
-            raise fslpath.PathError('imcp error - destination already '
-                                    'exists ({})'.format(dest))
+        convSrcs  = fslpath.getFileGroup(src,
+                                         imagepath.ALLOWED_EXTENSIONS,
+                                         imagepath.FILE_GROUPS,
+                                         unambiguous=True)
+        convDests = list(imageFiles(dest))
 
-        img = nib.load(src)
-        nib.save(img, dest)
+        if convDests[0] == convDests[1]:
+            convDests = convDests[:1]
 
-        if move:
-            os.remove(src)
+        if not overwrite and any([op.exists(d) for d in convDests]):
+            raise fslpath.PathError('imcp error - destination already '
+                                    'exists ({})'.format(', '.join(convDests)))
 
-        return
+        return True, move, convSrcs, convDests
 
     # Otherwise we do a file copy. This
     # is actually more complicated than
@@ -161,8 +211,8 @@ def imcp(src,
     # (e.g. file.hdr without an accompanying
     # file.img).
     copySrcs = fslpath.getFileGroup(src,
-                                    fslimage.ALLOWED_EXTENSIONS,
-                                    fslimage.FILE_GROUPS,
+                                    imagepath.ALLOWED_EXTENSIONS,
+                                    imagepath.FILE_GROUPS,
                                     fullPaths=False,
                                     unambiguous=True)
     copySrcs = [(srcBase, e) for e in copySrcs]
@@ -181,8 +231,31 @@ def imcp(src,
         raise fslpath.PathError('imcp error - a destination path already '
                                 'exists ({})'.format(', '.join(copyDests)))
 
+    return False, move, copySrcs, copyDests
+
+
+def runCopy(job):
+    """Used by :func:`imcp` and :func:`imcp_many`. Performs a copy/move
+    which has been resolved by :func:`resolveCopy`.
+    """
+
+    convert, move, srcs, dests = job
+
+    # If the source file type does not
+    # match the destination file type,
+    # we need to perform a conversion.
+    if convert:
+
+        convertImage(srcs[0], dests[0])
+
+        if move:
+            for src in srcs:
+                os.remove(src)
+
+        return
+
     # Do the copy/move
-    for src, dest in zip(copySrcs, copyDests):
+    for src, dest in zip(srcs, dests):
         if move: shutil.move(src, dest)
         else:    shutil.copy(src, dest)
 
@@ -198,3 +271,311 @@ def immv(src,
          overwrite=overwrite,
          useDefaultExt=useDefaultExt,
          move=True)
+
+
+def imcp_many(srcs,
+              dests,
+              overwrite=False,
+              useDefaultExt=False,
+              move=False,
+              nprocs=None):
+    """Copy or move the given ``srcs`` to ``dests``, using a pool of
+    processes to perform the copies/conversions concurrently.
+
+    Every source/destination pair is checked (see :func:`resolveCopy`) before
+    any files are copied - if any of them cannot be copied, a
+    :class:`.fsl.utils.path.PathError` is raised, and no files are touched.
+    Otherwise, all copies are performed, and a ``PathError`` is raised if
+    any of them failed. In both cases the error message contains one line
+    for each file which could not be copied.
+
+    Copies which involve the same files (e.g. several sources which are
+    copied to the same destination) are performed in the order that they
+    were given, by the same process, so the outcome is the same as calling
+    :func:`imcp` on each source in turn.
+
+    :arg srcs:   Sequence of paths to copy.
+
+    :arg dests:  Either a single destination directory, or a sequence of
+                 destination paths, one for each of the ``srcs``.
+
+    :arg nprocs: Maximum number of processes to use. If ``None`` or less than
+                 ``1``, the number of CPUs is used. If ``1``, all copies are
+                 performed in this process.
+
+    See :func:`imcp` for details on the other arguments.
+    """
+
+    if isinstance(dests, six.string_types):
+        dests = [dests] * len(srcs)
+
+    if len(srcs) != len(dests):
+        raise ValueError('The number of sources ({}) and destinations ({}) '
+                         'do not match'.format(len(srcs), len(dests)))
+
+    if nprocs is None or nprocs < 1:
+        nprocs = multiprocessing.cpu_count()
+
+    # Resolve and check every
+    # copy before doing anything
+    jobs   = []
+    errors = []
+    for src, dest in zip(srcs, dests):
+        try:
+            jobs.append(resolveCopy(src, dest, overwrite, useDefaultExt, move))
+        except Exception as e:
+            jobs  .append(None)
+            errors.append('{}: {}'.format(src, e))
+
+    # Without overwrite, a destination
+    # can only be written once
+    if not overwrite:
+        written = set()
+        for src, job in zip(srcs, jobs):
+            if job is None:
+                continue
+            jobDests = set(op.abspath(d) for d in job[3])
+            if len(written & jobDests) > 0:
+                errors.append('{}: imcp error - destination specified more '
+                              'than once ({})'.format(src, ', '.join(job[3])))
+            written.update(jobDests)
+
+    if len(errors) > 0:
+        raise fslpath.PathError('\n'.join(errors))
+
+    # Jobs which share a file are run in
+    # order, by the same process. Files
+    # are identified by their prefix, so
+    # e.g. file.nii and file.nii.gz are
+    # considered to be the same.
+    groups   = []
+    prefixes = []
+    groupOf  = {}
+
+    for i, job in enumerate(jobs):
+
+        jobPrefixes = set(imagepath.removeExt(op.abspath(f))
+                          for f in job[2] + job[3])
+        touched     = sorted(set(groupOf[p]
+                                 for p in jobPrefixes
+                                 if p in groupOf))
+
+        if len(touched) == 0:
+            gi = len(groups)
+            groups  .append([])
+            prefixes.append(set())
+        else:
+            gi = touched[0]
+
+        # Merge all of the groups
+        # that this job touches
+        for other in touched[1:]:
+            for p in prefixes[other]:
+                groupOf[p] = gi
+            groups[  gi].extend(groups[  other])
+            prefixes[gi].update(prefixes[other])
+            groups[  other] = []
+            prefixes[other] = set()
+
+        groups[  gi].append(i)
+        prefixes[gi].update(jobPrefixes)
+        for p in jobPrefixes:
+            groupOf[p] = gi
+
+    groups = [[(i, jobs[i]) for i in sorted(g)] for g in groups if len(g) > 0]
+    nprocs = min(nprocs, len(groups))
+
+    if nprocs <= 1:
+        results = [runCopyGroup(g) for g in groups]
+    else:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            results = list(pool.imap_unordered(runCopyGroup, groups))
+        finally:
+            pool.close()
+            pool.join()
+
+    errors = sorted(e for r in results for e in r)
+    errors = ['{}: {}'.format(srcs[i], e) for i, e in errors]
+
+    if len(errors) > 0:
+        raise fslpath.PathError('\n'.join(errors))
+
+
+def runCopyGroup(group):
+    """Used by :func:`imcp_many`. Runs each of the copies in the given
+    ``group`` in turn, which is a list of ``(index, job)`` tuples, where
+    each ``job`` has been created by :func:`resolveCopy`.
+
+    :returns: A list of ``(index, message)`` tuples, one for each copy
+              which failed.
+    """
+
+    errors = []
+
+    for i, job in group:
+        try:
+            runCopy(job)
+        except Exception as e:
+            errors.append((i, str(e)))
+
+    return errors
+
+
+def imageFiles(filename):
+    """Returns a tuple containing the paths to the header file and the image
+    data file for the given image file. For a hdr/img pair (e.g.
+    ``file.img``), these are the ``.hdr`` and ``.img`` files. For any other
+    image (e.g. ``file.nii.gz``), both paths are the same as ``filename``.
+    """
+
+    base, ext = imagepath.splitExt(filename)
+
+    for hdrExt, imgExt in imagepath.FILE_GROUPS:
+        if ext in (hdrExt, imgExt):
+            return base + hdrExt, base + imgExt
+
+    return filename, filename
+
+
+def openImageFile(filename, mode):
+    """Opens the given file, via ``gzip`` if it has a ``.gz`` suffix.
+    Compressed files are written with :attr:`COMPRESSION_LEVEL`.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, COMPRESSION_LEVEL)
+    else:
+        return open(filename, mode)
+
+
+def convertImage(src, dest, chunkSize=None):
+    """Converts the image file ``src`` into the image file ``dest``, where
+    the type of each file is determined by its suffix (``.nii``,
+    ``.nii.gz``, ``.img``/``.hdr``, or ``.img.gz``/``.hdr.gz``). Used by
+    :func:`runCopy`.
+
+    The image header and any NIFTI extensions are copied across, with the
+    magic string and ``vox_offset`` field adjusted when converting between
+    a hdr/img pair and a single file. The image data is then streamed from
+    ``src`` to ``dest`` in chunks of ``chunkSize`` bytes, being compressed
+    or decompressed as needed, so the image is never loaded into memory.
+
+    ANALYZE75 images cannot be converted to single files in this way, so
+    they are loaded and saved via ``nibabel`` instead.
+
+    :arg src:       Source file. For a hdr/img pair, either file may be given.
+
+    :arg dest:      Destination file. For a hdr/img pair, either file may be
+                    given.
+
+    :arg chunkSize: Number of bytes to copy at a time. Defaults to
+                    :attr:`CONVERT_CHUNK_SIZE`.
+    """
+
+    if chunkSize is None:
+        chunkSize = CONVERT_CHUNK_SIZE
+
+    srcHdr,  srcImg  = imageFiles(src)
+    destHdr, destImg = imageFiles(dest)
+    srcPair          = srcHdr  != srcImg
+    destPair         = destHdr != destImg
+
+    # The endianness and NIFTI version are
+    # identified by the sizeof_hdr field
+    with openImageFile(srcHdr, 'rb') as inf:
+        hdr = inf.read(4)
+
+    for endian in '<>':
+        if len(hdr) < 4:
+            continue
+        sizeof = struct.unpack(endian + 'i', hdr)[0]
+        if sizeof in (348, 540):
+            break
+    else:
+        raise fslpath.PathError('imcp error - {} does not appear '
+                                'to be an image file'.format(src))
+
+    # If only the compression differs,
+    # the files can just be streamed
+    # through as-is.
+    if srcPair == destPair:
+        for s, d in set([(srcHdr, destHdr), (srcImg, destImg)]):
+            with openImageFile(s, 'rb') as inf, \
+                 openImageFile(d, 'wb') as outf:
+                shutil.copyfileobj(inf, outf, chunkSize)
+        return
+
+    with openImageFile(srcHdr, 'rb') as inf:
+
+        hdr = bytearray(inf.read(sizeof))
+
+        # The magic string and vox_offset
+        # field are in different places
+        # in NIFTI1 and NIFTI2 headers
+        if sizeof == 348:
+            magicOff, offsetOff, offsetFmt = 344, 108, 'f'
+            magics = (b'n+1\0', b'ni1\0')
+        else:
+            magicOff, offsetOff, offsetFmt = 4,   168, 'q'
+            magics = (b'n+2\0', b'ni2\0')
+
+        magic     = bytes(hdr[magicOff:magicOff + 4])
+        offsetFmt = endian + offsetFmt
+        voxOffset = int(struct.unpack_from(offsetFmt, hdr, offsetOff)[0])
+
+        # ANALYZE75 images have no magic
+        # string, and no single-file format,
+        # so we fall back to nibabel
+        if magic not in magics:
+            import nibabel as nib
+            nib.save(nib.load(src), dest)
+            return
+
+        # NIFTI extensions (if any) follow the
+        # header, up to the start of the image
+        # data in a single file, or up to the
+        # end of the header file in a pair.
+        if srcPair: extensions = inf.read()
+        else:       extensions = inf.read(max(0, voxOffset - sizeof))
+
+        # Update the magic string and
+        # vox_offset for the new file
+        magic = bytearray(magic)
+
+        if destPair:
+            magic[1:2] = b'i'
+            newOffset  = 0
+
+        else:
+            magic[1:2] = b'+'
+
+            # The extension flags are mandatory,
+            # and the image data must start on a
+            # multiple of 16 bytes in single files
+            if len(extensions) < 4:
+                extensions = b'\0\0\0\0'
+
+            newOffset  = sizeof + len(extensions)
+            padding    = (16 - newOffset % 16) % 16
+            extensions = extensions + b'\0' * padding
+            newOffset  = newOffset  + padding
+
+        hdr[magicOff:magicOff + 4] = magic
+        struct.pack_into(offsetFmt, hdr, offsetOff, newOffset)
+
+        with openImageFile(destHdr, 'wb') as outf:
+            outf.write(hdr)
+            outf.write(extensions)
+
+            # pair -> single - stream the
+            # image data from the .img file
+            if not destPair:
+                with openImageFile(srcImg, 'rb') as imgf:
+                    imgf.seek(voxOffset)
+                    shutil.copyfileobj(imgf, outf, chunkSize)
+
+        # single -> pair - stream the rest of
+        # the source file into the .img file
+        if destPair:
+            with openImageFile(destImg, 'wb') as outf:
+                shutil.copyfileobj(inf, outf, chunkSize)
@@ -11,6 +11,7 @@
 
 import              os
 import os.path   as op
+import              time
 import itertools as it
 import numpy     as np
 
@@ -18,9 +19,10 @@ import mock
 import pytest
 
 import tests
-import fsl.utils.transform as transform
-import fsl.data.atlases    as atlases
-import fsl.data.image      as fslimage
+import fsl.utils.transform    as transform
+import fsl.data.atlases       as atlases
+import fsl.data.atlasregistry as atlasregistry
+import fsl.data.image         as fslimage
 
 
 datadir = op.join(op.dirname(__file__), 'testdata')
@@ -182,6 +184,38 @@ def test_add_remove_atlas():
 
         assert removed[0]
 
+        assert not reg.hasAtlas('mla')
+        assert reg.searchAtlases('my little atlas', exact=True) == ([], [])
+        with pytest.raises(KeyError):
+            reg.getAtlasDescription('mla')
+
+
+def test_searchAtlases():
+
+    reg = atlases.registry
+    reg.rescanAtlases()
+
+    descs   = reg.listAtlases()
+    queries = ['harvardoxford-cortical',
+               'Harvard-Oxford Cortical Structural Atlas',
+               'harvard',
+               'Cortical',
+               'jhu',
+               'l',
+               '',
+               'non-existent-atlas']
+
+    for q in queries:
+        ql = q.lower()
+
+        expnames = [d for d in descs if ql in d.name.lower()]
+        expids   = [d for d in descs if ql in d.atlasID.lower()]
+        assert reg.searchAtlases(q) == (expnames, expids)
+
+        expnames = [d for d in descs if ql == d.name.lower()]
+        expids   = [d for d in descs if ql == d.atlasID.lower()]
+        assert reg.searchAtlases(q, exact=True) == (expnames, expids)
+
 
 def test_extra_atlases():
 
@@ -232,6 +266,89 @@ def test_load_atlas():
     assert isinstance(lblatlas,     atlases.LabelAtlas)
 
 
+def test_load_atlas_cache():
+
+    reg = atlases.AtlasRegistry()
+    reg.rescanAtlases()
+
+    def load(*args, **kwargs):
+        return reg.loadAtlas(*args, cache=True, **kwargs)
+
+    lbl1 = load('talairach', resolution=2)
+    lbl2 = load('talairach', resolution=2)
+    sum1 = load('harvardoxford-cortical', loadSummary=True, resolution=2)
+    sum2 = load('harvardoxford-cortical', loadSummary=True, resolution=2)
+    prob = load('harvardoxford-cortical', resolution=2,
+                loadData=False, calcRange=False, indexed=True)
+
+    assert lbl1 is lbl2
+    assert sum1 is sum2
+    assert sum1 is not prob
+    assert reg.loadAtlas('talairach', resolution=2) is not lbl1
+
+    # on-disk atlases are not counted
+    lblsize = atlases.atlasSize(lbl1)
+    sumsize = atlases.atlasSize(sum1)
+    assert atlases.atlasSize(prob) == 0
+    assert reg.atlasCacheStats() == (3, lblsize + sumsize)
+
+    # least recently used atlases are evicted
+    load('talairach', resolution=2)
+    reg.setAtlasCacheSize(lblsize + 1)
+    assert reg.atlasCacheStats() == (2, lblsize)
+    assert load('talairach', resolution=2) is lbl1
+    assert load('harvardoxford-cortical',
+                loadSummary=True,
+                resolution=2) is not sum1
+
+    # explicit release
+    reg.setAtlasCacheSize(atlases.AtlasRegistry.DEFAULT_ATLAS_CACHE_SIZE)
+    lbl1 = load('talairach', resolution=2)
+    reg.releaseAtlas('talairach')
+    assert load('talairach', resolution=2) is not lbl1
+    reg.releaseAtlas()
+    assert reg.atlasCacheStats() == (0, 0)
+
+
+def test_load_atlas_cache_rescan():
+
+    with tests.testdir() as testdir:
+
+        spec = _make_dummy_atlas(testdir, 'My atlas', 'myatlas', 'MyAtlas')
+        img  = fslimage.Image(op.join(testdir, 'myatlas', 'MyAtlas'))
+        img.save(op.join(testdir, 'myatlas', 'MyMyAtlas'))
+
+        with mock.patch('fsl.data.atlases.fslsettings.read',
+                        return_value='myatlas={}'.format(spec)), \
+             mock.patch('fsl.data.atlases.fslsettings.write',
+                        return_value=None), \
+             mock.patch('fsl.utils.settings.filePath', return_value=None):
+
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            atlas = reg.loadAtlas('myatlas', cache=True)
+            assert reg.loadAtlas('myatlas', cache=True) is atlas
+            assert reg.atlasCacheStats()[0] == 1
+
+            # Cached atlases are dropped
+            # when the registry is rescanned,
+            # as their descriptions may have
+            # changed
+            reg.rescanAtlases()
+            assert reg.atlasCacheStats() == (0, 0)
+
+            reloaded = reg.loadAtlas('myatlas', cache=True)
+            assert reloaded is not atlas
+            assert reloaded.desc is reg.getAtlasDescription('myatlas')
+
+    # The cache functions are also
+    # available at module level
+    assert atlases.atlasCacheStats   == atlases.registry.atlasCacheStats
+    assert atlases.setAtlasCacheSize == atlases.registry.setAtlasCacheSize
+    assert atlases.atlasSize         is atlasregistry.atlasSize
+
+
 def test_find():
 
     reg = atlases.registry
@@ -300,3 +417,192 @@ def test_prepareMask():
 
         assert list(atlas.prepareMask(goodmask1).shape) == ashape
         assert list(atlas.prepareMask(goodmask2).shape) == ashape
+
+
+def test_registry_desc_cache():
+
+    with tests.testdir() as testdir:
+
+        cachedir = op.join(testdir, 'cache')
+
+        def filePath(path=None):
+            return op.join(cachedir, path)
+
+        specs = [
+            _make_dummy_atlas(testdir, 'My atlas 1', 'myatlas1', 'MyAtlas1'),
+            _make_dummy_atlas(testdir, 'My atlas 2', 'myatlas2', 'MyAtlas2')]
+
+        # The dummy atlases don't
+        # have a summary image
+        for name in ('MyAtlas1', 'MyAtlas2'):
+            img = fslimage.Image(op.join(testdir, name.lower(), name))
+            img.save(op.join(testdir, name.lower(), 'My' + name))
+
+        extraAtlases = ':'.join([
+            'myatlas1={}'.format(specs[0]),
+            'myatlas2={}'.format(specs[1])])
+
+        cacheFile = filePath(atlases.AtlasRegistry.DESC_CACHE_FILE)
+        realParse = atlasregistry.et.iterparse
+
+        with mock.patch('fsl.data.atlases.fslsettings.read',
+                        return_value=extraAtlases), \
+             mock.patch('fsl.data.atlases.fslsettings.write',
+                        return_value=None), \
+             mock.patch('fsl.utils.settings.filePath', filePath), \
+             mock.patch('fsl.data.atlasregistry.et.iterparse',
+                        side_effect=realParse) as mockParse:
+
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            nparsed = mockParse.call_count
+
+            assert op.exists(cacheFile)
+            assert nparsed > 0
+            assert reg.hasAtlas('myatlas1')
+            assert reg.hasAtlas('myatlas2')
+
+            # descriptions are loaded from
+            # the cache the second time around,
+            # and the unchanged cache is not
+            # re-written
+            os.utime(cacheFile, (0, 0))
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            assert mockParse.call_count == nparsed
+            assert os.stat(cacheFile).st_mtime == 0
+            desc = reg.getAtlasDescription('myatlas1')
+            assert desc.name            == 'My atlas 1'
+            assert len(desc.labels)     == 2
+            assert desc.find(value=2).name == 'Second region'
+
+            # a modified atlas is re-loaded
+            time.sleep(0.01)
+            with open(specs[1], 'rt') as f: spec = f.read()
+            with open(specs[1], 'wt') as f:
+                f.write(spec.replace('My atlas 2', 'My new atlas 2'))
+
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            assert mockParse.call_count == nparsed + 1
+            assert reg.getAtlasDescription('myatlas2').name == \
+                'My new atlas 2'
+            assert os.stat(cacheFile).st_mtime != 0
+
+            # the cache is replaced in one go,
+            # so no temporary files are left
+            assert os.listdir(cachedir) == \
+                [atlases.AtlasRegistry.DESC_CACHE_FILE]
+
+            # a corrupt cache is replaced
+            with open(cacheFile, 'wb') as f:
+                f.write(b'garbage')
+
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            assert mockParse.call_count == nparsed + 3
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+            assert mockParse.call_count == nparsed + 3
+
+
+def test_AtlasDescription_lazy():
+
+    with tests.testdir() as testdir:
+
+        spec       = _make_dummy_atlas(
+            testdir, 'My atlas', 'myatlas', 'MyAtlas')
+        realParse  = atlasregistry.et.parse
+        realHeader = fslimage.readHeader
+
+        with mock.patch('fsl.data.atlasregistry.et.parse',
+                        side_effect=realParse) as mockParse, \
+             mock.patch('fsl.data.image.readHeader',
+                        side_effect=realHeader) as mockHeader:
+
+            desc = atlases.AtlasDescription(spec)
+
+            assert desc.atlasID   == 'myatlas'
+            assert desc.name      == 'My atlas'
+            assert desc.atlasType == 'label'
+            assert len(desc.images) == 1
+            assert mockParse .call_count == 0
+            assert mockHeader.call_count == 0
+
+            assert np.all(np.isclose(desc.xforms[0], np.eye(4)))
+            assert mockParse .call_count == 0
+            assert mockHeader.call_count == 1
+
+            assert desc.find(value=1).name == 'First region'
+            assert [l.name for l in desc.labels] == ['First region',
+                                                    'Second region']
+            assert desc.labels[1].x == 6
+            assert mockParse .call_count == 1
+            assert mockHeader.call_count == 1
+
+
+def test_AtlasDescription_malformed():
+
+    with tests.testdir() as testdir:
+
+        extraAtlases = ':'.join([
+            'badlabels={}'.format(_make_dummy_atlas(
+                testdir, 'Bad labels', 'badlabels', 'BadLabels')),
+            'noimage={}'.format(_make_dummy_atlas(
+                testdir, 'No image', 'noimage', 'NoImage')),
+            'badheader={}'.format(_make_dummy_atlas(
+                testdir, 'Bad header', 'badheader', 'BadHeader')),
+            'goodatlas={}'.format(_make_dummy_atlas(
+                testdir, 'Good atlas', 'goodatlas', 'GoodAtlas'))])
+
+        # Only the header is parsed up front,
+        # so broken labels are not noticed
+        # until they are accessed
+        spec = op.join(testdir, 'badlabels.xml')
+        with open(spec, 'rt') as f: xml = f.read()
+        with open(spec, 'wt') as f:
+            f.write(xml.replace('index="2"', 'index="two"'))
+
+        # A missing image is
+        # noticed straight away
+        os.remove(op.join(testdir, 'noimage', 'NoImage.nii.gz'))
+
+        # An unreadable image is not noticed
+        # until the atlas is loaded
+        with open(op.join(testdir, 'badheader', 'BadHeader.nii.gz'),
+                  'wb') as f:
+            f.write(b'not an image')
+
+        with mock.patch('fsl.data.atlases.fslsettings.read',
+                        return_value=extraAtlases), \
+             mock.patch('fsl.data.atlases.fslsettings.write',
+                        return_value=None), \
+             mock.patch('fsl.utils.settings.filePath', return_value=None):
+
+            reg = atlases.AtlasRegistry()
+            reg.rescanAtlases()
+
+            assert     reg.hasAtlas('goodatlas')
+            assert     reg.hasAtlas('badlabels')
+            assert not reg.hasAtlas('noimage')
+
+            bad  = reg.getAtlasDescription('badlabels')
+            good = reg.getAtlasDescription('goodatlas')
+
+            assert bad.labels == []
+            assert np.all(np.isclose(bad.xforms[0], np.eye(4)))
+            assert [l.name for l in good.labels] == ['First region',
+                                                    'Second region']
+
+            with pytest.raises(KeyError):
+                bad.find(value=1)
+
+            assert reg.hasAtlas('badheader')
+            assert reg.getAtlasDescription('badheader').pixdims == []
+
+            with pytest.raises(ValueError, match='readable images'):
+                reg.loadAtlas('badheader')
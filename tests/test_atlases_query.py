@@ -10,6 +10,7 @@ import itertools       as it
 from   collections import defaultdict
 import numpy           as np
 import                    pytest
+import                    mock
 
 
 import fsl.data.atlases    as fslatlases
@@ -348,3 +349,299 @@ def _eval_mask_query(atlas, query, qtype, qin):
 
     if   isinstance(atlas, fslatlases.LabelAtlas):         evalLabel()
     elif isinstance(atlas, fslatlases.ProbabilisticAtlas): evalProb()
+
+
+def test_batch_coord_query(seed):
+
+    for atype, summary, res in it.product(('label', 'prob'),
+                                          (False, True),
+                                          (1, 2)):
+
+        if atype == 'label' and summary:
+            continue
+
+        atlas  = _random_atlas(atype, res=res, summary=summary)
+        shape  = np.array(atlas.shape[:3])
+        voxels = np.random.randint(-5, shape.max() + 5, (50, 3))
+        coords = transform.transform(voxels, atlas.voxToWorldMat)
+
+        for query, voxel in ((voxels, True), (coords, False)):
+
+            # the single-coordinate methods
+            # need python ints for voxels
+            if voxel: single = [[int(v) for v in q] for q in query]
+            else:     single = query
+
+            if isinstance(atlas, fslatlases.LabelAtlas):
+                result   = atlas.coordLabels(query, voxel=voxel)
+                expected = [atlas.coordLabel(q, voxel=voxel) for q in single]
+
+                assert result.shape == (50, )
+
+                for r, e in zip(result, expected):
+                    if e is None: assert np.isnan(r)
+                    else:         assert r == e
+
+            else:
+                result   = atlas.coordProportions(query, voxel=voxel)
+                expected = [atlas.coordProportions(q, voxel=voxel)
+                            for q in single]
+
+                assert result.shape == (50, len(atlas.desc.labels))
+
+                for r, e in zip(result, expected):
+                    if len(e) == 0: assert np.all(np.isnan(r))
+                    else:           assert np.all(np.isclose(r, e))
+
+
+def test_weighted_mask_label(seed):
+
+    for atype, res in it.product(('label', 'prob'), (1, 2)):
+
+        atlas   = _random_atlas(atype, res=res, summary=atype == 'prob')
+        weights = np.random.random(atlas.shape[:3])
+        weights[weights < 0.5] = 0
+        mask    = fslimage.Image(weights, xform=atlas.voxToWorldMat)
+
+        vals, props = atlas.maskLabel(mask)
+
+        # Compare against a naive per-label
+        # weighted sum over the masked voxels
+        boolmask  = weights > 0
+        avals     = atlas[:][boolmask]
+        aweights  = weights[boolmask]
+        expvals   = []
+        expprops  = []
+
+        for label in atlas.desc.labels:
+            if np.any(avals == label.value):
+                expvals .append(label.value)
+                expprops.append(100 * aweights[avals == label.value].sum() /
+                                aweights.sum())
+
+        assert vals == expvals
+        assert np.all(np.isclose(props, expprops))
+
+
+def test_sampleMask(seed):
+
+    atlas    = _get_atlas('harvardoxford-cortical', 2)
+    boolmask = np.random.random(atlas.shape[:3]) > 0.8
+    data     = atlas[:]
+    expected = data[boolmask]
+    volumes  = [3, 0, 7, 8]
+
+    assert not atlas.nibImage.in_memory
+
+    # chunks of one volume, and of all volumes
+    for chunkSize in (1, None):
+        block = atlas.sampleMask(boolmask, chunkSize=chunkSize)
+        assert np.all(block == expected)
+        block = atlas.sampleMask(boolmask, volumes, chunkSize=chunkSize)
+        assert np.all(block == expected[:, volumes])
+
+    empty = atlas.sampleMask(np.zeros(atlas.shape[:3], dtype=np.bool))
+    assert empty.shape == (0, atlas.shape[3])
+
+    # in-memory, and 3D atlases
+    summary = _get_atlas('harvardoxford-cortical', 2, summary=True)
+    assert np.all(summary.sampleMask(boolmask) == summary[:][boolmask])
+
+    weights = np.random.random(atlas.shape[:3])
+    weights[~boolmask] = 0
+    mask    = fslimage.Image(weights, xform=atlas.voxToWorldMat)
+    props   = atlas.maskProportions(mask)
+
+    for label, prop in zip(atlas.desc.labels, props):
+        vals = data[..., label.index][boolmask] * weights[boolmask]
+        assert np.isclose(prop, vals.sum() / weights[boolmask].sum())
+
+
+def test_maskProportionMatrix(seed):
+
+    # 2mm atlases only, so that the
+    # up-sampled masks stay small
+    for atype in ('label', 'prob'):
+
+        atlas  = _random_atlas(atype, res=2, summary=atype == 'prob')
+        ashape = list(atlas.shape[:3])
+        masks  = []
+
+        # Masks in the atlas space, and masks
+        # at twice the atlas resolution, which
+        # need to be resampled
+        for i in range(6):
+            if i % 2:
+                mshape = ashape
+                mxform = atlas.voxToWorldMat
+            else:
+                mshape = [s * 2 for s in ashape]
+                mxform = transform.concat(
+                    atlas.voxToWorldMat,
+                    transform.scaleOffsetXform([0.5] * 3, 0))
+
+            weights = np.random.random(mshape)
+            weights[weights < 0.7] = 0
+            masks.append(fslimage.Image(weights, xform=mxform))
+
+        result = atlas.maskProportionMatrix(masks)
+
+        assert result.shape == (6, len(atlas.desc.labels))
+
+        for mask, props in zip(masks, result):
+
+            if isinstance(atlas, fslatlases.LabelAtlas):
+                vals, mprops = atlas.maskLabel(mask)
+                expected     = np.zeros(len(atlas.desc.labels))
+                for v, p in zip(vals, mprops):
+                    expected[atlas.find(value=v).index] = p
+            else:
+                expected = atlas.maskProportions(mask)
+
+            assert np.all(np.isclose(props, expected))
+
+        # A 4D stack of masks in the atlas space
+        stack = fslimage.Image(np.stack([m[:] for m in masks[1::2]], axis=-1),
+                               xform=atlas.voxToWorldMat)
+
+        assert np.all(np.isclose(atlas.maskProportionMatrix(stack),
+                                 result[1::2]))
+
+        # Masks not in the atlas space
+        badmask = fslimage.Image(np.ones(ashape),
+                                 xform=transform.scaleOffsetXform([3] * 3, 0))
+        with pytest.raises(fslatlases.MaskError):
+            atlas.maskProportionMatrix([masks[1], badmask])
+
+
+def test_sparse_prob_atlas(seed):
+
+    with testdir() as td:
+
+        cachedir = os.path.join(td, 'cache')
+
+        def filePath(path=None):
+            return os.path.join(cachedir, path)
+
+        with mock.patch('fsl.utils.settings.filePath', filePath):
+            desc   = fslatlases.getAtlasDescription('harvardoxford-cortical')
+            dense  = _get_atlas('harvardoxford-cortical', 2)
+            atlas  = fslatlases.ProbabilisticAtlas(desc, 2, useSparse=True)
+
+            # The range of the image data
+            # is not calculated up front
+            with mock.patch('fsl.data.image.Image.calcRange') as calcRange:
+                cached = fslatlases.ProbabilisticAtlas(desc, 2, useSparse=True)
+                assert calcRange.call_count == 0
+
+        cacheFile = os.path.join(cachedir, 'atlas_sparse')
+        assert len(os.listdir(cacheFile)) == 1
+        assert not atlas.nibImage.in_memory
+
+        data = dense[:]
+        assert np.all(atlas.sparseData.toarray() ==
+                      data.reshape((-1, data.shape[3])))
+        assert np.all(cached.sparseData.toarray() ==
+                      atlas.sparseData.toarray())
+        assert np.all(np.isclose(cached.dataRange, (data.min(), data.max())))
+
+        shape  = np.array(atlas.shape[:3])
+        voxels = np.random.randint(-5, shape.max() + 5, (50, 3))
+
+        assert np.all(np.isclose(atlas.coordProportions(voxels, voxel=True),
+                                 dense.coordProportions(voxels, voxel=True),
+                                 equal_nan=True))
+
+        for v in voxels:
+            v = [int(c) for c in v]
+            assert np.all(np.isclose(atlas.coordProportions(v, voxel=True),
+                                     dense.coordProportions(v, voxel=True)))
+
+        weights = np.random.random(atlas.shape[:3])
+        weights[weights < 0.8] = 0
+        mask    = fslimage.Image(weights, xform=atlas.voxToWorldMat)
+
+        assert np.all(np.isclose(atlas.maskProportions(mask),
+                                 dense.maskProportions(mask)))
+
+
+def test_labelImage(seed):
+
+    for atype in ('label', 'prob'):
+
+        atlas = _random_atlas(atype, res=2)
+
+        # A 3mm image which covers, and
+        # extends beyond, the atlas
+        xform  = transform.scaleOffsetXform([3, 3, 3], [-100, -130, -80])
+        data   = np.random.random((70, 80, 65))
+        image  = fslimage.Image(data, xform=xform)
+
+        for threshold, chunkSize in it.product((None, 0.5), (None, 100000)):
+
+            labels, counts = atlas.labelImage(image,
+                                              threshold=threshold,
+                                              chunkSize=chunkSize)
+
+            assert labels.shape == data.shape
+            assert counts.shape == (len(atlas.desc.labels), )
+
+            voxels = np.array(np.meshgrid(*[np.arange(d) for d in data.shape],
+                                          indexing='ij')).reshape(3, -1).T
+            coords = transform.transform(voxels, xform)
+
+            if isinstance(atlas, fslatlases.LabelAtlas):
+                expected = atlas.coordLabels(coords)
+                expected[np.isnan(expected)] = 0
+            else:
+                props    = atlas.coordProportions(coords)
+                values   = np.array([l.value for l in atlas.desc.labels])
+                best     = np.argmax(np.nan_to_num(props), axis=1)
+                expected = values[best]
+                expected[~(np.nanmax(props, axis=1) > 0)] = 0
+
+            expected = expected.reshape(data.shape)
+
+            if threshold is not None:
+                expected[data <= threshold] = 0
+
+            assert np.all(labels == expected)
+
+            # 0 is also used for unlabelled voxels
+            for label, count in zip(atlas.desc.labels, counts):
+                if label.value != 0:
+                    assert count == np.count_nonzero(labels == label.value)
+
+
+def test_labelImage_slabSize(seed):
+
+    atlas = _random_atlas('prob', res=2)
+    nvols = atlas.shape[3]
+    xform = transform.scaleOffsetXform([4, 4, 4], [-100, -130, -80])
+    image = fslimage.Image(np.random.random((50, 60, 50)), xform=xform)
+
+    import fsl.data.imagewrapper as imagewrapper
+
+    calcVolumeChunks = imagewrapper.calcVolumeChunks
+    slabs            = []
+
+    def calc(shape, volDim, itemsize, chunkSize):
+        result = calcVolumeChunks(shape, volDim, itemsize, chunkSize)
+        slabs.append((itemsize, result))
+        return result
+
+    chunkSize = 1000000
+
+    with mock.patch('fsl.data.imagewrapper.calcVolumeChunks', calc):
+        labels, counts = atlas.labelImage(image, chunkSize=chunkSize)
+
+    # Slabs are sized according to the atlas
+    # data, and the resolution difference, too
+    itemsize, result = slabs[0]
+    assert itemsize >= 24 + atlas.dtype.itemsize * nvols * 8
+
+    for zlo, zhi in result:
+        assert zhi - zlo == 1 or \
+            (zhi - zlo) * 50 * 60 * itemsize <= chunkSize
+
+    assert np.all(labels == atlas.labelImage(image)[0])
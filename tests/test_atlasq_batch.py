@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# test_atlasq_batch.py -
+#
+# Author: Paul McCarthy <pauldmccarthy@gmail.com>
+#
+
+
+import              os
+import os.path   as op
+import              csv
+import              json
+import itertools as it
+import numpy     as np
+import six
+import mock
+
+import fsl.utils.transform as transform
+import fsl.data.atlases    as fslatlases
+import fsl.data.image      as fslimage
+import fsl.scripts.atlasq  as fslatlasq
+
+from . import (tempdir,
+               make_random_mask)
+
+
+def setup_module():
+    if os.environ.get('FSLDIR', None) is None:
+        raise Exception('FSLDIR is not set - atlas tests cannot be run')
+
+
+def _expected(atlas, stype, sources):
+    """Returns the expected (type, index, proportion) rows for the given
+    queries, calculated with the coordQuery/maskQuery functions.
+    """
+
+    if stype == 'mask':
+        images        = [fslimage.Image(s) for s in sources]
+        labels, props = fslatlasq.maskQuery(atlas, images)
+    else:
+        labels, props = fslatlasq.coordQuery(atlas, sources, stype == 'voxel')
+
+    rows = []
+
+    for source, ls, ps in zip(sources, labels, props):
+
+        ls = [l for l in ls if l is not None]
+        ps = [p for p in ps if p is not None] or [None] * len(ls)
+
+        if len(ls) == 0:
+            rows.append((stype, None, None))
+        for l, p in zip(ls, ps):
+            rows.append((stype, l, p))
+
+    return rows
+
+
+def test_batch(seed):
+
+    fslatlases.rescanAtlases()
+
+    for atlasID, label, fmt in it.product(('harvardoxford-cortical',
+                                           'talairach'),
+                                          (False, True),
+                                          ('csv', 'json')):
+
+        atlas = fslatlases.loadAtlas(atlasID, loadSummary=label,
+                                     resolution=2, cache=True)
+
+        with tempdir() as td:
+
+            shape  = np.array(atlas.shape[:3])
+            voxels = np.random.randint(-5, shape.max() + 5, (25, 3))
+            coords = transform.transform(voxels, atlas.voxToWorldMat)
+            masks  = []
+
+            for i in range(3):
+                fname = op.join(td, 'mask{}.nii.gz'.format(i))
+                make_random_mask(fname, atlas.shape[:3],
+                                 atlas.voxToWorldMat)
+                masks.append(fname)
+
+            np.save('coords.npy', coords)
+            np.savetxt('voxels.csv', voxels, delimiter=',', fmt='%d')
+
+            with open('masks.txt', 'wt') as f:
+                f.write('# masks\n')
+                for m in masks:
+                    f.write('{}\n'.format(op.basename(m)))
+
+            args = ['batch', atlasID, '-r', '2',
+                    '-c', 'coords.npy',
+                    '-v', 'voxels.csv',
+                    '-m', 'masks.txt',
+                    '-f', fmt,
+                    '-o', 'out.txt']
+            if label:
+                args.append('-l')
+
+            fslatlasq.main(args)
+
+            expected = _expected(atlas, 'coordinate', coords) + \
+                       _expected(atlas, 'voxel',      voxels) + \
+                       _expected(atlas, 'mask',       masks)
+
+            with open('out.txt', 'rt') as f:
+                if fmt == 'csv':
+                    rows = list(csv.reader(f))[1:]
+                    got  = [(r[0],
+                             int(r[2])   if r[2] != '' else None,
+                             float(r[4]) if r[4] != '' else None)
+                            for r in rows]
+                    assert all(r[5] == '' for r in rows)
+                else:
+                    got = []
+                    for line in f:
+                        result = json.loads(line)
+                        if len(result['indices']) == 0:
+                            got.append((result['type'], None, None))
+                        for l, p in zip(result['indices'],
+                                        result['proportions']):
+                            got.append((result['type'], l, p))
+
+            assert len(got) == len(expected)
+
+            for g, e in zip(got, expected):
+                assert g[:2] == e[:2]
+                if e[2] is None: assert g[2] is None
+                else:            assert np.isclose(g[2], e[2], atol=1e-4)
+
+
+def test_loadCoordinates():
+
+    coords = np.random.random((10, 3))
+
+    with tempdir():
+        np.save('coords.npy', coords)
+        np.savetxt('coords.csv', coords, delimiter=',')
+        np.savetxt('coords.tsv', coords, delimiter='\t')
+        np.savetxt('coords.txt', coords, header='x y z')
+        np.savetxt('coord.txt',  coords[:1])
+
+        for fname in ('coords.npy', 'coords.csv', 'coords.tsv', 'coords.txt'):
+            assert np.all(np.isclose(fslatlasq.loadCoordinates(fname),
+                                     coords))
+
+        assert fslatlasq.loadCoordinates('coord.txt').shape == (1, 3)
+
+
+def test_batchMaskQuery():
+
+    def maskQuery(atlas, masks):
+        if any(m.shape != (10, 10, 10) for m in masks):
+            raise fslatlases.MaskError('Mask is not in the atlas space')
+        return [[1]] * len(masks), [[0.5]] * len(masks)
+
+    with tempdir() as td, \
+         mock.patch('fsl.scripts.atlasq.maskQuery', maskQuery):
+
+        make_random_mask('good1.nii.gz', (10, 10, 10), np.eye(4))
+        make_random_mask('good2.nii.gz', (10, 10, 10), np.eye(4))
+        make_random_mask('badspace.nii.gz', (20, 20, 20), np.eye(4))
+        with open('corrupt.nii.gz', 'wt') as f:
+            f.write('not an image')
+
+        masks = [op.join(td, f) for f in ('good1.nii.gz',
+                                          'missing.nii.gz',
+                                          'badspace.nii.gz',
+                                          'corrupt.nii.gz',
+                                          'good2.nii.gz')]
+
+        labels, props, errors = fslatlasq.batchMaskQuery(None, masks)
+
+        assert labels == [[1], [], [], [], [1]]
+        assert props  == [[0.5], [], [], [], [0.5]]
+        assert errors[0] is None and errors[4] is None
+        assert 'atlas space' in errors[2]
+        assert all(e is not None for e in errors[1:4])
+
+        # Failed masks are written out
+        # with their error message, and
+        # the other masks are unaffected
+        for fmt in ('csv', 'json'):
+            outf   = six.StringIO()
+            writer = fslatlasq.batchWriter(None, outf, fmt)
+            writer('mask', masks[1:4], labels[1:4], props[1:4], errors[1:4])
+
+            if fmt == 'csv':
+                rows = list(csv.reader(outf.getvalue().split('\n')))[1:-1]
+                assert [r[1] for r in rows] == masks[1:4]
+                assert [r[5] for r in rows] == errors[1:4]
+                assert all(r[2:5] == ['', '', ''] for r in rows)
+            else:
+                rows = [json.loads(l) for l in outf.getvalue().split('\n')
+                        if l != '']
+                assert [r['source'] for r in rows] == masks[1:4]
+                assert [r['error']  for r in rows] == errors[1:4]
+                assert all(r['indices'] == [] for r in rows)
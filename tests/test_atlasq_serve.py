@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# test_atlasq_serve.py -
+#
+# Author: Paul McCarthy <pauldmccarthy@gmail.com>
+#
+
+
+import              os
+import os.path   as op
+import              socket
+import              threading
+
+import mock
+import pytest
+
+import fsl.data.atlases   as fslatlases
+import fsl.scripts.atlasq as fslatlasq
+
+from . import (tempdir,
+               make_random_mask,
+               CaptureStdout)
+
+
+def setup_module():
+    if os.environ.get('FSLDIR', None) is None:
+        raise Exception('FSLDIR is not set - atlas tests cannot be run')
+
+
+def _in_process(args):
+    """Runs atlasq with the given arguments without a server, returning
+    the exit status and standard output.
+    """
+    capture = CaptureStdout()
+    with capture, mock.patch('fsl.scripts.atlasq.clientRequest',
+                             return_value=None):
+        status = fslatlasq.main(args)
+    return status, capture.stdout
+
+
+def test_serve(seed):
+
+    fslatlases.rescanAtlases()
+
+    with tempdir() as td:
+
+        sockPath = op.join(td, 'atlasq.sock')
+        server   = fslatlasq.makeServer(sockPath)
+        thread   = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        atlas = fslatlases.loadAtlas('harvardoxford-cortical',
+                                     loadSummary=True,
+                                     resolution=2)
+        make_random_mask('mask.nii.gz', atlas.shape, atlas.voxToWorldMat)
+
+        tests = [
+            ['summary', 'talairach'],
+            ['summary', 'non-existent-atlas'],
+            ['query', 'harvardoxford-cortical', '-r', '2',
+             '-c', '0', '0', '0'],
+            ['query', 'harvardoxford-cortical', '-r', '2', '-m', 'mask'],
+            ['query', 'talairach', '-s', '-v', '20', '20', '20'],
+            ['ohi', '-a', 'Talairach Daemon Labels', '-c', '0,0,0'],
+        ]
+
+        try:
+            for args in tests:
+                expstatus, expstdout = _in_process(list(args))
+                status, stdout, stderr = fslatlasq.clientRequest(
+                    list(args), sockPath, timeout=60)
+
+                assert status == expstatus
+                assert stdout == expstdout
+
+            # main sends requests to
+            # the server at $ATLASQ_SOCKET
+            with mock.patch.dict('os.environ', {'ATLASQ_SOCKET' : sockPath}):
+                capture = CaptureStdout()
+                with capture:
+                    assert fslatlasq.main(list(tests[0])) == 0
+                assert capture.stdout == _in_process(list(tests[0]))[1]
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # stale socket file, and no server - the
+        # client falls back to in-process execution
+        assert fslatlasq.clientRequest(tests[0], sockPath) is None
+        os.remove(sockPath)
+        assert fslatlasq.clientRequest(tests[0], sockPath) is None
+
+        with mock.patch.dict('os.environ', {'ATLASQ_SOCKET' : sockPath}):
+            capture = CaptureStdout()
+            with capture:
+                assert fslatlasq.main(list(tests[0])) == 0
+            assert capture.stdout == _in_process(list(tests[0]))[1]
+
+
+def test_socketPath():
+
+    with mock.patch.dict('os.environ', {'ATLASQ_SOCKET' : '/a/b.sock'}):
+        assert fslatlasq.socketPath() == '/a/b.sock'
+
+    with mock.patch.dict('os.environ'):
+        os.environ.pop('ATLASQ_SOCKET', None)
+        sockPath = fslatlasq.socketPath()
+
+    assert op.basename(op.dirname(sockPath)) == \
+        'atlasq-{}'.format(os.getuid())
+
+
+def test_checkSocketPath():
+
+    with tempdir() as td:
+
+        # The socket directory is created
+        # with no access for other users
+        sockdir  = op.join(td, 'sockdir')
+        sockPath = op.join(sockdir, 'atlasq.sock')
+
+        fslatlasq.checkSocketPath(sockPath, create=True)
+        assert op.isdir(sockdir)
+        assert os.stat(sockdir).st_mode & 0o777 == 0o700
+
+        # Directories which can be
+        # written by others are refused
+        os.chmod(sockdir, 0o777)
+        with pytest.raises(fslatlasq.SocketError):
+            fslatlasq.checkSocketPath(sockPath)
+        os.chmod(sockdir, 0o700)
+
+        # Anything other than a socket
+        # at the path is refused
+        with open(sockPath, 'wt') as f:
+            f.write('not a socket')
+        with pytest.raises(fslatlasq.SocketError):
+            fslatlasq.checkSocketPath(sockPath)
+        with pytest.raises(fslatlasq.SocketError):
+            fslatlasq.makeServer(sockPath)
+        assert fslatlasq.clientRequest(['summary', 'talairach'],
+                                       sockPath) is None
+        assert op.exists(sockPath)
+        os.remove(sockPath)
+
+        # Sockets and directories owned
+        # by other users are refused
+        server = fslatlasq.makeServer(sockPath)
+
+        try:
+            assert os.stat(sockPath).st_mode & 0o777 == 0o600
+            fslatlasq.checkSocketPath(sockPath)
+
+            with mock.patch('os.getuid', return_value=os.getuid() + 1):
+                with pytest.raises(fslatlasq.SocketError):
+                    fslatlasq.checkSocketPath(sockPath)
+                with pytest.raises(fslatlasq.SocketError):
+                    fslatlasq.makeServer(sockPath)
+                assert fslatlasq.clientRequest(['summary', 'talairach'],
+                                               sockPath) is None
+
+            assert op.exists(sockPath)
+
+        finally:
+            server.server_close()
+
+
+def test_clientRequest_timeout():
+
+    with tempdir() as td:
+
+        # A server which never responds - the
+        # client gives up, and main falls back
+        # to running the command in-process
+        sockPath = op.join(td, 'atlasq.sock')
+        sock     = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            sock.bind(sockPath)
+            sock.listen(1)
+
+            assert fslatlasq.clientRequest(['list'],
+                                           sockPath,
+                                           timeout=0.5) is None
+
+            with mock.patch.dict('os.environ', {'ATLASQ_SOCKET' : sockPath}), \
+                 mock.patch('fsl.scripts.atlasq.SERVER_TIMEOUT', 0.5):
+                capture = CaptureStdout()
+                with capture:
+                    status = fslatlasq.main(['summary', 'talairach'])
+                assert (status, capture.stdout) == \
+                    _in_process(['summary', 'talairach'])
+        finally:
+            sock.close()
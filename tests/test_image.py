@@ -785,6 +785,195 @@ def _test_Image_changeData(imgtype):
         shutil.rmtree(testdir)
 
 
+def test_readHeader():
+
+    with tempdir():
+
+        files = [('analyze.img',    nib.AnalyzeImage),
+                 ('nifti1a.nii',    nib.Nifti1Image),
+                 ('nifti1.nii.gz',  nib.Nifti1Image),
+                 ('nifti1pair.img', nib.Nifti1Pair),
+                 ('nifti2a.nii',    nib.Nifti2Image),
+                 ('nifti2.nii.gz',  nib.Nifti2Image),
+                 ('nifti2pair.img', nib.Nifti2Pair)]
+
+        for fname, ctype in files:
+
+            data  = np.random.random((10, 11, 12, 3)).astype(np.float32)
+            xform = np.diag([1.5, 2, 2.5, 1])
+
+            nib.save(ctype(data, xform), fname)
+
+            hdr      = fslimage.readHeader(fname)
+            expected = nib.load(fname).header
+
+            # nibabel resets the scaling parameters
+            # on loaded image headers, so we can't
+            # compare the raw header bytes
+            assert type(hdr) == type(expected)
+            assert hdr.get_data_shape() == expected.get_data_shape()
+            assert hdr.get_data_dtype() == expected.get_data_dtype()
+            assert hdr.get_zooms()      == expected.get_zooms()
+            assert np.all(np.isclose(hdr     .get_best_affine(),
+                                     expected.get_best_affine()))
+
+            # Nifti objects created from the header
+            # should be the same as Image objects
+            nifti = fslimage.Nifti(hdr)
+            img   = fslimage.Image(fname, loadData=False)
+            assert nifti.shape  == img.shape
+            assert nifti.pixdim == img.pixdim
+            assert np.all(np.isclose(nifti.voxToWorldMat, img.voxToWorldMat))
+
+            # extension not needed
+            hdr2 = fslimage.readHeader(fslimage.removeExt(fname))
+            assert hdr2.binaryblock == hdr.binaryblock
+
+        # headers are cached, but copies
+        # are returned, so callers can't
+        # modify the cached copy
+        hdr1 = fslimage.readHeader('nifti1.nii.gz')
+        hdr1['descrip'] = b'modified'
+        hdr2 = fslimage.readHeader('nifti1.nii.gz')
+        assert hdr2['descrip'] != b'modified'
+
+        # and the cache notices if
+        # the file has changed
+        make_image('nifti1.nii.gz', 1, (5, 6, 7), (1, 1, 1))
+        st = os.stat('nifti1.nii.gz')
+        os.utime('nifti1.nii.gz', (st.st_atime, st.st_mtime + 10))
+        assert fslimage.Nifti(fslimage.readHeader('nifti1.nii.gz')).shape == \
+            (5, 6, 7)
+
+        # Not an image
+        with open('notimage.nii', 'wb') as f:
+            f.write(b'a' * 500)
+        with pytest.raises(ValueError):
+            fslimage.readHeader('notimage.nii')
+
+        with pytest.raises(fslimage.PathError):
+            fslimage.readHeader('nonexistent.nii.gz')
+
+
+def test_Image_batchEdit():
+    with tempdir():
+        _test_Image_batchEdit()
+def _test_Image_batchEdit():
+
+    data = np.random.random((10, 10, 10)) + 1
+    img  = fslimage.Image(data)
+    img.save('image.nii.gz')
+
+    notified = {'data' : [], 'saveState' : 0, 'dataRange' : 0}
+
+    def onData(i, topic, value):
+        notified['data'].append(value)
+    def onSaveState(*a):
+        notified['saveState'] += 1
+    def onDataRange(*a):
+        notified['dataRange'] += 1
+
+    img.register('name1', onData,      'data')
+    img.register('name2', onSaveState, 'saveState')
+    img.register('name3', onDataRange, 'dataRange')
+
+    with img.batchEdit():
+        img[1, 2, 3]       = 5
+        img[4, 5, 6]       = -5
+        img[2:4, 2:4, 8]   = np.full((2, 2), 1.5)
+
+        # nested batches are
+        # merged into one
+        with img.batchEdit():
+            img[0, 9, 0] = 10
+
+        assert notified == {'data' : [], 'saveState' : 0, 'dataRange' : 0}
+
+    assert len(notified['data'])  == 1
+    assert notified['saveState']  == 1
+    assert notified['dataRange']  == 1
+    assert notified['data'][0]    == (slice(0, 5, 1),
+                                      slice(2, 10, 1),
+                                      slice(0, 9, 1))
+    assert img.dataRange          == (-5, 10)
+    assert img[4, 5, 6]           == -5
+    assert np.all(img[2:4, 2:4, 8] == 1.5)
+
+    # No dataRange notification
+    # if the range didn't change
+    with img.batchEdit():
+        img[5, 5, 5] = 2
+        img[6, 6, 6] = 3
+
+    assert len(notified['data'])  == 2
+    assert notified['saveState']  == 1
+    assert notified['dataRange']  == 1
+
+    # Notification is still emitted
+    # if an error occurs in the batch
+    with pytest.raises(ValueError):
+        with img.batchEdit():
+            img[7, 7, 7] = 20
+            raise ValueError()
+
+    assert len(notified['data'])  == 3
+    assert notified['dataRange']  == 2
+    assert notified['data'][2]    == (slice(7, 8, 1),
+                                      slice(7, 8, 1),
+                                      slice(7, 8, 1))
+
+    # Outside of a batch, notifications
+    # are emitted on every write
+    img[1, 1, 1] = 1
+    img[1, 1, 2] = 1
+    assert len(notified['data'])  == 5
+
+
+def test_Image_batchEdit_deferredRange():
+
+    data = np.random.random((10, 10, 10)) + 1
+    data[0, 0, 0] = 20
+    data[9, 9, 9] = 0
+    img  = fslimage.Image(data.copy())
+
+    assert img.dataRange == (0, 20)
+
+    calls   = [0]
+    wrapper = img._Image__imageWrapper
+    update  = wrapper._ImageWrapper__updateDataRangeOnWrite
+
+    def countUpdate(*args):
+        calls[0] += 1
+        return update(*args)
+
+    wrapper._ImageWrapper__updateDataRangeOnWrite = countUpdate
+
+    # Overwrite both extrema - the range
+    # should only be updated once, at
+    # the end of the batch
+    with img.batchEdit():
+        img[0, 0, 0]     = 1.5
+        img[9, 9, 9]     = 1.5
+        img[5, 5, 5]     = 1.5
+        img[2:4, 2:4, 8] = np.full((2, 2), 1.5)
+        assert calls[0] == 0
+
+    data[0, 0, 0]     = 1.5
+    data[9, 9, 9]     = 1.5
+    data[5, 5, 5]     = 1.5
+    data[2:4, 2:4, 8] = 1.5
+
+    assert calls[0] == 1
+    assert np.all(np.isclose(img.dataRange, (data.min(), data.max())))
+
+    # Outside of a batch, the range
+    # is updated on every write
+    img[1, 1, 1] = -1
+    img[1, 1, 2] = 30
+    assert calls[0]      == 3
+    assert img.dataRange == (-1, 30)
+
+
 def  test_Image_2D_analyze(): _test_Image_2D(0)
 def  test_Image_2D_nifti1():  _test_Image_2D(1)
 def  test_Image_2D_nifti2():  _test_Image_2D(2)
@@ -1169,3 +1358,29 @@ def _test_Image_init_xform(imgtype):
         assert np.all(np.isclose(xform,  rxform))
         assert fsform_code == sform_code
         assert fqform_code == qform_code
+
+
+def  test_Image_mmap_analyze(): _test_Image_mmap(0)
+def  test_Image_mmap_nifti1():  _test_Image_mmap(1)
+def  test_Image_mmap_nifti2():  _test_Image_mmap(2)
+def _test_Image_mmap(imgtype):
+
+    with tempdir() as td:
+
+        fname = op.join(td, 'image')
+        nimg  = make_image(fname, imgtype, dims=(10, 11, 12, 5),
+                           pixdims=(1, 1, 1, 1))
+        data  = nimg.get_data()
+
+        img     = fslimage.Image(fname, loadData=False, mmap=True)
+        wrapper = img.getImageWrapper()
+
+        assert wrapper.memmap is not None
+        assert np.all(np.isclose(img[..., 2], data[..., 2]))
+        assert np.all(np.isclose(img[:],      data))
+        assert np.all(np.isclose(img.dataRange, (data.min(), data.max())))
+
+        # mmap is ignored if loadData is True
+        img = fslimage.Image(fname, mmap=True)
+        assert img.getImageWrapper().memmap is None
+        assert np.all(np.isclose(img[:], data))
@@ -5,9 +5,12 @@
 # Author: Paul McCarthy <pauldmccarthy@gmail.com>
 #
 
+import            os
 import os.path as op
 import            time
 
+import mock
+
 import numpy   as np
 import nibabel as nib
 
@@ -268,3 +271,174 @@ def _test_image_calcRange(threaded):
     if threaded:
         img.getImageWrapper().getTaskThread().waitUntilIdle()
     assert img.dataRange == (0, 1)
+
+
+def test_image_indexed_indexCache():
+
+    with tests.testdir() as testdir:
+
+        filename = op.join(testdir, 'image.nii.gz')
+        cachedir = op.join(testdir, 'cache')
+        data     = np.random.random((50, 50, 50, 10))
+
+        def filePath(path=None):
+            return op.join(cachedir, path)
+
+        fslimage.Image(data).save(filename)
+
+        with mock.patch('fsl.utils.settings.filePath', filePath):
+
+            cacheFile = fslimage.indexCacheFile(filename)
+
+            assert cacheFile is not None
+            assert op.dirname(cacheFile) == op.join(cachedir, 'indexed_gzip')
+            assert not op.exists(cacheFile)
+
+            # index is not saved when the image is
+            # garbage collected, only when it is
+            # explicitly closed. The data range is
+            # not calculated, so the index is only
+            # built up to the volumes that are read.
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+            assert np.all(np.isclose(img[..., 1], data[..., 1]))
+            del img
+            assert not op.exists(cacheFile)
+
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+            assert np.all(np.isclose(img[..., 1], data[..., 1]))
+            img.close()
+            img.close()
+            assert op.exists(cacheFile)
+            partialSize = op.getsize(cacheFile)
+
+            # and imported when it is re-opened. An
+            # index which has not grown is not saved.
+            img  = fslimage.Image(filename,
+                                  loadData=False,
+                                  calcRange=False,
+                                  indexed=True)
+            fobj = img._Image__fileobj
+            assert fobj._index_cache_loaded
+            assert fobj._index_cache_size == partialSize
+            mtime = os.stat(cacheFile).st_mtime
+            time.sleep(0.01)
+            img.close()
+            assert os.stat(cacheFile).st_mtime == mtime
+            assert op.getsize(cacheFile)       == partialSize
+
+            # An imported index which has grown
+            # since is saved over the old one
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+            assert np.all(np.isclose(img[..., 9], data[..., 9]))
+            img.close()
+            assert op.getsize(cacheFile) > partialSize
+            assert [f for f in os.listdir(op.dirname(cacheFile))
+                    if not f.startswith('.')] == [op.basename(cacheFile)]
+
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+            assert np.all(np.isclose(img[..., 7], data[..., 7]))
+            img.close()
+
+            # a modified file gets a new index,
+            # and the old one is cleared out
+            time.sleep(0.01)
+            data = np.random.random((50, 50, 50, 10))
+            fslimage.Image(data).save(filename)
+
+            newCacheFile = fslimage.indexCacheFile(filename)
+            assert newCacheFile != cacheFile
+
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+            assert not img._Image__fileobj._index_cache_loaded
+            assert np.all(np.isclose(img[..., 3], data[..., 3]))
+            img.close()
+
+            assert     op.exists(newCacheFile)
+            assert not op.exists(cacheFile)
+
+        # No caching if settings is not initialised
+        assert fslimage.indexCacheFile(filename) is None
+
+
+def test_image_indexed_save_preserveState():
+
+    with tests.testdir() as testdir:
+
+        filename = op.join(testdir, 'image.nii.gz')
+        cachedir = op.join(testdir, 'cache')
+
+        def filePath(path=None):
+            return op.join(cachedir, path)
+
+        data = np.zeros((50, 50, 50, 20))
+        for vol in range(data.shape[-1]):
+            data[..., vol] = vol
+
+        fslimage.Image(data).save(filename)
+
+        with mock.patch('fsl.utils.settings.filePath', filePath):
+
+            img = fslimage.Image(filename,
+                                 loadData=False,
+                                 calcRange=False,
+                                 indexed=True)
+
+            img[..., 5]
+            img[..., 10] = np.zeros((50, 50, 50)) + 30
+
+            cov5  = img.getImageWrapper().coverage(5)
+            cov10 = img.getImageWrapper().coverage(10)
+
+            img.save()
+
+            # data range and coverage carried
+            # over to the new image wrapper
+            wrapper = img.getImageWrapper()
+            assert img.dataRange == (5, 30)
+            assert np.all(wrapper.coverage(5)  == cov5)
+            assert np.all(wrapper.coverage(10) == cov10)
+            assert np.all(np.isnan(wrapper.coverage(15)))
+
+            # The new index has been saved
+            # to the index cache
+            assert op.exists(fslimage.indexCacheFile(filename))
+
+            assert np.all(img[..., 10] == 30)
+            assert np.all(img[..., 19] == 19)
+            assert img.dataRange == (5, 30)
+
+
+def test_image_calcRange_chunked():
+
+    data = np.random.random((10, 10, 10, 12))
+    img  = fslimage.Image(data, calcRange=False, loadData=False)
+
+    pcts = img.calcRange(chunkSize=data[..., 0].nbytes * 5,
+                         nthreads=3,
+                         percentiles=[5, 95])
+
+    assert np.all(np.isclose(img.dataRange, (data.min(), data.max())))
+    assert pcts.shape == (12, 2)
+    for vol in range(12):
+        assert np.all(np.isclose(pcts[vol],
+                                 np.percentile(data[..., vol], [5, 95])))
+
+    # No percentiles when the range
+    # is calculated from a sample
+    img = fslimage.Image(data, calcRange=False, loadData=False)
+    assert img.calcRange(100, percentiles=[50]) is None
@@ -13,11 +13,14 @@ import              time
 import itertools as it
 import numpy     as np
 import nibabel   as nib
+import pytest
 
 
 import fsl.data.image        as image
 import fsl.data.imagewrapper as imagewrap
 
+from . import tempdir
+
 
 real_print = print
 def print(*args, **kwargs):
@@ -329,6 +332,36 @@ def test_naninfrange():
         elif np.isinf(   expected[1]): assert np.isinf(result[1]) 
 
 
+
+def test_naninfrangePerVolume():
+
+    data = np.random.random((10, 10, 10, 6))
+
+    data[1, 1, 1, 1] = np.nan
+    data[2, 2, 2, 2] = np.inf
+    data[3, 3, 3, 3] = -np.inf
+    data[..., 4]     = np.nan
+    data[..., 5]     = np.inf
+
+    result = imagewrap.naninfrangePerVolume(data)
+
+    assert result.shape == (6, 2)
+
+    for vol in range(4):
+        expected = imagewrap.naninfrange(data[..., vol])
+        assert np.all(np.isclose(result[vol], expected))
+
+    assert np.all(np.isnan(result[4]))
+    assert np.all(np.isnan(result[5]))
+
+    # Integer data
+    data   = np.random.randint(-100, 100, (5, 5, 8))
+    result = imagewrap.naninfrangePerVolume(data)
+
+    for vol in range(8):
+        assert tuple(result[vol]) == (data[..., vol].min(),
+                                      data[..., vol].max())
+
 def test_adjustCoverage():
 
     # TODO Randomise
@@ -1314,3 +1347,445 @@ def test_4D_indexing(shape=None, img=None):
     img[:, 0, :, :] = [[[999] * shape[0]] * shape[2]] * shape[3]
     img[:, :, 0, :] = [[[999] * shape[0]] * shape[1]] * shape[3]
     img[:, :, :, 0] = [[[999] * shape[0]] * shape[1]] * shape[2]
+
+
+def test_ImageWrapper_mmap():
+
+    with tempdir():
+
+        data  = np.random.random((10, 11, 12, 13))
+        fname = 'image.nii'
+        nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+
+        wrapper = imagewrap.ImageWrapper(nib.load(fname), mmap=True)
+
+        assert isinstance(wrapper.memmap, np.memmap)
+        assert wrapper.scaling == (1.0, 0.0)
+
+        # Accesses should return views
+        # into the memory map, without
+        # copying the data
+        vol = wrapper[..., 3]
+        assert np.all(np.isclose(vol, data[..., 3]))
+        assert np.may_share_memory(vol, wrapper.memmap)
+        assert not vol.flags.writeable
+
+        assert np.all(np.isclose(wrapper[2, 3, 4, :], data[2, 3, 4, :]))
+        assert np.isclose(wrapper[2, 3, 4, 5], data[2, 3, 4, 5])
+
+        # Fancy indexing is supported
+        mask = data > 0.5
+        assert np.all(np.isclose(wrapper[mask], data[mask]))
+
+        # Data range is calculated as normal
+        wrapper[:]
+        assert wrapper.covered
+        assert np.all(np.isclose(wrapper.dataRange,
+                                 (data.min(), data.max())))
+
+        # Writes cause the data to be loaded
+        # into memory, and subsequent reads
+        # come from the in-memory array
+        wrapper[0, 0, 0, 0] = 999
+        assert wrapper[0, 0, 0, 0] == 999
+        assert np.isclose(wrapper.memmap[0, 0, 0, 0], data[0, 0, 0, 0])
+
+
+def test_ImageWrapper_mmap_scaled():
+
+    with tempdir():
+
+        data  = np.random.randint(0, 100, (10, 11, 12)).astype(np.int16)
+        fname = 'image.nii'
+        img   = nib.Nifti1Image(data, np.eye(4))
+
+        img.header.set_slope_inter(2.5, 10)
+        nib.save(img, fname)
+
+        img     = nib.load(fname)
+        wrapper = imagewrap.ImageWrapper(img, mmap=True)
+
+        assert wrapper.scaling == (2.5, 10.0)
+        assert np.all(wrapper.memmap[:] == data)
+        assert np.all(np.isclose(wrapper[:],        img.get_data()))
+        assert np.all(np.isclose(wrapper[..., 5],   data[..., 5] * 2.5 + 10))
+        assert np.all(np.isclose(wrapper.dataRange, (data.min() * 2.5 + 10,
+                                                     data.max() * 2.5 + 10)))
+
+
+def test_ImageWrapper_mmap_not_possible():
+
+    with tempdir():
+
+        data = np.random.random((10, 11, 12))
+
+        nib.save(nib.Nifti1Image(data, np.eye(4)), 'image.nii.gz')
+
+        # compressed file
+        wrapper = imagewrap.ImageWrapper(nib.load('image.nii.gz'), mmap=True)
+        assert wrapper.memmap is None
+        assert np.all(np.isclose(wrapper[:], data))
+
+        # in-memory image
+        wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)),
+                                         mmap=True)
+        assert wrapper.memmap is None
+        assert np.all(np.isclose(wrapper[:], data))
+
+
+def test_ImageWrapper_copyState():
+
+    data = np.random.random((10, 10, 10, 5))
+    img1 = nib.Nifti1Image(data, np.eye(4))
+    img2 = nib.Nifti1Image(data, np.eye(4))
+    wrp1 = imagewrap.ImageWrapper(img1)
+    wrp2 = imagewrap.ImageWrapper(img2)
+
+    wrp1[..., 2]
+    wrp1[:5, :5, :5, 3]
+
+    wrp2.copyState(wrp1)
+
+    assert wrp2.dataRange == wrp1.dataRange
+    assert wrp2.covered   == wrp1.covered
+    for vol in range(5):
+        assert np.all(np.isclose(wrp2.coverage(vol),
+                                 wrp1.coverage(vol),
+                                 equal_nan=True))
+
+    # state is copied, not shared
+    wrp1[..., 4]
+    assert np.all(np.isnan(wrp2.coverage(4)))
+
+    img3 = nib.Nifti1Image(np.random.random((10, 10, 10, 6)), np.eye(4))
+    with pytest.raises(ValueError):
+        imagewrap.ImageWrapper(img3).copyState(wrp1)
+
+
+def test_ImageWrapper_volumeCache():
+
+    with tempdir():
+
+        filename = 'image.nii.gz'
+        data     = np.random.random((10, 11, 12, 6)).astype(np.float32)
+        volBytes = data[..., 0].nbytes
+
+        nib.save(nib.Nifti1Image(data, np.eye(4)), filename)
+
+        # Room for three volumes
+        nibImg  = nib.load(filename)
+        wrapper = imagewrap.ImageWrapper(nibImg, volumeCacheSize=volBytes * 3)
+
+        assert wrapper.volumeCacheStats() == (0, 0, 0, 0)
+
+        assert np.all(wrapper[..., 0]        == data[..., 0])
+        assert np.all(wrapper[2:5, :, 3, 0]  == data[2:5, :, 3, 0])
+        assert np.all(wrapper[..., 1]        == data[..., 1])
+        assert np.all(wrapper[..., 2]        == data[..., 2])
+        assert np.all(wrapper[:, :, :, 2:3]  == data[:, :, :, 2:3])
+
+        hits, misses, nvols, nbytes = wrapper.volumeCacheStats()
+        assert misses == 3
+        assert hits   >= 2
+        assert nvols  == 3
+        assert nbytes == volBytes * 3
+
+        # volume 0 is least recently used,
+        # so should be dropped from the cache
+        wrapper[..., 3]
+        wrapper[..., 0]
+        hits2, misses2, _, nbytes = wrapper.volumeCacheStats()
+        assert misses2 == misses + 2
+        assert nbytes  == volBytes * 3
+
+        # Multi-volume reads bypass the cache
+        assert np.all(wrapper[..., 1:4] == data[..., 1:4])
+
+        # modifying returned data must
+        # not affect the cache
+        vol = wrapper[..., 0]
+        vol[:] = -1
+        assert np.all(wrapper[..., 0] == data[..., 0])
+
+        # cache is cleared when data is loaded
+        wrapper[0, 0, 0, 0] = 5
+        assert wrapper.volumeCacheStats()[2:] == (0, 0)
+        assert wrapper[0, 0, 0, 0] == 5
+
+        # A 3D image - 2D slices are cached
+        data    = data[..., 0]
+        nibImg  = nib.Nifti1Image(data, np.eye(4))
+        nib.save(nibImg, filename)
+        nibImg  = nib.load(filename)
+        wrapper = imagewrap.ImageWrapper(nibImg, volumeCacheSize=10 ** 6)
+
+        assert np.all(wrapper[:, :, 4] == data[:, :, 4])
+        assert np.all(wrapper[:, 5, 4] == data[:, 5, 4])
+        assert wrapper.volumeCacheStats()[:3] == (1, 1, 1)
+
+
+def test_splitExpansion():
+
+    exp    = [(0, 10), (0, 10), (3, 4)]
+    slices = [(2, 5),  (0, 10), (3, 4)]
+
+    # no data - expansion returned as-is
+    assert imagewrap.splitExpansion(exp, slices, False) == [(exp, False)]
+
+    # no overlap
+    assert imagewrap.splitExpansion(exp, [(12, 15), (0, 10), (3, 4)]) == \
+        [(exp, False)]
+
+    # expansion entirely within slices
+    assert imagewrap.splitExpansion(slices, exp) == [(slices, True)]
+
+    pieces = imagewrap.splitExpansion(exp, slices)
+
+    assert pieces[0] == (slices, True)
+    assert all([not inData for _, inData in pieces[1:]])
+
+    # Pieces must not overlap, and
+    # must fill the expansion
+    mask = np.zeros((10, 10, 10), dtype=np.int)
+    for piece, _ in pieces:
+        mask[tuple(slice(lo, hi) for lo, hi in piece)] += 1
+
+    expected = np.zeros((10, 10, 10), dtype=np.int)
+    expected[tuple(slice(lo, hi) for lo, hi in exp)] = 1
+    assert np.all(mask == expected)
+
+    # random boxes
+    for i in range(50):
+        exp    = [sorted(np.random.choice(11, 2, replace=False))
+                  for d in range(3)]
+        slices = [sorted(np.random.choice(11, 2, replace=False))
+                  for d in range(3)]
+        pieces = imagewrap.splitExpansion(exp, slices)
+
+        mask[:] = 0
+        for piece, inData in pieces:
+            mask[tuple(slice(lo, hi) for lo, hi in piece)] += 1
+            if inData:
+                for (plo, phi), (slo, shi) in zip(piece, slices):
+                    assert plo >= slo and phi <= shi
+
+        expected[:] = 0
+        expected[tuple(slice(lo, hi) for lo, hi in exp)] = 1
+        assert np.all(mask == expected)
+
+
+def test_ImageWrapper_read_reuseData():
+
+    # Each uncovered read should only
+    # need to read the data once
+    with tempdir():
+
+        data = np.random.random((10, 11, 12, 5))
+        nib.save(nib.Nifti1Image(data, np.eye(4)), 'image.nii.gz')
+
+        wrapper = imagewrap.ImageWrapper(nib.load('image.nii.gz'),
+                                         volumeCacheSize=10 ** 7)
+        wrapper[..., 2]
+        assert wrapper.volumeCacheStats()[:2] == (0, 1)
+        assert np.isclose(wrapper.dataRange[0], data[..., 2].min())
+        assert np.isclose(wrapper.dataRange[1], data[..., 2].max())
+
+    # Partially covered reads should give the
+    # same range as reading all of the data
+    data    = np.random.random((20, 20, 20, 3))
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)))
+
+    wrapper[2:8,   5:15, 4:6, 0]
+    wrapper[6:12,  0:10, 3:9, 0]
+    wrapper[0:20, 10:12, 0:5, 0:2]
+
+    cov = wrapper.coverage(0)
+    sub = data[int(cov[0, 0]):int(cov[1, 0]),
+               int(cov[0, 1]):int(cov[1, 1]),
+               int(cov[0, 2]):int(cov[1, 2]), 0]
+    cov = wrapper.coverage(1)
+    sub2 = data[int(cov[0, 0]):int(cov[1, 0]),
+                int(cov[0, 1]):int(cov[1, 1]),
+                int(cov[0, 2]):int(cov[1, 2]), 1]
+
+    assert np.isclose(wrapper.dataRange[0], min(sub.min(), sub2.min()))
+    assert np.isclose(wrapper.dataRange[1], max(sub.max(), sub2.max()))
+
+
+def test_ImageWrapper_read_reuseData_step():
+
+    # Data read with a step cannot be
+    # re-used, as the voxels are not in
+    # the order that the coverage expects
+    data = np.zeros((4, 4, 4, 3))
+    for vol in range(3):
+        data[..., vol] = np.arange(64).reshape((4, 4, 4)) + 10 * vol
+
+    for sliceobj in [(Ellipsis, slice(None, None, -1)),
+                     (slice(None, None, -1), Ellipsis)]:
+
+        image   = nib.Nifti1Image(data.copy(), np.eye(4))
+        wrapper = imagewrap.ImageWrapper(image)
+
+        assert np.all(wrapper[sliceobj] == data[sliceobj])
+        assert np.all(wrapper.volumeRanges() == [[0,  63],
+                                                 [10, 73],
+                                                 [20, 83]])
+
+        wrapper[0, 0, 0, 0] = 50
+        assert wrapper.dataRange == (1, 83)
+
+
+def test_calcVolumeChunks():
+
+    # 10 volumes of 100 bytes each
+    assert imagewrap.calcVolumeChunks((5, 5, 4, 10), 3, 1, 350) == \
+        [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert imagewrap.calcVolumeChunks((5, 5, 4, 10), 3, 1, 10000) == \
+        [(0, 10)]
+
+    # At least one volume per chunk
+    assert imagewrap.calcVolumeChunks((5, 5, 4, 3), 3, 4, 10) == \
+        [(0, 1), (1, 2), (2, 3)]
+
+
+def test_ImageWrapper_calcRange():
+
+    with tempdir():
+
+        data = np.random.random((10, 11, 12, 20)).astype(np.float32)
+        data[..., 3]        = np.nan
+        data[1, 1, 1, 5]    = np.inf
+        data[2, 2, 2, 7]    = 5
+        data[3, 3, 3, 19]   = -5
+
+        nib.save(nib.Nifti1Image(data, np.eye(4)), 'image.nii.gz')
+
+        for nthreads in (1, 4):
+            wrapper = imagewrap.ImageWrapper(nib.load('image.nii.gz'))
+            volbytes = data[..., 0].nbytes
+
+            pcts = wrapper.calcRange(chunkSize=volbytes * 3,
+                                     nthreads=nthreads,
+                                     percentiles=[0, 50, 100])
+
+            assert wrapper.covered
+            assert wrapper.dataRange == (-5, 5)
+
+            ranges = wrapper.volumeRanges()
+            assert ranges.shape == (20, 2)
+            assert pcts.shape   == (20, 3)
+
+            for vol in range(20):
+                vdata = data[..., vol]
+                vdata = vdata[np.isfinite(vdata)]
+
+                if vol == 3:
+                    assert np.all(np.isnan(ranges[vol]))
+                    assert np.all(np.isnan(pcts[vol]))
+                    continue
+
+                assert np.isclose(ranges[vol, 0], vdata.min())
+                assert np.isclose(ranges[vol, 1], vdata.max())
+                assert np.all(np.isclose(
+                    pcts[vol], np.percentile(vdata, [0, 50, 100])))
+
+            # Further reads should
+            # not change anything
+            wrapper[..., 4]
+            assert np.all(np.isclose(wrapper.volumeRanges(), ranges,
+                                     equal_nan=True))
+
+    # 3D image - per-slice ranges
+    data    = np.random.randint(0, 100, (10, 11, 12)).astype(np.int16)
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)))
+
+    assert wrapper.calcRange(chunkSize=1, nthreads=2) is None
+    assert wrapper.covered
+    assert wrapper.dataRange == (data.min(), data.max())
+    assert np.all(wrapper.volumeRanges()[:, 0] == data.min(axis=(0, 1)))
+    assert np.all(wrapper.volumeRanges()[:, 1] == data.max(axis=(0, 1)))
+
+
+def test_ImageWrapper_write_keepCoverage_precision():
+
+    # The known ranges are stored as float32, which
+    # may round the true minimum/maximum of float64
+    # or large integer data. Overwriting them must
+    # still cause the range to be re-calculated.
+    data          = np.zeros((10, 10, 10), dtype=np.float64)
+    data[1, 1, 1] = -0.1
+    data[2, 2, 2] =  0.1
+
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)),
+                                     loadData=True)
+    wrapper[:]
+    wrapper[2, 2, 2] = 0
+    assert np.all(np.isclose(wrapper.dataRange, (-0.1, 0)))
+
+    # 2**25 + 3 is rounded up to
+    # 2**25 + 4 by float32
+    data          = np.zeros((10, 10, 10), dtype=np.int64)
+    data[1, 1, 1] = 100
+    data[2, 2, 2] = 2 ** 25 + 3
+    data[3, 3, 3] = -(2 ** 25 + 3)
+
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)),
+                                     loadData=True)
+    wrapper[:]
+    wrapper[2, 2, 2] = 0
+    assert wrapper.dataRange[1] == 100
+    wrapper[3, 3, 3] = 0
+    assert wrapper.dataRange == (0, 100)
+
+
+def test_ImageWrapper_write_keepCoverage():
+
+    data = np.random.random((10, 10, 10, 4)) + 1
+    data[1, 1, 1, 2] = 0
+    data[8, 8, 8, 2] = 5
+
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)),
+                                     loadData=True)
+    wrapper[..., 2]
+    assert wrapper.dataRange == (0, 5)
+    cov = wrapper.coverage(2)
+
+    # A write which does not touch the
+    # min/max just widens the range,
+    # without resetting the coverage
+    wrapper[4:6, 4:6, 4:6, 2] = np.full((2, 2, 2), 3)
+    assert wrapper.dataRange == (0, 5)
+    assert np.all(wrapper.coverage(2) == cov)
+
+    wrapper[4, 4, 4, 2] = 10
+    assert wrapper.dataRange == (0, 10)
+    assert np.all(wrapper.coverage(2) == cov)
+
+    wrapper[5, 5, 5, 2] = -1
+    assert wrapper.dataRange == (-1, 10)
+    assert np.all(wrapper.coverage(2) == cov)
+
+    # Overwriting the maximum means that
+    # the range has to be re-calculated
+    wrapper[4, 4, 4, 2] = 2
+    assert wrapper.dataRange == (-1, 5)
+
+    # And the minimum
+    wrapper[5:7, 5:7, 5:7, 2] = np.full((2, 2, 2), 2)
+    assert wrapper.dataRange == (0, 5)
+
+    # Partial overlap with the coverage - the
+    # range is widened, and the coverage is
+    # expanded to include the written area
+    wrapper = imagewrap.ImageWrapper(nib.Nifti1Image(data, np.eye(4)),
+                                     loadData=True)
+    wrapper[2:5, 2:5, 2:5, 1]
+    wrapper[4:8, 4:8, 4:8, 1] = np.full((4, 4, 4), 7)
+
+    expected = np.array(data[2:8, 2:8, 2:8, 1])
+    expected[2:6, 2:6, 2:6] = 7
+
+    assert np.all(wrapper.coverage(1) == [[2, 2, 2], [8, 8, 8]])
+    assert np.isclose(wrapper.dataRange[0], expected.min())
+    assert np.isclose(wrapper.dataRange[1], expected.max())
@@ -11,6 +11,7 @@ from __future__ import print_function
 
 import               os
 import os.path    as op
+import itertools  as it
 import               shutil
 import subprocess as sp
 import               tempfile
@@ -21,6 +22,7 @@ import nibabel as nib
 
 from nibabel.spatialimages import ImageFileError
 
+import mock
 import pytest
 
 import fsl.utils.path   as fslpath
@@ -681,3 +683,289 @@ def test_imcp_shouldPass(move=False):
 
 def test_immv_shouldPass():
     test_imcp_shouldPass(move=True)
+
+
+def test_imcp_many(move=False):
+
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    try:
+        names  = ['file{}'.format(i) for i in range(10)]
+        hashes = {}
+
+        for n in names:
+            hashes[n + '.nii.gz'] = makeImage(op.join(indir, n + '.nii'))
+
+        srcs = [op.join(indir, n) for n in names]
+
+        imcp.imcp_many(srcs,
+                       outdir,
+                       useDefaultExt=True,
+                       move=move,
+                       nprocs=4)
+
+        checkFilesToExpect(names, outdir, 'NIFTI_GZ', hashes)
+
+        if move: assert len(os.listdir(indir)) == 0
+        else:    assert len(os.listdir(indir)) == len(names)
+
+    finally:
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_immv_many():
+    test_imcp_many(move=True)
+
+
+def test_imcp_many_same_dest():
+
+    # Copies to the same destination are
+    # performed in order - the last one wins
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    try:
+        makeImage(op.join(indir, 'a.nii'))
+        makeImage(op.join(indir, 'b.img'))
+        datahash = makeImage(op.join(indir, 'c.nii.gz'))
+
+        srcs  = [op.join(indir, f) for f in ('a', 'b', 'c')]
+        dests = [op.join(outdir, 'out')] * 3
+
+        imcp.imcp_many(srcs,
+                       dests,
+                       overwrite=True,
+                       useDefaultExt=True,
+                       nprocs=3)
+
+        checkFilesToExpect(['out'],
+                           outdir,
+                           'NIFTI_GZ',
+                           {'out.nii.gz' : datahash})
+
+        # Without overwrite, this is an error
+        cleardir(outdir)
+
+        with pytest.raises(fslpath.PathError):
+            imcp.imcp_many(srcs, dests, useDefaultExt=True, nprocs=3)
+
+        assert len(os.listdir(outdir)) == 0
+
+    finally:
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_imcp_many_errors():
+
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    try:
+        makeImage(op.join(indir, 'a.nii'))
+        makeImage(op.join(indir, 'b.nii'))
+
+        # Every pair is checked before
+        # anything is copied, and errors
+        # are reported for each file
+        srcs = [op.join(indir, f) for f in ('a', 'x', 'b', 'y')]
+
+        with pytest.raises(fslpath.PathError) as e:
+            imcp.imcp_many(srcs, outdir, nprocs=2)
+
+        msg = str(e.value)
+        assert len(os.listdir(outdir)) == 0
+        assert len(msg.split('\n')) == 2
+        assert srcs[1] in msg and srcs[3] in msg
+
+        # Errors which occur during the copy
+        # are reported after all of the other
+        # files have been copied
+        with open(op.join(indir, 'c.nii'), 'wt') as f:
+            f.write('not an image')
+
+        srcs = [op.join(indir, f) for f in ('a', 'c', 'b')]
+
+        with pytest.raises(fslpath.PathError) as e:
+            imcp.imcp_many(srcs, outdir, useDefaultExt=True, nprocs=2)
+
+        msg = str(e.value)
+        assert len(msg.split('\n')) == 1
+        assert srcs[1] in msg
+        assert op.exists(op.join(outdir, 'a.nii.gz'))
+        assert op.exists(op.join(outdir, 'b.nii.gz'))
+
+        with pytest.raises(ValueError):
+            imcp.imcp_many(srcs, [outdir, outdir])
+
+    finally:
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_imcp_script_nprocs(move=False):
+
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    if move: script = immv_script
+    else:    script = imcp_script
+
+    try:
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
+
+        names  = ['file{}'.format(i) for i in range(6)]
+        hashes = {}
+
+        for n in names:
+            hashes[n + '.nii.gz'] = makeImage(op.join(indir, n + '.img'))
+
+        srcs = [op.join(indir, n) for n in names]
+
+        assert script.main(['-j', '3'] + srcs + [outdir]) == 0
+        checkFilesToExpect(names, outdir, 'NIFTI_GZ', hashes)
+
+        cleardir(outdir)
+
+        if not move:
+            assert script.main(['-j0'] + srcs + [outdir]) == 0
+            checkFilesToExpect(names, outdir, 'NIFTI_GZ', hashes)
+
+        assert script.main(['-j'])                   != 0
+        assert script.main(['-j', 'a', 'b', 'c'])    != 0
+        assert script.main(['-jx', srcs[0], outdir]) != 0
+
+    finally:
+        os.environ.pop('FSLOUTPUTTYPE', None)
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_immv_script_nprocs():
+    test_imcp_script_nprocs(move=True)
+
+
+def test_convertImage():
+
+    exts = ['.nii', '.nii.gz', '.img', '.img.gz']
+
+    def makeNifti(filename, ctr):
+        data  = np.array(np.random.random((9, 8, 7, 3)) * 100,
+                         dtype=np.float32)
+        xform = np.diag([2, 3, 4, 1])
+        xform[:3, 3] = [10, 20, 30]
+        img   = ctr(data, xform)
+
+        img.header['descrip'] = b'imcp test'
+        img.header.extensions.append(
+            nib.nifti1.Nifti1Extension(6, b'some comment text'))
+
+        nib.save(img, filename)
+        return data, xform
+
+    ctrs = {
+        1 : {False : nib.Nifti1Image, True : nib.Nifti1Pair},
+        2 : {False : nib.Nifti2Image, True : nib.Nifti2Pair}}
+
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    # The conversion should not
+    # load the image via nibabel
+    realLoad = nib.load
+    def load(*args, **kwargs):
+        raise AssertionError('nib.load called')
+
+    try:
+        for version, srcExt, destExt in it.product((1, 2), exts, exts):
+
+            if srcExt == destExt:
+                continue
+
+            src  = op.join(indir,  'src'  + srcExt)
+            dest = op.join(outdir, 'dest' + destExt)
+            ctr  = ctrs[version][srcExt.startswith('.img')]
+
+            data, xform = makeNifti(src, ctr)
+
+            with mock.patch('nibabel.load', load):
+                imcp.convertImage(src, dest, chunkSize=1000)
+
+            img = realLoad(dest)
+
+            hdr = img.header
+
+            if version == 1:
+                assert     isinstance(hdr, nib.Nifti1Header)
+                assert not isinstance(hdr, nib.Nifti2Header)
+            else:
+                assert isinstance(hdr, nib.Nifti2Header)
+
+            assert np.all(np.asarray(img.dataobj) == data)
+            assert np.all(np.isclose(img.affine, xform))
+            assert hdr['descrip'] == b'imcp test'
+            assert hdr.extensions[0].get_content() == b'some comment text'
+
+            cleardir(indir)
+            cleardir(outdir)
+
+        # ANALYZE images are
+        # converted via nibabel
+        src  = op.join(indir,  'src.img')
+        dest = op.join(outdir, 'dest.nii')
+        data = np.array(np.random.random((9, 8, 7)) * 100, dtype=np.float32)
+        nib.save(nib.AnalyzeImage(data, np.eye(4)), src)
+
+        imcp.convertImage(src, dest)
+
+        assert np.all(np.asarray(nib.load(dest).dataobj) == data)
+
+    finally:
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_imcp_convert_pair(move=False):
+
+    indir  = tempfile.mkdtemp()
+    outdir = tempfile.mkdtemp()
+
+    try:
+        datahash = makeImage(op.join(indir, 'a.img'))
+        src      = op.join(indir,  'a')
+
+        # Both files in the pair
+        # should be moved/overwritten
+        make_dummy_file(op.join(outdir, 'b.hdr.gz'))
+
+        with pytest.raises(fslpath.PathError):
+            imcp.imcp(src, op.join(outdir, 'b.img.gz'), move=move)
+        with pytest.raises(fslpath.PathError):
+            imcp.imcp(src, op.join(outdir, 'b.hdr.gz'), move=move)
+
+        cleardir(outdir)
+
+        imcp.imcp(src, op.join(outdir, 'b.nii.gz'), move=move)
+        checkImageHash(op.join(outdir, 'b.nii.gz'), datahash)
+
+        if move: assert len(os.listdir(indir)) == 0
+        else:    assert len(os.listdir(indir)) == 2
+
+        src = op.join(outdir, 'b')
+        imcp.imcp(src, op.join(outdir, 'c.img.gz'), move=move)
+        checkImageHash(op.join(outdir, 'c.img.gz'), datahash)
+
+        if move: expect = ['c.hdr.gz', 'c.img.gz']
+        else:    expect = ['b.nii.gz', 'c.hdr.gz', 'c.img.gz']
+
+        assert sorted(os.listdir(outdir)) == expect
+
+    finally:
+        shutil.rmtree(indir)
+        shutil.rmtree(outdir)
+
+
+def test_immv_convert_pair():
+    test_imcp_convert_pair(move=True)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# test_startup.py - Make sure that the command-line tools which do not
+# need to load images do not import nibabel or scipy.
+#
+# Author: Paul McCarthy <pauldmccarthy@gmail.com>
+#
+
+
+import os.path    as op
+import               os
+import               sys
+import               textwrap
+import subprocess as sp
+
+from tests import testdir
+
+
+rootdir = op.abspath(op.join(op.dirname(__file__), '..'))
+
+
+def _run(code, cwd=None):
+    """Runs the given code in a new python interpreter, and returns the
+    names of any heavy modules which it imported.
+    """
+
+    code = textwrap.dedent(code) + textwrap.dedent("""
+    heavy = [m for m in ('nibabel', 'scipy') if m in sys.modules]
+    print('heavy:' + ' '.join(heavy))
+    """)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = op.pathsep.join(
+        [rootdir] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    output = sp.check_output([sys.executable, '-c', code],
+                             cwd=cwd,
+                             env=env)
+
+    heavy = output.decode().strip().split('\n')[-1]
+    heavy = heavy[len('heavy:'):].split()
+
+    return heavy
+
+
+def test_imglob_startup():
+
+    with testdir(['file.hdr', 'file.img', 'other.nii.gz']) as td:
+        heavy = _run("""
+        import sys
+        import fsl.scripts.imglob as imglob
+        imglob.main(['file', 'other'])
+        """, cwd=td)
+
+    assert heavy == []
+
+
+def test_imcp_startup():
+
+    # imcp/immv use the default file type, so
+    # files of that type are copied/moved
+    # without being loaded
+    with testdir(['file.nii.gz', 'other.nii.gz']) as td:
+        heavy = _run("""
+        import os
+        import sys
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI_GZ'
+        import fsl.scripts.imcp as imcp
+        import fsl.scripts.immv as immv
+        imcp.main([r'{0}/file',  r'{0}/copy'])
+        immv.main([r'{0}/other', r'{0}/moved'])
+        """.format(td), cwd=td)
+
+        assert op.exists(op.join(td, 'copy.nii.gz'))
+        assert op.exists(op.join(td, 'moved.nii.gz'))
+        assert not op.exists(op.join(td, 'other.nii.gz'))
+
+    assert heavy == []
+
+
+def test_atlasq_list_startup():
+
+    heavy = _run("""
+    import sys
+    import fsl.scripts.atlasq as atlasq
+    atlasq.main(['list'])
+    """)
+
+    assert heavy == []
+
+
+
+def test_module_imports():
+
+    # The light-weight modules must not
+    # import nibabel or scipy, but the
+    # image module does
+    for mod in ('fsl.data.imagepath',
+                'fsl.data.atlasregistry',
+                'fsl.scripts.imglob',
+                'fsl.scripts.atlasq'):
+        assert _run('import sys\nimport {}'.format(mod)) == []
+
+    assert 'nibabel' in _run('import sys\nimport fsl.data.image')